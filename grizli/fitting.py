@@ -10,6 +10,7 @@ import glob
 import logging
 import matplotlib.gridspec
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 import numpy as np
 import os
 import scipy.interpolate
@@ -38,14 +39,7 @@ IGM_MINZ = 4
 
 PLINE = {'kernel': 'point', 'pixfrac': 0.2, 'pixscale': 0.1, 'size': 8, 'wcs': None}
 
-# IGM from eazy-py
-try:
-    import eazy.igm
-    IGM = eazy.igm.Inoue14()
-except:
-    IGM = None
-
-def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002], fitter='nnls', group_name='grism', fit_stacks=True, prior=None, fcontam=0.2, pline=PLINE, mask_sn_limit=3, fit_only_beams=False, fit_beams=True, root='', fit_trace_shift=False, phot=None, verbose=True, scale_photometry=False, show_beams=True):
+def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002], fitter='nnls', group_name='grism', fit_stacks=True, prior=None, fcontam=0.2, pline=PLINE, mask_sn_limit=3, fit_only_beams=False, fit_beams=True, root='', fit_trace_shift=False, phot=None, verbose=True, scale_photometry=False, show_beams=True, use_template_bank=False):
     """Run the full procedure
     
     1) Load MultiBeam and stack files 
@@ -53,6 +47,11 @@ def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002],
     
     fwhm=1200; zr=[0.65, 1.6]; dz=[0.004, 0.0002]; group_name='grism'; fit_stacks=True; prior=None; fcontam=0.2; mask_sn_limit=3; fit_beams=True; root=''
     
+    If `use_template_bank` is True, the default `t0` and `t1` templates are
+    the cached `~grizli.utils.TemplateBank` versions from 
+    `~grizli.utils.load_template_bank` rather than 
+    `~grizli.utils.load_templates`.
+    
     """
     from grizli.stack import StackFitter
     from grizli.multifit import MultiBeam    
@@ -80,11 +79,16 @@ def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002],
         st.set_photometry(**phot)
         mb.set_photometry(**phot)
             
+    if use_template_bank:
+        load_templates = grizli.utils.load_template_bank
+    else:
+        load_templates = grizli.utils.load_templates
+        
     if t0 is None:
-        t0 = grizli.utils.load_templates(line_complexes=True, fsps_templates=True, fwhm=fwhm)
+        t0 = load_templates(line_complexes=True, fsps_templates=True, fwhm=fwhm)
     
     if t1 is None:
-        t1 = grizli.utils.load_templates(line_complexes=False, fsps_templates=True, fwhm=fwhm)
+        t1 = load_templates(line_complexes=False, fsps_templates=True, fwhm=fwhm)
         
     # Fit on stacked spectra
     if fit_only_beams:
@@ -393,6 +397,46 @@ def _loss(dz, gamma=0.15):
     loss : float
     """
     return 1-1/(1+(dz/gamma)**2)
+
+def _stack_xfit_outputs(outputs, NCOEFF=0):
+    """Stack `xfit_at_z` outputs into chi2, coeffs and covar arrays
+    
+    `NCOEFF` sets the array shapes if `outputs` is empty.
+    """
+    NZ = len(outputs)
+    if NZ > 0:
+        NCOEFF = len(outputs[0][1])
+        
+    chi2 = np.zeros(NZ)
+    coeffs = np.zeros((NZ, NCOEFF))
+    covar = np.zeros((NZ, NCOEFF, NCOEFF))
+    for i, out in enumerate(outputs):
+        chi2[i], coeffs[i,:], coeffs_err, covar[i,:,:] = out
+    
+    return chi2, coeffs, covar
+    
+### Fitter object and `xfit_at_z` arguments for process pool workers
+_XFIT_STATE = None
+
+def _xfit_init_worker(fitter_obj, kwargs):
+    """Initializer for `GroupFitter.get_xfit_pool` process pools
+    
+    The fitter object is sent to each worker only once.
+    """
+    global _XFIT_STATE
+    _XFIT_STATE = (fitter_obj, kwargs)
+
+def _xfit_worker(z):
+    """Evaluate `xfit_at_z` with the stored worker state
+    """
+    fitter_obj, kwargs = _XFIT_STATE
+    return fitter_obj.xfit_at_z(z=z, **kwargs)
+
+def _xfit_thread_worker(args):
+    """Evaluate `xfit_at_z` in a thread pool, `args` = (fitter_obj, kwargs, z)
+    """
+    fitter_obj, kwargs, z = args
+    return fitter_obj.xfit_at_z(z=z, **kwargs)
     
 class GroupFitter(object):
     """Combine stack.StackFitter and MultiBeam fitting into a single object
@@ -470,6 +514,18 @@ class GroupFitter(object):
                            
         return A_bg
     
+    def init_model_matrix(self):
+        """Precompute sparse dispersion operators for the beams
+        
+        With the operators initialized, the template models in `xfit_at_z`
+        are computed as a single sparse matrix product for each beam, 
+        rather than with the batched dispersion kernel.  See
+        `~grizli.model.BeamCutout.init_model_matrix`.
+        """
+        for beam in self.beams:
+            if hasattr(beam, 'init_model_matrix'):
+                beam.init_model_matrix()
+    
     def get_SDSS_photometry(self, bands='ugriz', templ=None, radius=2):
         from astroquery.sdss import SDSS
         from astropy import coordinates as coords
@@ -603,7 +659,7 @@ class GroupFitter(object):
             
         return A_phot[:,mask]
         
-    def xfit_at_z(self, z=0, templates=[], fitter='nnls', fit_background=True, get_uncertainties=False, get_design_matrix=False, pscale=None):
+    def xfit_at_z(self, z=0, templates=[], fitter='nnls', fit_background=True, get_uncertainties=False, get_design_matrix=False, pscale=None, normal_equations=False, log_shift=False):
         """Fit the 2D spectra with a set of templates at a specified redshift.
         
         Parameters
@@ -627,6 +683,22 @@ class GroupFitter(object):
         
         get_design_matrix : bool
             Return design matrix and data, rather than nominal outputs.
+        
+        normal_equations : bool
+            Solve for the coefficients with the small normal system of 
+            the design matrix, see `~grizli.utils.normal_equations_lstsq`, 
+            which is also reused for the covariance.  Falls back to the 
+            solvers of the full design matrix if the normal matrix can't be
+            factored.
+        
+        log_shift : bool
+            If `templates` is a `~grizli.utils.TemplateBank`, apply the 
+            redshift as a shift of the log-wavelength template arrays and 
+            resample them to the beam wavelengths with operators that are 
+            precomputed once per beam, see
+            `~grizli.model.GrismDisperser.interpolate_log_spectra`.  Otherwise
+            the redshifted templates are interpolated separately for every 
+            beam.
             
         Returns
         -------
@@ -656,43 +728,73 @@ class GroupFitter(object):
         
         COEFF_SCALE = 1.e-19
         
+        log_shift &= isinstance(templates, utils.TemplateBank)
+        
+        # IGM from eazy-py, tabulated and shared by all of the fitting 
+        # functions.  The table is only initialized on first use.
+        if z > IGM_MINZ:
+            igm = utils.get_igm_table()
+        else:
+            igm = None
+            
+        spectra = []
         for i, t in enumerate(templates):
             if t.startswith('line'):
                 lower_bound[self.N+i] = -np.inf
-                
+
             ti = templates[t]
-            if z > IGM_MINZ:
-                if IGM is None:
-                    igmz = 1.
-                else:
-                    igmz = IGM.full_IGM(z, ti.wave*(1+z))         
-            else:
+            if igm is None:
                 igmz = 1.
-                
-            s = [ti.wave*(1+z), ti.flux/(1+z)*igmz]
-            
-            for j, beam in enumerate(self.beams):
-                mask_i = beam.fit_mask.reshape(beam.sh)
-                clip = mask_i.sum(axis=0) > 0        
-                if clip.sum() == 0:
-                    continue
-                                
-                lam_beam = beam.wave[clip]
-                if ((s[0].min() > lam_beam.max()) | 
+            else:
+                igmz = igm.full_IGM(z, ti.wave*(1+z))
+
+            spectra.append([ti.wave*(1+z), ti.flux/(1+z)*igmz])
+
+        for j, beam in enumerate(self.beams):
+            mask_i = beam.fit_mask.reshape(beam.sh)
+            clip = mask_i.sum(axis=0) > 0
+            if clip.sum() == 0:
+                continue
+
+            lam_beam = beam.wave[clip]
+            sl = self.mslices[j]
+
+            ### Templates that overlap with the beam
+            tmatrix = []
+            for i, t in enumerate(templates):
+                s = spectra[i]
+                if ((s[0].min() > lam_beam.max()) |
                     (s[0].max() < lam_beam.min())):
                     continue
 
-                sl = self.mslices[j]
                 if t in beam.thumbs:
                     #print('Use thumbnail!', t)
                     A[self.N+i, sl] = beam.compute_model(thumb=beam.thumbs[t], spectrum_1d=s, in_place=False, is_cgs=True)[beam.fit_mask]*COEFF_SCALE
                 else:
-                    A[self.N+i, sl] = beam.compute_model(spectrum_1d=s, in_place=False, is_cgs=True)[beam.fit_mask]*COEFF_SCALE
-                    
-                # if j == 0:
-                #     m = beam.compute_model(spectrum_1d=s, in_place=False, is_cgs=True)
-                #     ds9.frame(i)
-                #     ds9.view(m.reshape(beam.sh))
+                    tmatrix.append(i)
+
+            if len(tmatrix) == 0:
+                continue
+
+            ### Compute models for all templates together
+            if log_shift & hasattr(beam, 'compute_masked_log_models'):
+                models = beam.compute_masked_log_models(
+                                        templates.flux_arr[tmatrix,:],
+                                        templates.wave, z=z, is_cgs=True,
+                                        igm=igm)
+            elif hasattr(beam, 'compute_masked_models'):
+                models = beam.compute_masked_models([spectra[i]
+                                                     for i in tmatrix],
+                                                    is_cgs=True)
+            else:
+                models = None
+
+            if models is not None:
+                A[self.N+np.array(tmatrix), sl] = models*COEFF_SCALE
+                continue
+
+            for i in tmatrix:
+                A[self.N+i, sl] = beam.compute_model(spectrum_1d=spectra[i], in_place=False, is_cgs=True)[beam.fit_mask]*COEFF_SCALE
                         
         if fit_background:
             if fitter in ['nnls', 'lstsq']:
@@ -736,18 +838,28 @@ class GroupFitter(object):
             return AxT, data
             
         # Run the minimization
-        if fitter == 'nnls':
-            coeffs_i, rnorm = scipy.optimize.nnls(AxT, data)            
-        elif fitter == 'lstsq':
-            try:
-                coeffs_i, residuals, rank, s = np.linalg.lstsq(AxT, data)
-            except: 
-                logging.info("FAILED at lstsq fitting.")
-                return None
+        if normal_equations:
+            bounds = (lower_bound[oktemp], upper_bound[oktemp])
+            out = utils.normal_equations_lstsq(AxT, data, fitter=fitter,
+                                               bounds=bounds)
+            coeffs_i, ATA, R = out
         else:
-            # Bounded Least Squares
-            lsq_out = scipy.optimize.lsq_linear(AxT, data, bounds=(lower_bound[oktemp], upper_bound[oktemp]), method='bvls', tol=1.e-8)
-            coeffs_i = lsq_out.x
+            coeffs_i, ATA, R = None, None, None
+            
+        if coeffs_i is None:
+            # Full design matrix
+            if fitter == 'nnls':
+                coeffs_i, rnorm = scipy.optimize.nnls(AxT, data)            
+            elif fitter == 'lstsq':
+                try:
+                    coeffs_i, residuals, rank, s = np.linalg.lstsq(AxT, data)
+                except: 
+                    logging.info("FAILED at lstsq fitting.")
+                    return None
+            else:
+                # Bounded Least Squares
+                lsq_out = scipy.optimize.lsq_linear(AxT, data, bounds=(lower_bound[oktemp], upper_bound[oktemp]), method='bvls', tol=1.e-8)
+                coeffs_i = lsq_out.x
             
         # Compute background array         
         if fit_background:
@@ -776,7 +888,7 @@ class GroupFitter(object):
         if get_uncertainties:
             try:
                 # Covariance is inverse of AT.A
-                covar_i = np.matrix(np.dot(AxT.T, AxT)).I.A
+                covar_i = utils.normal_covariance(AxT, ATA=ATA, R=R)
                 covar = utils.fill_masked_covar(covar_i, oktemp)
                 covard = np.sqrt(covar.diagonal())
                 
@@ -788,7 +900,12 @@ class GroupFitter(object):
                         #mcoeffs_i, rnorm = scipy.optimize.nnls(AxTm, data)            
                         #mcoeffs_i[:self.N] -= pedestal
 
-                        mcovar_i = np.matrix(np.dot(AxTm.T, AxTm)).I.A
+                        if ATA is None:
+                            mcovar_i = utils.normal_covariance(AxTm)
+                        else:
+                            ATAm = ATA[nonzero,:][:,nonzero]
+                            mcovar_i = utils.normal_covariance(ATA=ATAm)
+                        
                         mcovar = utils.fill_masked_covar(mcovar_i, nonzero)
                         mcovar = utils.fill_masked_covar(mcovar, oktemp)
                         mcovard = np.sqrt(mcovar.diagonal())
@@ -818,13 +935,241 @@ class GroupFitter(object):
             
         return chi2, coeffs, coeffs_err, covar
     
+    def get_xfit_pool(self, n_jobs=1, executor='process', **kwargs):
+        """Worker pool for evaluating `xfit_at_z` on redshift grids
+        
+        Parameters
+        ----------
+        n_jobs : int
+            Number of workers.  If <= 0, use `mp.cpu_count()`.  Returns None
+            for `n_jobs` = 1.
+        
+        executor : 'process', 'thread'
+            With 'process', a `multiprocessing.Pool` is initialized with a 
+            copy of `self` and `kwargs` sent once to each worker process.  
+            With 'thread', use a `multiprocessing.pool.ThreadPool` that 
+            shares `self`, which only runs in parallel where the numerical 
+            routines release the GIL (e.g., threaded BLAS).  The cached 
+            per-beam arrays are built under `~grizli.model.CACHE_LOCK` so that
+            the threads can share the beams.
+        
+        kwargs : dict
+            Keywords passed to `xfit_at_z`, e.g., `templates`, `fitter`.
+            
+        Returns
+        -------
+        pool : `multiprocessing.Pool`, `multiprocessing.pool.ThreadPool` or None
+            The pool, which should be closed after use, also if the fits 
+            raise an exception.  The `xfit_at_z`
+            arguments are stored in `pool.xfit_kwargs`.
+        """
+        if n_jobs <= 0:
+            n_jobs = mp.cpu_count()
+        
+        if n_jobs == 1:
+            return None
+            
+        if executor == 'thread':
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(processes=n_jobs)
+        elif executor == 'process':
+            pool = mp.Pool(processes=n_jobs, initializer=_xfit_init_worker,
+                           initargs=(self, kwargs))
+        else:
+            raise ValueError("executor must be 'process' or 'thread'")
+            
+        pool.xfit_executor = executor
+        pool.xfit_kwargs = kwargs
+        return pool
+        
+    def xfit_zgrid(self, zgrid, pool=None, verbose=True, label='  ', 
+                   **kwargs):
+        """Evaluate `xfit_at_z` on a grid of redshifts
+        
+        Parameters
+        ----------
+        zgrid : array-like
+            Redshift grid.
+        
+        pool : None or output of `get_xfit_pool`
+            If specified, distribute the redshifts to the workers of the 
+            pool and ignore `kwargs`, which were set when the pool was 
+            created.  The outputs are identical to the serial evaluation.
+        
+        verbose : bool
+            Print status messages.
+        
+        label : str
+            Prefix for the status messages.
+            
+        kwargs : dict
+            Keywords passed to `xfit_at_z`.
+            
+        Returns
+        -------
+        chi2 : `~np.ndarray`, shape (NZ,)
+            Chi-squared values.
+        
+        coeffs : `~np.ndarray`, shape (NZ, NCOEFF)
+            Fit coefficients.
+        
+        covar : `~np.ndarray`, shape (NZ, NCOEFF, NCOEFF)
+            Covariance matrices.
+        """
+        NZ = len(zgrid)
+        
+        if pool is None:
+            outputs = []
+            chi2min = 1e30
+            iz = 0
+            for i in range(NZ):
+                out = self.xfit_at_z(z=zgrid[i], **kwargs)
+                outputs.append(out)
+                
+                if out[0] < chi2min:
+                    iz = i
+                    chi2min = out[0]
+                
+                if verbose:                    
+                    print(utils.NO_NEWLINE + label + '{0:.4f} {1:9.1f} ({2:.4f}) {3:d}/{4:d}'.format(zgrid[i], out[0], zgrid[iz], i+1, NZ))
+        else:
+            if pool.xfit_executor == 'thread':
+                args = [(self, pool.xfit_kwargs, z) for z in zgrid]
+                outputs = pool.map(_xfit_thread_worker, args)
+            else:
+                outputs = pool.map(_xfit_worker, zgrid)
+            
+            if verbose:
+                iz = np.argmin([out[0] for out in outputs])
+                print(utils.NO_NEWLINE + label + '{0:.4f} {1:9.1f} ({2:.4f}) {3:d}/{4:d}'.format(zgrid[-1], outputs[-1][0], zgrid[iz], NZ, NZ))
+        
+        return _stack_xfit_outputs(outputs)
+        
+    def xfit_adaptive_zoom(self, zgrid, chi2, indexes, ztol=0.0002, 
+                           max_evals=100, NCOEFF=0, verbose=True, **kwargs):
+        """Refine the redshift of chi2 minima with bounded Brent searches
+        
+        For each peak of the coarse grid, the minimum bracketed by the 
+        neighboring grid points is found with 
+        `scipy.optimize.minimize_scalar(method='bounded')`.  
+        
+        Parameters
+        ----------
+        zgrid, chi2 : `~np.ndarray`
+            Coarse redshift grid and chi-squared values.
+        
+        indexes : list
+            Indices of the peaks in `zgrid` to refine.  Peaks at the edges of
+            the grid are skipped.
+            
+        ztol : float
+            Convergence tolerance in redshift.
+        
+        max_evals : int
+            Maximum total number of `xfit_at_z` evaluations for all peaks.
+        
+        NCOEFF : int
+            Number of coefficients, used for the shape of the empty output 
+            arrays if no redshifts are evaluated.
+        
+        verbose : bool
+            Print status messages.
+            
+        kwargs : dict
+            Keywords passed to `xfit_at_z`.
+            
+        Returns
+        -------
+        zgrid_zoom : `~np.ndarray`, shape (NZOOM,)
+            Redshifts evaluated by the searches.
+        
+        chi2_zoom, coeffs_zoom, covar_zoom : `~np.ndarray`
+            Outputs of `xfit_at_z` at `zgrid_zoom`, as from `xfit_zgrid`.
+        """
+        evals = OrderedDict()
+        
+        def _objfun(z):
+            z = float(z)
+            if z not in evals:
+                evals[z] = self.xfit_at_z(z=z, **kwargs)
+                if verbose:
+                    print(utils.NO_NEWLINE+'- {0:.4f} {1:9.1f} {2:d}'.format(z, evals[z][0], len(evals)))
+                    
+            return evals[z][0]
+        
+        for ix in indexes:
+            if (ix == 0) | (ix >= len(chi2)-1):
+                continue
+            
+            ### The bounded method needs at least a few evaluations
+            maxiter = max_evals - len(evals)
+            if maxiter < 3:
+                break
+                
+            scipy.optimize.minimize_scalar(_objfun, 
+                                bounds=(zgrid[ix-1], zgrid[ix+1]),
+                                method='bounded', 
+                                options={'xatol':ztol, 'maxiter':maxiter})
+        
+        zgrid_zoom = np.array(list(evals.keys()))
+        out = _stack_xfit_outputs(list(evals.values()), NCOEFF=NCOEFF)
+        chi2_zoom, coeffs_zoom, covar_zoom = out
+        
+        return zgrid_zoom, chi2_zoom, coeffs_zoom, covar_zoom
+        
     def xfit_redshift(self, prior=None, fwhm=1200,
                      make_figure=True, zr=[0.65, 1.6], dz=[0.005, 0.0004],
                      verbose=True, fit_background=True, fitter='nnls', 
                      delta_chi2_threshold=0.004, poly_order=3, zoom=True, 
                      line_complexes=True, templates={}, figsize=[8,5],
-                     fsps_templates=False, get_uncertainties=True):
+                     fsps_templates=False, get_uncertainties=True,
+                     n_jobs=1, executor='process', search='grid', 
+                     ztol=None, max_evals=100, lazy_covar=False,
+                     normal_equations=False, log_shift=False):
         """TBD
+        
+        Parameters
+        ----------
+        n_jobs : int
+            Number of workers used to evaluate the redshift grids, see 
+            `get_xfit_pool`.  The results are identical to the serial 
+            evaluation with the default `n_jobs=1`.
+        
+        executor : 'process', 'thread'
+            Type of the worker pool, see `get_xfit_pool`.
+        
+        search : 'grid', 'adaptive'
+            Method for refining the peaks of the coarse redshift grid.  With
+            'grid', evaluate a fine grid with step `dz[1]` around each peak.
+            With 'adaptive', find the chi2 minimum around each peak with 
+            bounded Brent searches, see `xfit_adaptive_zoom`, which 
+            generally needs many fewer evaluations.
+        
+        ztol : float or None
+            Redshift tolerance of the adaptive search.  If None, use `dz[1]`.
+        
+        max_evals : int
+            Maximum number of evaluations of the adaptive search.
+        
+        lazy_covar : bool
+            Fit the redshift grids without computing the covariance 
+            matrices, which are then only computed at the redshift with the
+            minimum chi2 and at the minima of the refined peaks.  The other 
+            rows of the `covar` column of the output table are zero.
+        
+        normal_equations : bool
+            Solve the fits with the normal equations, see `xfit_at_z`.
+        
+        log_shift : bool
+            Evaluate the templates with the log-wavelength shifts, see 
+            `xfit_at_z`.  The templates are first resampled to a
+            `~grizli.utils.TemplateBank` if necessary.
+            
+        Returns
+        -------
+        fit : `~grizli.utils.GTable`
+            Table of the fit results.  The total number of `xfit_at_z` 
+            evaluations is stored in `fit.meta['n_eval']`.
         """
         
         if zr is 0:
@@ -867,98 +1212,126 @@ class GroupFitter(object):
         else:
             if verbose:
                 print('User templates! N={0} \n'.format(len(templates)))
+        
+        if log_shift & (not isinstance(templates, utils.TemplateBank)):
+            templates = utils.TemplateBank.from_templates(templates)
             
         NTEMP = len(templates)
         
         out = self.xfit_at_z(z=0., templates=templates, fitter=fitter,
                             fit_background=fit_background, 
-                            get_uncertainties=get_uncertainties)
+                            get_uncertainties=get_uncertainties,
+                            normal_equations=normal_equations,
+                            log_shift=log_shift)
                             
         chi2, coeffs, coeffs_err, covar = out
         
-        chi2 = np.zeros(NZ)
-        coeffs = np.zeros((NZ, coeffs.shape[0]))
-        covar = np.zeros((NZ, covar.shape[0], covar.shape[1]))
+        ### Pool for computing the redshift grids in parallel
+        fit_kwargs = dict(templates=templates, fitter=fitter,
+                          fit_background=fit_background,
+                          get_uncertainties=get_uncertainties,
+                          normal_equations=normal_equations,
+                          log_shift=log_shift)
         
-        chi2min = 1e30
-        iz = 0
-        for i in range(NZ):
-            out = self.xfit_at_z(z=zgrid[i], templates=templates,
-                                fitter=fitter, fit_background=fit_background,
-                                get_uncertainties=get_uncertainties)
-            
-            chi2[i], coeffs[i,:], coeffs_err, covar[i,:,:] = out
-            if chi2[i] < chi2min:
-                iz = i
-                chi2min = chi2[i]
-
-            if verbose:                    
-                print(utils.NO_NEWLINE + '  {0:.4f} {1:9.1f} ({2:.4f}) {3:d}/{4:d}'.format(zgrid[i], chi2[i], zgrid[iz], i+1, NZ))
+        if lazy_covar:
+            fit_kwargs['get_uncertainties'] = False
+            zpeaks = []
         
-        if verbose:
-            print('First iteration: z_best={0:.4f}\n'.format(zgrid[iz]))
-            
-        ## Find peaks
-        import peakutils
+        pool = self.get_xfit_pool(n_jobs=n_jobs, executor=executor,
+                                  **fit_kwargs)
         
-        # Make "negative" chi2 for peak-finding
-        if chi2_poly > (chi2.min()+100):
-            chi2_rev = (chi2.min() + 100 - chi2)/self.DoF
-        elif chi2_poly < (chi2.min() + 9):
-            chi2_rev = (chi2.min() + 16 - chi2)/self.DoF
-        else:
-            chi2_rev = (chi2_poly - chi2)/self.DoF
+        ### Make sure the workers are shut down if a fit fails
+        try:
             
-        chi2_rev[chi2_rev < 0] = 0
-        indexes = peakutils.indexes(chi2_rev, thres=0.4, min_dist=8)
-        num_peaks = len(indexes)
-        
-        if False:
-            plt.plot(zgrid, (chi2-chi2.min())/ self.DoF)
-            plt.scatter(zgrid[indexes], (chi2-chi2.min())[indexes]/ self.DoF, color='r')
-        
-        # delta_chi2 = (chi2.max()-chi2.min())/self.DoF
-        # if delta_chi2 > delta_chi2_threshold:      
-        if (num_peaks > 0) & (not stars) & zoom:
-            zgrid_zoom = []
-            for ix in indexes:
-                if (ix > 0) & (ix < len(chi2)-1):
-                    c = polyfit(zgrid[ix-1:ix+2], chi2[ix-1:ix+2], 2)
-                    zi = -c[1]/(2*c[0])
-                    chi_i = polyval(c, zi)
-                    zgrid_zoom.extend(np.arange(zi-2*dz[0], 
-                                      zi+2*dz[0]+dz[1]/10., dz[1]))
+            NCOEFF = coeffs.shape[0]
+            chi2, coeffs, covar = self.xfit_zgrid(zgrid, pool=pool, 
+                                                  verbose=verbose, label='  ',
+                                                  **fit_kwargs)
+            iz = np.argmin(chi2)
+            
+            if verbose:
+                print('First iteration: z_best={0:.4f}\n'.format(zgrid[iz]))
+                
+            ## Find peaks
+            import peakutils
+            
+            # Make "negative" chi2 for peak-finding
+            if chi2_poly > (chi2.min()+100):
+                chi2_rev = (chi2.min() + 100 - chi2)/self.DoF
+            elif chi2_poly < (chi2.min() + 9):
+                chi2_rev = (chi2.min() + 16 - chi2)/self.DoF
+            else:
+                chi2_rev = (chi2_poly - chi2)/self.DoF
+                
+            chi2_rev[chi2_rev < 0] = 0
+            indexes = peakutils.indexes(chi2_rev, thres=0.4, min_dist=8)
+            num_peaks = len(indexes)
+            
+            if False:
+                plt.plot(zgrid, (chi2-chi2.min())/ self.DoF)
+                plt.scatter(zgrid[indexes], (chi2-chi2.min())[indexes]/ self.DoF, color='r')
+            
+            # delta_chi2 = (chi2.max()-chi2.min())/self.DoF
+            # if delta_chi2 > delta_chi2_threshold:      
+            n_eval = NZ + 2
+            
+            ### Brackets of the peaks for lazy covariance
+            if lazy_covar & (not stars) & zoom:
+                for ix in indexes:
+                    if (ix > 0) & (ix < len(chi2)-1):
+                        zpeaks.append([zgrid[ix-1], zgrid[ix+1]])
+            
+            if (num_peaks > 0) & (not stars) & zoom & (search == 'adaptive'):
+                if ztol is None:
+                    ztol = dz[1]
                     
-            # zgrid_zoom = utils.zoom_zgrid(zgrid, chi2/self.DoF,
-            #                               threshold=delta_chi2_threshold,
-            #                               factor=dz[0]/dz[1])
-            NZOOM = len(zgrid_zoom)
-        
-            chi2_zoom = np.zeros(NZOOM)
-            coeffs_zoom = np.zeros((NZOOM, coeffs.shape[1]))
-            covar_zoom = np.zeros((NZOOM, coeffs.shape[1], covar.shape[2]))
-
-            iz = 0
-            chi2min = 1.e30
-            for i in range(NZOOM):
-                out = self.xfit_at_z(z=zgrid_zoom[i], templates=templates,
-                                    fitter=fitter,
-                                    fit_background=fit_background,
-                                    get_uncertainties=get_uncertainties)
-
-                chi2_zoom[i], coeffs_zoom[i,:], e, covar_zoom[i,:,:] = out
-                #A, coeffs_zoom[i,:], chi2_zoom[i], model_2d = out
-                if chi2_zoom[i] < chi2min:
-                    chi2min = chi2_zoom[i]
-                    iz = i
+                out = self.xfit_adaptive_zoom(zgrid, chi2, indexes, ztol=ztol,
+                                              max_evals=max_evals, 
+                                              NCOEFF=NCOEFF, verbose=verbose,
+                                              **fit_kwargs)
                 
-                if verbose:
-                    print(utils.NO_NEWLINE+'- {0:.4f} {1:9.1f} ({2:.4f}) {3:d}/{4:d}'.format(zgrid_zoom[i], chi2_zoom[i], zgrid_zoom[iz], i+1, NZOOM))
-        
-            zgrid = np.append(zgrid, zgrid_zoom)
-            chi2 = np.append(chi2, chi2_zoom)
-            coeffs = np.append(coeffs, coeffs_zoom, axis=0)
-            covar = np.vstack((covar, covar_zoom))
+                zgrid_zoom, chi2_zoom, coeffs_zoom, covar_zoom = out
+                n_eval += len(zgrid_zoom)
+                
+                zgrid = np.append(zgrid, zgrid_zoom)
+                chi2 = np.append(chi2, chi2_zoom)
+                coeffs = np.append(coeffs, coeffs_zoom, axis=0)
+                covar = np.vstack((covar, covar_zoom))
+                
+            elif (num_peaks > 0) & (not stars) & zoom:
+                zgrid_zoom = []
+                for ix in indexes:
+                    if (ix > 0) & (ix < len(chi2)-1):
+                        c = polyfit(zgrid[ix-1:ix+2], chi2[ix-1:ix+2], 2)
+                        zi = -c[1]/(2*c[0])
+                        chi_i = polyval(c, zi)
+                        zgrid_zoom.extend(np.arange(zi-2*dz[0], 
+                                          zi+2*dz[0]+dz[1]/10., dz[1]))
+                        
+                # zgrid_zoom = utils.zoom_zgrid(zgrid, chi2/self.DoF,
+                #                               threshold=delta_chi2_threshold,
+                #                               factor=dz[0]/dz[1])
+                NZOOM = len(zgrid_zoom)
+                n_eval += NZOOM
+                
+                if NZOOM > 0:
+                    out = self.xfit_zgrid(zgrid_zoom, pool=pool, verbose=verbose,
+                                          label='- ', **fit_kwargs)
+                    chi2_zoom, coeffs_zoom, covar_zoom = out
+                else:
+                    chi2_zoom = np.zeros(NZOOM)
+                    coeffs_zoom = np.zeros((NZOOM, NCOEFF))
+                    covar_zoom = np.zeros((NZOOM, NCOEFF, NCOEFF))
+                    
+            
+                zgrid = np.append(zgrid, zgrid_zoom)
+                chi2 = np.append(chi2, chi2_zoom)
+                coeffs = np.append(coeffs, coeffs_zoom, axis=0)
+                covar = np.vstack((covar, covar_zoom))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
             
         so = np.argsort(zgrid)
         zgrid = zgrid[so]
@@ -966,6 +1339,25 @@ class GroupFitter(object):
         coeffs = coeffs[so,:]
         covar = covar[so,:,:]
         
+        ### Covariance at the minima
+        if lazy_covar & bool(get_uncertainties):
+            icovar = [np.argmin(chi2)]
+            for zpi in zpeaks:
+                inpeak = (zgrid >= zpi[0]) & (zgrid <= zpi[1])
+                if inpeak.sum() > 0:
+                    icovar.append(np.arange(len(zgrid))[inpeak][np.argmin(chi2[inpeak])])
+            
+            for i in np.unique(icovar):
+                out = self.xfit_at_z(z=zgrid[i], templates=templates, 
+                                     fitter=fitter, 
+                                     fit_background=fit_background,
+                                     get_uncertainties=get_uncertainties,
+                                     normal_equations=normal_equations,
+                                     log_shift=log_shift)
+                covar[i,:,:] = out[3]
+                n_eval += 1
+                
+        
         fit = utils.GTable()
         fit.meta['N'] = (self.N, 'Number of spectrum extensions')
         fit.meta['polyord'] = (poly_order, 'Order polynomial fit')
@@ -974,6 +1366,10 @@ class GroupFitter(object):
         fit.meta['chimin'] = (chi2.min(), 'Minimum chi2')
         fit.meta['chimax'] = (chi2.max(), 'Maximum chi2')
         fit.meta['fitter'] = (fitter, 'Minimization algorithm')
+        fit.meta['zsearch'] = (search, 'Redshift refinement method')
+        fit.meta['n_eval'] = (n_eval, 'Number of xfit_at_z evaluations')
+        fit.meta['lazycov'] = (lazy_covar, 'Covariance only computed at minima')
+        fit.meta['logshift'] = (log_shift, 'Templates shifted on log-wavelength grid')
         
         # Bayesian information criteria, normalized to template min_chi2
         # BIC = log(number of data points)*(number of params) + min(chi2) + C
@@ -5,8 +5,12 @@ Initial code taken from `(Brammer, Pirzkal, & Ryan 2014) <https://github.com/WFC
 explanation how the grism configuration parameters and coefficients are defined and evaluated.
 """
 import os
+import itertools
 import numpy as np
 
+### Unique identifiers of the compiled beams, see `aXeConf.compile_beams`
+COMPILED_VERSION = itertools.count()
+
 class aXeConf():
     def __init__(self, conf_file='WFC3.IR.G141.V2.5.conf'):
         """Read an aXe-compatible configuration file
@@ -124,6 +128,105 @@ class aXeConf():
         
         self.beams.sort()
         
+    def compile_beams(self):
+        """Parse the trace coefficients of all beams into arrays
+        
+        Stores a dictionary for each beam in `self.compiled` with keys
+        
+            - NORDER: number of trace / dispersion polynomial coefficients
+            - XOFF, YOFF: field-dependent coefficients of the beam offsets
+            - DYDX, DLDP: lists of the field-dependent coefficients of the
+              trace and dispersion polynomials, None where not defined
+            - params: list of the (parameter, value) pairs read from 
+              `self.conf`, used to check that the compiled beam is current
+            - sens: state of the sensitivity curve, see 
+              `sensitivity_state`
+            - version: unique integer identifying the compiled parameters,
+              e.g., for keys of `~grizli.model.TRACE_CACHE`
+        
+        so that the parameters don't have to be looked up from `self.conf`
+        in `get_beam_trace`.  `get_compiled_beam` recompiles if any of the 
+        trace parameters in `self.conf` or the sensitivity curves are 
+        replaced.
+        """
+        self.compiled = {}
+        for beam in self.orders:
+            if 'XOFF_{0}'.format(beam) not in self.conf:
+                continue
+                
+            NORDER = self.orders[beam]+1
+            compiled = {'NORDER':NORDER, 'params':[]}
+            for key in ['XOFF', 'YOFF']:
+                param = '{0}_{1}'.format(key, beam)
+                compiled[key] = self.conf[param]
+                compiled['params'].append((param, compiled[key]))
+            
+            for key in ['DYDX', 'DLDP']:
+                compiled[key] = []
+                for i in range(NORDER):
+                    param = '{0}_{1:s}_{2:d}'.format(key, beam, i)
+                    compiled[key].append(self.conf.get(param, None))
+                    compiled['params'].append((param, compiled[key][-1]))
+            
+            compiled['sens'] = self.sensitivity_state(beam)
+            compiled['version'] = next(COMPILED_VERSION)
+            self.compiled[beam] = compiled
+    
+    def sensitivity_state(self, beam='A'):
+        """Sensitivity table and column arrays of a beam with their sums
+        
+        Used to check if the sensitivity curve of a compiled beam has been
+        replaced or modified in place.  Returns None if the beam has no 
+        sensitivity curve.
+        """
+        sens = getattr(self, 'sens', {}).get(beam, None)
+        if sens is None:
+            return None
+        
+        wave, sensitivity = sens['WAVELENGTH'], sens['SENSITIVITY']
+        
+        ### Sums as bytes so that NaN values compare equal
+        checksum = (np.sum(wave, dtype=np.float64).tobytes() +
+                    np.sum(sensitivity, dtype=np.float64).tobytes())
+                    
+        return (sens, wave, sensitivity, checksum)
+    
+    def get_compiled_beam(self, beam='A'):
+        """Get the compiled coefficients of a beam, see `compile_beams`
+        
+        The coefficients are compiled again if the polynomial order of the 
+        beam, any of its trace parameters in `self.conf` or its sensitivity 
+        curve has changed.
+        """
+        if not hasattr(self, 'compiled'):
+            self.compile_beams()
+        
+        if beam not in self.compiled:
+            self.compile_beams()
+        
+        compiled = self.compiled[beam]
+        
+        ## Parameters replaced in `self.conf` since compiled
+        current = compiled['NORDER'] == self.orders[beam]+1
+        for param, value in compiled['params']:
+            if self.conf.get(param, None) is not value:
+                current = False
+                break
+        
+        if current & (compiled['sens'] is not None):
+            state = self.sensitivity_state(beam)
+            current = ((state is not None) &
+                       (state[0] is compiled['sens'][0]) & 
+                       (state[1] is compiled['sens'][1]) &
+                       (state[2] is compiled['sens'][2]) & 
+                       (state[3] == compiled['sens'][3]))
+        
+        if not current:
+            self.compile_beams()
+            compiled = self.compiled[beam]
+            
+        return compiled
+        
     def field_dependent(self, xi, yi, coeffs):
         """aXe field-dependent coefficients
         
@@ -271,17 +374,18 @@ class aXeConf():
             Effective wavelength along the trace evaluated at `dx`.
             
         """
-        NORDER = self.orders[beam]+1
+        compiled = self.get_compiled_beam(beam)
+        NORDER = compiled['NORDER']
         
         xi, yi = x-self.xoff, y-self.yoff
-        xoff_beam = self.field_dependent(xi, yi, self.conf['XOFF_{0}'.format(beam)])
-        yoff_beam = self.field_dependent(xi, yi, self.conf['YOFF_{0}'.format(beam)])
+        xoff_beam = self.field_dependent(xi, yi, compiled['XOFF'])
+        yoff_beam = self.field_dependent(xi, yi, compiled['YOFF'])
     
         ## y offset of trace (DYDX)
         dydx = np.zeros(NORDER) #0 #+1.e-80
         for i in range(NORDER):
-            if 'DYDX_{0:s}_{1:d}'.format(beam, i) in self.conf.keys():
-                coeffs = self.conf['DYDX_{0:s}_{1:d}'.format(beam, i)]
+            coeffs = compiled['DYDX'][i]
+            if coeffs is not None:
                 dydx[i] = self.field_dependent(xi, yi, coeffs)
             
         # $dy = dydx_0+dydx_1 dx+dydx_2 dx^2+$ ...
@@ -293,8 +397,8 @@ class aXeConf():
         ## wavelength solution    
         dldp = np.zeros(NORDER)
         for i in range(NORDER):
-            if 'DLDP_{0:s}_{1:d}'.format(beam, i) in self.conf.keys():
-                coeffs = self.conf['DLDP_{0:s}_{1:d}'.format(beam, i)]
+            coeffs = compiled['DLDP'][i]
+            if coeffs is not None:
                 dldp[i] = self.field_dependent(xi, yi, coeffs)
         
         dp = self.evaluate_dp(dx-xoff_beam, dydx)
@@ -395,6 +499,106 @@ class aXeConf():
                     
         return dy, lam
         
+    def get_beam_traces(self, x=[507], y=[507], dx=0., beam='A', 
+                        fwcpos=None):
+        """Evaluate beam traces for many reference pixels at once
+        
+        Vectorized version of `get_beam_trace` for arrays of source 
+        positions, with trace offsets `dx` common to all sources.
+        
+        Parameters
+        ----------
+        x, y : array-like
+            Detector coordinates of the sources, shape (N,).
+        
+        dx : float or array-like
+            Offset in x pixels, shape (M,).
+        
+        beam : str
+            Beam name.
+        
+        fwcpos : None or float
+            NIRISS filter wheel position.  The rotated traces are computed 
+            for each source separately with `get_beam_trace`.
+            
+        Returns
+        -------
+        dy, lam : `~numpy.ndarray`
+            Trace offsets and effective wavelengths, shape (N, M).  Agree 
+            with `get_beam_trace` to numerical precision.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        dx = np.atleast_1d(np.asarray(dx, dtype=float))
+        N, M = len(x), len(dx)
+        
+        if fwcpos is not None:
+            dy = np.zeros((N, M))
+            lam = np.zeros((N, M))
+            for i in range(N):
+                dy[i,:], lam[i,:] = self.get_beam_trace(x=x[i], y=y[i], dx=dx,
+                                                beam=beam, fwcpos=fwcpos)
+            
+            return dy, lam
+            
+        compiled = self.get_compiled_beam(beam)
+        NORDER = compiled['NORDER']
+        
+        xi, yi = x-self.xoff, y-self.yoff
+        xoff_beam = self.field_dependent(xi, yi, compiled['XOFF'])*np.ones(N)
+        yoff_beam = self.field_dependent(xi, yi, compiled['YOFF'])*np.ones(N)
+        
+        ## Field-dependent trace and dispersion coefficients, (N, NORDER)
+        dydx = np.zeros((N, NORDER))
+        dldp = np.zeros((N, NORDER))
+        for i in range(NORDER):
+            if compiled['DYDX'][i] is not None:
+                dydx[:,i] = self.field_dependent(xi, yi, compiled['DYDX'][i])
+            
+            if compiled['DLDP'][i] is not None:
+                dldp[:,i] = self.field_dependent(xi, yi, compiled['DLDP'][i])
+        
+        ## Trace offsets
+        xx = dx[None,:] - xoff_beam[:,None]
+        dy = yoff_beam[:,None]*np.ones(M)
+        for i in range(NORDER):
+            dy += dydx[:,i][:,None]*xx**i
+        
+        ## Arc length along the trace
+        poly_order = NORDER-1
+        if poly_order == 0:
+            dp = xx*1
+        elif poly_order == 1:
+            dp = np.sqrt(1+dydx[:,1]**2)[:,None]*xx
+        elif poly_order == 2:
+            dp = np.zeros((N, M))
+            
+            ## Sources with linear traces
+            lin = dydx[:,2] == 0
+            if lin.sum() > 0:
+                dp[lin,:] = np.sqrt(1+dydx[lin,1]**2)[:,None]*xx[lin,:]
+            
+            quad = ~lin
+            if quad.sum() > 0:
+                c1 = dydx[quad,1][:,None]
+                c2 = dydx[quad,2][:,None]
+                u0 = c1
+                dp0 = (u0*np.sqrt(1+u0**2)+np.arcsinh(u0))/(4*c2)
+                u = c1+2*c2*xx[quad,:]
+                dp[quad,:] = (u*np.sqrt(1+u**2)+np.arcsinh(u))/(4*c2)-dp0
+        else:
+            ## Numerical integration, done separately for each source
+            dp = np.zeros((N, M))
+            for i in range(N):
+                dp[i,:] = self.evaluate_dp(xx[i,:], dydx[i,:])
+        
+        ## Wavelengths
+        lam = dp*0.
+        for i in range(NORDER):
+            lam += dldp[:,i][:,None]*dp**i
+        
+        return dy, lam
+        
     def show_beams(self, beams=['E','D','C','B','A']):
         """
         Make a demo plot of the beams of a given configuration file
@@ -7,6 +7,7 @@ from astropy.table import Column
 import astropy.units as u
 import astropy.wcs as pywcs
 import copy
+import json
 import logging
 import matplotlib.gridspec
 import matplotlib.pyplot as plt
@@ -17,10 +18,17 @@ import scipy.ndimage as nd
 import scipy.sparse
 import sklearn
 import stwcs
+import threading
 
 from astropy.coordinates import Angle
 from astropy.table import Table
 from collections import OrderedDict
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
 from drizzlepac import astrodrizzle
 
 ### Helper functions from a document written by Pirzkal, Brammer & Ryan 
@@ -87,6 +95,111 @@ if False:
         obs = S.Observation(spec, bp)
         photflam_list[filter] = n/obs.countrate()
 
+class TraceCache(object):
+    def __init__(self, max_bytes=256*1024**2, quantize=None):
+        """LRU cache of the trace products computed by `GrismDisperser`
+        
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum size of the cached arrays, in bytes.  The least recently
+            used entries are removed when the limit is exceeded.
+        
+        quantize : float or None
+            If specified, round the detector positions where the trace is 
+            evaluated to multiples of `quantize` pixels, so that nearby 
+            positions share cached traces.  If None, the traces are 
+            evaluated at the exact positions.
+        
+        Attributes
+        ----------
+        hits, misses : int
+            Counters of the lookups in the cache.
+            
+        nbytes : int
+            Current size of the cached arrays.
+        
+        The cache can be shared by threads, e.g., with 
+        `~grizli.fitting.GroupFitter.xfit_redshift(executor='thread')`, 
+        and access is serialized with a lock.
+        """
+        self.max_bytes = max_bytes
+        self.quantize = quantize
+        self.lock = threading.Lock()
+        self.clear()
+        
+    def clear(self):
+        """Empty the cache and reset the counters
+        """
+        with self.lock:
+            self.data = OrderedDict()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+    
+    def quantize_position(self, x, y):
+        """Round detector coordinates to the `quantize` grid
+        """
+        if self.quantize is None:
+            return x, y
+        
+        q = self.quantize
+        return np.round(x/q)*q, np.round(y/q)*q
+        
+    def get(self, key):
+        """Get copies of cached arrays, or None if `key` not in the cache
+        """
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return None
+        
+            self.hits += 1
+        
+            # Move to the end of the LRU queue
+            value = self.data.pop(key)
+            self.data[key] = value
+        
+        # Cached arrays aren't modified in place, so copy outside the lock
+        return OrderedDict([(k, value[k].copy()) for k in value])
+    
+    def put(self, key, value):
+        """Add a dictionary of arrays to the cache
+        """
+        value = OrderedDict([(k, value[k].copy()) for k in value])
+        nbytes = int(np.sum([value[k].nbytes for k in value]))
+        if nbytes > self.max_bytes:
+            return
+        
+        with self.lock:
+            if key in self.data:
+                return
+            
+            self.data[key] = value
+            self.nbytes += nbytes
+        
+            while self.nbytes > self.max_bytes:
+                k, v = self.data.popitem(last=False)
+                self.nbytes -= int(np.sum([v[ki].nbytes for ki in v]))
+    
+    def stats(self):
+        """Summary of the cache usage
+        """
+        with self.lock:
+            return OrderedDict([('entries', len(self.data)), 
+                                ('nbytes', self.nbytes),
+                                ('max_bytes', self.max_bytes),
+                                ('hits', self.hits), 
+                                ('misses', self.misses)])
+        
+### Trace products shared by all `GrismDisperser` objects.  Set to None to 
+### disable caching.
+TRACE_CACHE = TraceCache()
+
+### Serializes building the operators cached on the beam objects, which can 
+### be shared by threads, e.g., `GrismDisperser.init_log_resampling`
+CACHE_LOCK = threading.RLock()
+
 class GrismDisperser(object):
     def __init__(self, id=0, direct=None, 
                        segmentation=None, origin=[500, 500], 
@@ -194,6 +307,9 @@ class GrismDisperser(object):
         self.fwcpos = fwcpos
         self.scale = scale
         
+        ### Threads for the dispersion kernel, see `compute_model`
+        self.num_threads = 1
+        
         ### Direct image
         if direct is None:
             direct = np.zeros((20,20), dtype=np.float32)
@@ -226,6 +342,10 @@ class GrismDisperser(object):
         
         self.beam = beam
         
+        ### Optional sparse dispersion operator, see `init_model_matrix`
+        self.model_matrix = None
+        self.model_matrix_id = None
+        
         ## Config file    
         if isinstance(conf, list):
             conf_f = grismconf.get_config_filename(conf[0], conf[1], conf[2])
@@ -261,34 +381,76 @@ class GrismDisperser(object):
         #xoff = -2.5 # test
         
         self.xoff = xoff
-        self.ytrace_beam, self.lam_beam = self.conf.get_beam_trace(
-                            x=(self.xc+self.xcenter-self.pad)/self.grow,
-                            y=(self.yc+self.ycenter-self.pad)/self.grow,
-                            dx=(self.dx+self.xcenter*0+self.xoff)/self.grow,
-                            beam=self.beam, fwcpos=self.fwcpos)
         
-        self.ytrace_beam *= self.grow
-        
-        ### Integer trace
-        # Add/subtract 20 for handling int of small negative numbers    
-        dyc = np.cast[int](self.ytrace_beam+20)-20+1 
+        ### Cached trace products 
+        x, y = self.get_trace_position()
+        if TRACE_CACHE is not None:
+            ### The compiled version changes if the trace parameters or the 
+            ### sensitivity curve of the beam are replaced
+            version = self.conf.get_compiled_beam(self.beam)['version']
+            cache_key = (self.conf.conf_file, version, self.beam, x, y, 
+                         self.xcenter, self.xoff, self.dx[0], len(self.dx),
+                         self.conf.xoff, self.conf.yoff, 
+                         self.grow, self.fwcpos, tuple(self.sh))
+            cached = TRACE_CACHE.get(cache_key)
+        else:
+            cached = None
         
-        ### Account for pixel centering of the trace
-        self.yfrac_beam = self.ytrace_beam - np.floor(self.ytrace_beam)
+        ### x offsets of the trace across the 2D cutout
+        self.x0 = np.array(self.sh) // 2
+        self.dxfull = np.arange(self.sh[1]+len(self.dx), dtype=int) 
+        self.dxfull += self.dx[0]-self.x0[1]
         
-        ### Interpolate the sensitivity curve on the wavelength grid. 
-        ysens = self.lam_beam*0
-        so = np.argsort(self.lam_beam)
-        ysens[so] = interp.interp_conserve_c(self.lam_beam[so],
+        if cached is None:
+            ### Evaluate the trace at the beam pixels and across the full 
+            ### cutout with a single call.  The numerical integration of 
+            ### higher-order traces depends on the `dx` grid, so evaluate 
+            ### those separately.
+            dx_beam = (self.dx+self.xcenter*0+self.xoff)/self.grow
+            dx_full = (self.dxfull+self.xcenter+xoff)/self.grow
+            if self.conf.orders[self.beam] <= 2:
+                dy, lam = self.conf.get_beam_traces(x=[x], y=[y],
+                                       dx=np.append(dx_beam, dx_full),
+                                       beam=self.beam, fwcpos=self.fwcpos)
+            
+                NB = len(dx_beam)
+                self.ytrace_beam, self.lam_beam = dy[0,:NB], lam[0,:NB]
+                self.ytrace, self.lam = dy[0,NB:], lam[0,NB:]
+            else:
+                self.ytrace_beam, self.lam_beam = self.conf.get_beam_trace(
+                                       x=x, y=y, dx=dx_beam, beam=self.beam,
+                                       fwcpos=self.fwcpos)
+                                       
+                self.ytrace, self.lam = self.conf.get_beam_trace(x=x, y=y,
+                                       dx=dx_full, beam=self.beam, 
+                                       fwcpos=self.fwcpos)
+            
+            self.ytrace_beam *= self.grow
+        
+            ### Account for pixel centering of the trace
+            self.yfrac_beam = self.ytrace_beam - np.floor(self.ytrace_beam)
+        
+            ### Interpolate the sensitivity curve on the wavelength grid. 
+            ysens = self.lam_beam*0
+            so = np.argsort(self.lam_beam)
+            ysens[so] = interp.interp_conserve_c(self.lam_beam[so],
                                  self.conf.sens[self.beam]['WAVELENGTH'], 
                                  self.conf.sens[self.beam]['SENSITIVITY'])
-        self.lam_sort = so
+            self.lam_sort = so
         
-        ### Needs term of delta wavelength per pixel for flux densities
-        dl = np.abs(np.append(self.lam_beam[1] - self.lam_beam[0],
-                              np.diff(self.lam_beam)))
-        ysens *= dl#*1.e-17
-        self.sensitivity_beam = ysens
+            ### Needs term of delta wavelength per pixel for flux densities
+            dl = np.abs(np.append(self.lam_beam[1] - self.lam_beam[0],
+                                  np.diff(self.lam_beam)))
+            ysens *= dl#*1.e-17
+            self.sensitivity_beam = ysens
+        else:
+            for k in ['ytrace_beam', 'lam_beam', 'yfrac_beam', 'lam_sort',
+                      'sensitivity_beam']:
+                setattr(self, k, cached[k])
+        
+        ### Integer trace
+        # Add/subtract 20 for handling int of small negative numbers    
+        dyc = np.cast[int](self.ytrace_beam+20)-20+1 
         
         ### Initialize the model arrays
         self.NX = len(self.dx)
@@ -299,7 +461,6 @@ class GrismDisperser(object):
         self.idx = np.arange(self.modelf.size).reshape(self.sh_beam)
         
         ## Indices of the trace in the flattened array 
-        self.x0 = np.array(self.sh) // 2
         self.dxpix = self.dx - self.dx[0] + self.x0[1] #+ 1
         try:
             self.flat_index = self.idx[dyc + self.x0[0], self.dxpix]
@@ -308,30 +469,31 @@ class GrismDisperser(object):
             raise IndexError
             
         ###### Trace, wavelength, sensitivity across entire 2D array
-        self.dxfull = np.arange(self.sh_beam[1], dtype=int) 
-        self.dxfull += self.dx[0]-self.x0[1]
-        
         # self.ytrace, self.lam = self.conf.get_beam_trace(x=self.xc,
         #                  y=self.yc, dx=self.dxfull, beam=self.beam)
         
-        self.ytrace, self.lam = self.conf.get_beam_trace(
-                                x=(self.xc+self.xcenter-self.pad)/self.grow,
-                                y=(self.yc+self.ycenter-self.pad)/self.grow,
-                                dx=(self.dxfull+self.xcenter+xoff)/self.grow,
-                                beam=self.beam, fwcpos=self.fwcpos)
-        
-        self.ytrace *= self.grow
+        if cached is None:
+            self.ytrace *= self.grow
         
-        ysens = self.lam*0
-        so = np.argsort(self.lam)
-        ysens[so] = interp.interp_conserve_c(self.lam[so],
+            ysens = self.lam*0
+            so = np.argsort(self.lam)
+            ysens[so] = interp.interp_conserve_c(self.lam[so],
                                  self.conf.sens[self.beam]['WAVELENGTH'], 
                                  self.conf.sens[self.beam]['SENSITIVITY'])
         
-        dl = np.abs(np.append(self.lam[1] - self.lam[0],
-                              np.diff(self.lam)))
-        ysens *= dl#*1.e-17
-        self.sensitivity = ysens
+            dl = np.abs(np.append(self.lam[1] - self.lam[0],
+                                  np.diff(self.lam)))
+            ysens *= dl#*1.e-17
+            self.sensitivity = ysens
+            
+            if TRACE_CACHE is not None:
+                keys = ['ytrace_beam', 'lam_beam', 'yfrac_beam', 'lam_sort',
+                        'sensitivity_beam', 'ytrace', 'lam', 'sensitivity']
+                TRACE_CACHE.put(cache_key, OrderedDict([(k, getattr(self, k))
+                                                        for k in keys]))
+        else:
+            for k in ['ytrace', 'lam', 'sensitivity']:
+                setattr(self, k, cached[k])
         
         # Slices of the parent array based on the origin parameter
         self.slx_parent = slice(self.origin[1] + self.dxfull[0] + self.x0[1],
@@ -339,8 +501,28 @@ class GrismDisperser(object):
         
         self.sly_parent = slice(self.origin[0], self.origin[0] + self.sh[0])
         
+        ### Trace changed, so need to recompute the dispersion operator
+        self.reset_model_matrix()
+        
         #print 'XXX wavelength: %s %s %s' %(self.lam[-5:], self.lam_beam[-5:], dl[-5:])
             
+    def get_trace_position(self):
+        """Detector position where the trace is evaluated
+        
+        Returns
+        -------
+        x, y : float
+            Detector coordinates, rounded to the grid of 
+            `TRACE_CACHE.quantize` if specified.
+        """
+        x = (self.xc+self.xcenter-self.pad)/self.grow
+        y = (self.yc+self.ycenter-self.pad)/self.grow
+        
+        if TRACE_CACHE is not None:
+            x, y = TRACE_CACHE.quantize_position(x, y)
+        
+        return x, y
+        
     def add_ytrace_offset(self, yoffset):
         """Add an offset in Y to the spectral trace
         
@@ -351,15 +533,15 @@ class GrismDisperser(object):
             
         """
         
-        self.ytrace_beam, self.lam_beam = self.conf.get_beam_trace(
-                                x=(self.xc+self.xcenter-self.pad)/self.grow,
-                                y=(self.yc+self.ycenter-self.pad)/self.grow,
+        x, y = self.get_trace_position()
+        self.ytrace_beam, self.lam_beam = self.conf.get_beam_trace(x=x, y=y,
                             dx=(self.dx+self.xcenter*0+self.xoff)/self.grow,
                                 beam=self.beam, fwcpos=self.fwcpos)
         
         self.ytrace_beam *= self.grow
         
         self.ytrace_beam += yoffset
+        self.yoffset = yoffset
         
         ### Integer trace
         # Add/subtract 20 for handling int of small negative numbers    
@@ -375,17 +557,19 @@ class GrismDisperser(object):
             raise IndexError
             
         ###### Trace, wavelength, sensitivity across entire 2D array
-        self.ytrace, self.lam = self.conf.get_beam_trace(
-                                x=(self.xc+self.xcenter-self.pad)/self.grow,
-                                y=(self.yc+self.ycenter-self.pad)/self.grow,
+        self.ytrace, self.lam = self.conf.get_beam_trace(x=x, y=y,
                             dx=(self.dxfull+self.xcenter+self.xoff)/self.grow,
                                 beam=self.beam, fwcpos=self.fwcpos)
         
         self.ytrace *= self.grow
         self.ytrace += yoffset
+        
+        if getattr(self, 'model_matrix', None) is not None:
+            self.init_model_matrix(id=self.model_matrix_id)
                 
     def compute_model(self, id=None, thumb=None, spectrum_1d=None,
-                      in_place=True, outdata=None, scale=None, is_cgs=False):
+                      in_place=True, outdata=None, scale=None, is_cgs=False,
+                      num_threads=None):
         """Compute a model 2D grism spectrum
 
         Parameters
@@ -414,6 +598,11 @@ class GrismDisperser(object):
         
         is_cgs : bool
             Units of `spectrum_1d` fluxes are f_lambda cgs.
+        
+        num_threads : int or None
+            Number of OpenMP threads for the dispersion kernel, 
+            `~grizli.utils_c.disperse.disperse_grism_object_parallel`.  If 
+            None, use `self.num_threads`.  If <= 0, use all available cores.
             
         Returns
         -------
@@ -468,8 +657,34 @@ Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})
                 """.format(self.sh[0], self.sh[1]))
                 return False
 
-        ### Now compute the dispersed spectrum using the C helper
-        status = disperse.disperse_grism_object(thumb, self.seg, id,
+        ### Use the precomputed sparse operator if it's available and
+        ### consistent with the requested thumbnail / id
+        model_matrix = getattr(self, 'model_matrix', None)
+        use_matrix = ((model_matrix is not None) &
+                      (thumb is self.direct) &
+                      (id == self.model_matrix_id))
+        
+        if num_threads is None:
+            num_threads = getattr(self, 'num_threads', 1)
+        
+        # Parallel kernel not available in old compiled versions of the 
+        # C extension
+        if not hasattr(disperse, 'disperse_grism_object_parallel'):
+            num_threads = 1
+            
+        if use_matrix:
+            scale_vec = np.ones(self.NX)*scale_spec
+            outdata += model_matrix.dot(scale_vec)
+        elif num_threads != 1:
+            status = disperse.disperse_grism_object_parallel(thumb, self.seg,
+                                 id, self.flat_index, self.yfrac_beam,
+                                 self.sensitivity_beam*scale_spec,
+                                 outdata, self.x0, np.array(self.sh),
+                                 self.x0, np.array(self.sh_beam),
+                                 num_threads=num_threads)
+        else:
+            ### Now compute the dispersed spectrum using the C helper
+            status = disperse.disperse_grism_object(thumb, self.seg, id,
                                  self.flat_index, self.yfrac_beam,
                                  self.sensitivity_beam*scale_spec,
                                  outdata, self.x0, np.array(self.sh),
@@ -479,7 +694,297 @@ Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})
             return outdata
         else:
             return True
+
+    def interpolate_spectra(self, spectra, scale=None, is_cgs=False):
+        """Interpolate a list of 1D spectra to the `lam_beam` grid
+        
+        Parameters
+        ----------
+        spectra : list of [`~numpy.array`, `~numpy.array`]
+            List of 1D [wave, flux] spectra.
+        
+        scale : float or None
+            Multiplicative factor to apply to the spectra.  If None, use 
+            `self.scale`.
+            
+        is_cgs : bool
+            Units of the `spectra` fluxes are f_lambda cgs.
+        
+        Returns
+        -------
+        scale_spec : `~numpy.ndarray`
+            Interpolated spectra, shape (len(`spectra`), `self.NX`).  Same 
+            as ``scale_spec`` in `compute_model`.
+        """
+        if scale is None:
+            scale = self.scale
+        
+        int_func = interp.interp_conserve_c
+        lam_sort = self.lam_beam[self.lam_sort]
+        
+        scale_spec = np.zeros((len(spectra), self.NX))
+        for i, spectrum_1d in enumerate(spectra):
+            xspec, yspec = spectrum_1d
+            scale_spec[i,self.lam_sort] = int_func(lam_sort, xspec, yspec)*scale
+        
+        if is_cgs:
+            scale_spec /= self.total_flux
+        
+        return scale_spec
+        
+    def init_log_resampling(self, wave):
+        """Precompute the resampling from a log-wavelength grid to `lam_beam`
+        
+        See `~grizli.utils.log_resampling_matrix`.  The result is stored in 
+        the `log_resampling` attribute as `(key, i0, i1, matrix)`, where the 
+        matrix rows follow the order of `lam_beam`.
+        
+        Parameters
+        ----------
+        wave : array-like
+            Template wavelength grid, e.g., `~grizli.utils.TemplateBank.wave`.
+            
+        """
+        key = (len(wave), wave[0], wave[-1])
+        cached = getattr(self, 'log_resampling', None)
+        if cached is not None:
+            if cached[0] == key:
+                return cached
+        
+        with CACHE_LOCK:
+            # Another thread may have built it in the meantime
+            cached = getattr(self, 'log_resampling', None)
+            if cached is not None:
+                if cached[0] == key:
+                    return cached
+                
+            lam_sort = self.lam_beam[self.lam_sort]
+            i0, i1, matrix = utils.log_resampling_matrix(wave, lam_sort)
+        
+            # Unsorted lam_beam rows
+            matrix = matrix[np.argsort(self.lam_sort),:]
+        
+            cached = (key, i0, i1, matrix)
+            self.log_resampling = cached
+            
+        return cached
     
+    def interpolate_log_spectra(self, flux_arr, wave, z=0, scale=None,
+                                is_cgs=False, igm=None):
+        """Redshift and interpolate log-wavelength templates to `lam_beam`
+        
+        The redshift is applied as a shift of the template arrays 
+        (`~grizli.utils.log_shift_spectra`) and the interpolation to 
+        `lam_beam` with the precomputed operator from `init_log_resampling`,
+        which approximates `interpolate_spectra` with the 1D spectra
+        
+            >>> spectra = [[wave*(1+z), flux_arr[i,:]/(1+z)] 
+                           for i in range(NTEMP)]
+        
+        Parameters
+        ----------
+        flux_arr : array-like, dimensions `(NTEMP, NL)`
+            Rest-frame template fluxes.
+        
+        wave : array-like, dimensions `(NL,)`
+            Log-wavelength grid of the templates.
+        
+        z : float
+            Redshift.
+            
+        scale, is_cgs : 
+            See `interpolate_spectra`.
+        
+        igm : None or `~eazy.igm.Inoue14`
+            If specified, multiply the redshifted templates by the IGM 
+            transmission `igm.full_IGM(z, wave)`.
+            
+        Returns
+        -------
+        scale_spec : `~numpy.ndarray`
+            Interpolated spectra, shape (NTEMP, `self.NX`).
+        """
+        if scale is None:
+            scale = self.scale
+        
+        key, i0, i1, matrix = self.init_log_resampling(wave)
+        
+        flux_z = utils.log_shift_spectra(flux_arr, wave, z=z, i0=i0, i1=i1)
+        if igm is not None:
+            flux_z *= igm.full_IGM(z, wave[i0:i1])
+            
+        scale_spec = matrix.dot(flux_z.T).T*scale
+        
+        if is_cgs:
+            scale_spec /= self.total_flux
+        
+        return scale_spec
+        
+    def compute_model_multi(self, spectra, id=None, thumb=None, scale=None,
+                            is_cgs=False, scale_spec=None):
+        """Compute 2D models for a list of 1D spectra in a single pass
+        
+        Uses the sparse dispersion operator if it has been initialized with 
+        `init_model_matrix` or otherwise the batched kernel 
+        `~grizli.utils_c.disperse.disperse_grism_object_multi`.
+        
+        Parameters
+        ----------
+        spectra : list of [`~numpy.array`, `~numpy.array`]
+            List of 1D [wave, flux] spectra.
+        
+        id, thumb, scale, is_cgs : 
+            See `compute_model`.  Unlike `compute_model`, the `id` and 
+            `scale` attributes aren't updated.
+        
+        scale_spec : None or `~numpy.ndarray`
+            Spectra already interpolated to `lam_beam`, e.g., from 
+            `interpolate_log_spectra`, in which case `spectra`, `scale` and 
+            `is_cgs` are ignored.
+        
+        Returns
+        -------
+        models : `~numpy.ndarray`
+            Flattened 2D models, shape (len(`spectra`), `self.modelf.size`).
+        """
+        if id is None:
+            id = self.id
+        
+        if thumb is None:
+            thumb = self.direct
+        else:
+            if thumb.shape != self.sh:
+                logging.info("""
+Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})      
+                """.format(self.sh[0], self.sh[1]))
+                return False
+            
+        if scale_spec is None:
+            scale_spec = self.interpolate_spectra(spectra, scale=scale, 
+                                                  is_cgs=is_cgs)
+        
+        NSPEC = len(scale_spec)
+        model_matrix = getattr(self, 'model_matrix', None)
+        use_matrix = ((model_matrix is not None) &
+                      (thumb is self.direct) &
+                      (id == self.model_matrix_id))
+        
+        if use_matrix:
+            return model_matrix.dot(scale_spec.T).T
+        
+        models = np.zeros((NSPEC, self.modelf.size))
+        
+        # Batched kernel not available in old compiled versions of the 
+        # C extension
+        if not hasattr(disperse, 'disperse_grism_object_multi'):
+            for i in range(NSPEC):
+                disperse.disperse_grism_object(thumb, self.seg, id,
+                                 self.flat_index, self.yfrac_beam,
+                                 self.sensitivity_beam*scale_spec[i,:],
+                                 models[i,:], self.x0, np.array(self.sh),
+                                 self.x0, np.array(self.sh_beam))
+            
+            return models
+            
+        status = disperse.disperse_grism_object_multi(thumb, self.seg, id,
+                                 self.flat_index, self.yfrac_beam,
+                                 self.sensitivity_beam*scale_spec,
+                                 models, self.x0, np.array(self.sh),
+                                 self.x0, np.array(self.sh_beam))
+        
+        return models
+        
+    def compute_model_matrix(self, id=None, thumb=None):
+        """Sparse operator that maps a spectrum to the dispersed 2D model
+
+        The matrix reproduces the pixel-by-pixel accumulation of
+        `~grizli.utils_c.disperse.disperse_grism_object`, including the
+        sensitivity curve, so that
+
+            >>> modelf = matrix.dot(scale_spec)
+
+        where ``scale_spec`` is the 1D spectrum evaluated at `lam_beam`.
+
+        Parameters
+        ----------
+        id : int or None
+            Segmentation ID.  If `None`, use `self.id`.
+
+        thumb : `~numpy.ndarray` with shape = `self.sh` or None
+            Optional direct image.  If `None` then use `self.direct`.
+
+        Returns
+        -------
+        matrix : `~scipy.sparse.csr_matrix`
+            Matrix with shape (`self.modelf.size`, `self.NX`).
+
+        """
+        if id is None:
+            id = self.id
+
+        if thumb is None:
+            thumb = self.direct
+
+        nl = self.modelf.size
+        shg = self.sh_beam
+
+        ### Pixels of the thumbnail that contribute to the model, same
+        ### limits as in the C helper
+        yp, xp = np.indices((2*self.x0[0], 2*self.x0[1]))
+        yp, xp = yp.flatten(), xp.flatten()
+        ok = (yp < self.sh[0]) & (xp < self.sh[1])
+        yp, xp = yp[ok], xp[ok]
+
+        fl = np.cast[np.float64](thumb[yp, xp])
+        ok = (fl != 0) & (self.seg[yp, xp] == id)
+        yp, xp, fl = yp[ok], xp[ok], fl[ok]
+
+        offset = (yp-self.x0[0])*shg[1] + (xp-self.x0[1])
+
+        ### Two rows per trace pixel weighted by the sub-pixel centering
+        k1 = self.flat_index[None,:] + offset[:,None]
+        k2 = k1 - shg[1]
+
+        cols = np.arange(self.NX)[None,:] + 0*k1
+        wht = fl[:,None]*self.sensitivity_beam[None,:]
+        w1 = wht*self.yfrac_beam[None,:]
+        w2 = wht*(1-self.yfrac_beam[None,:])
+
+        rows = np.hstack((k1.flatten(), k2.flatten()))
+        cols = np.hstack((cols.flatten(), cols.flatten()))
+        data = np.hstack((w1.flatten(), w2.flatten()))
+
+        ok = (rows >= 0) & (rows < nl)
+
+        matrix = scipy.sparse.coo_matrix((data[ok], (rows[ok], cols[ok])),
+                                         shape=(nl, self.NX))
+
+        return matrix.tocsr()
+
+    def init_model_matrix(self, id=None):
+        """Precompute the sparse dispersion operator for `compute_model`
+
+        Once initialized, `compute_model` for the default direct thumbnail
+        and segmentation `id` is computed as a sparse matrix product.
+
+        Parameters
+        ----------
+        id : int or None
+            Segmentation ID.  If `None`, use `self.id`.
+
+        """
+        if id is None:
+            id = self.id
+
+        self.model_matrix = self.compute_model_matrix(id=id)
+        self.model_matrix_id = id
+
+    def reset_model_matrix(self):
+        """Discard the precomputed sparse dispersion operator
+        """
+        self.model_matrix = None
+        self.model_matrix_id = None
+
     def init_optimal_profile(self):
         """Initilize optimal extraction profile
         """
@@ -1637,6 +2142,191 @@ class ImageData(object):
         else:
             return self.data[ext]/self.photflam
             
+class CompactDisperser(object):
+    __slots__ = ('id', 'beam', 'direct', 'seg', 'origin', 'pad', 'grow', 
+                 'xcenter', 'ycenter', 'fwcpos', 'scale', 'conf', 'model', 
+                 'spectrum_1d', 'is_cgs')
+    
+    def __init__(self, disperser):
+        """Compact representation of a `GrismDisperser` object
+        
+        Only the inputs needed to regenerate the disperser are kept: copies
+        of the direct and segmentation thumbnails, the 2D model and a 
+        reference to the shared configuration object.  The model is kept in
+        double precision so that it can be subtracted exactly from the full
+        model when the object is updated.  The trace arrays and the dense 
+        `idx` index array are not stored.
+        
+        Parameters
+        ----------
+        disperser : `GrismDisperser`
+            Disperser object to compress.
+        """
+        self.id = disperser.id
+        self.beam = disperser.beam
+        self.direct = np.array(disperser.direct, dtype=np.float32)
+        self.seg = np.array(disperser.seg, dtype=np.float32)
+        self.origin = disperser.origin
+        self.pad = disperser.pad
+        self.grow = disperser.grow
+        self.xcenter = disperser.xcenter
+        self.ycenter = disperser.ycenter
+        self.fwcpos = disperser.fwcpos
+        self.scale = disperser.scale
+        self.conf = disperser.conf
+        self.model = np.array(disperser.model, dtype=np.float64)
+        self.spectrum_1d = disperser.spectrum_1d
+        self.is_cgs = getattr(disperser, 'is_cgs', False)
+    
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__])
+    
+    def __setstate__(self, state):
+        for k in self.__slots__:
+            setattr(self, k, state[k])
+            
+    @property
+    def nbytes(self):
+        """Memory used by the arrays"""
+        nbytes = self.direct.nbytes + self.seg.nbytes + self.model.nbytes
+        if self.spectrum_1d is not None:
+            nbytes += int(np.sum([np.asarray(a).nbytes 
+                                  for a in self.spectrum_1d]))
+        
+        return nbytes
+        
+    def restore(self):
+        """Regenerate the full `GrismDisperser` object
+        
+        Returns
+        -------
+        disperser : `GrismDisperser`
+            Disperser with the model set from the stored model, without 
+            recomputing it.
+        """
+        disperser = GrismDisperser(id=self.id, direct=self.direct, 
+                                   segmentation=self.seg, origin=self.origin,
+                                   xcenter=self.xcenter, ycenter=self.ycenter,
+                                   pad=self.pad, grow=self.grow, 
+                                   beam=self.beam, conf=self.conf, 
+                                   scale=self.scale, fwcpos=self.fwcpos)
+        
+        disperser.modelf[:] = self.model.flatten()
+        disperser.spectrum_1d = self.spectrum_1d
+        disperser.is_cgs = self.is_cgs
+        return disperser
+
+class DisperserStore(MutableMapping):
+    def __init__(self, max_bytes=512*1024**2):
+        """Memory-limited container for `GrismFLT.object_dispersers`
+        
+        Dictionaries of `GrismDisperser` beams are stored as 
+        `CompactDisperser` objects and regenerated when accessed.  When the
+        size of the stored arrays exceeds `max_bytes`, the least recently 
+        used entries are replaced by the `(is_cgs, spectrum_1d)` tuples 
+        stored by `GrismFLT.compute_model_orders` with `store=False`, so 
+        that the beams are recomputed if they are needed again.
+        
+        Parameters
+        ----------
+        max_bytes : int or None
+            Maximum size of the stored arrays, in bytes.  No limit if None.
+        
+        Attributes
+        ----------
+        nbytes : int
+            Current size of the stored arrays.
+            
+        evictions, rebuilds : int
+            Counters of the entries evicted from the store and of the 
+            `GrismDisperser` objects regenerated from compact entries.
+        """
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.evictions = 0
+        self.rebuilds = 0
+    
+    @staticmethod
+    def compress(beams):
+        """Convert a dictionary of `GrismDisperser` objects to compact form
+        """
+        return OrderedDict([(b, CompactDisperser(beams[b])) for b in beams])
+        
+    def __setitem__(self, id, value):
+        if id in self.data:
+            del self[id]
+        
+        if isinstance(value, OrderedDict):
+            value = self.compress(value)
+            nbytes = int(np.sum([value[b].nbytes for b in value]))
+        else:
+            nbytes = 0
+            
+        self.data[id] = value
+        self.sizes[id] = nbytes
+        self.nbytes += nbytes
+        
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+    
+    def __getitem__(self, id):
+        value = self.data[id]
+        if not isinstance(value, OrderedDict):
+            return value
+        
+        # Move to the end of the LRU queue
+        self.data.pop(id)
+        self.data[id] = value
+        
+        self.rebuilds += len(value)
+        return OrderedDict([(b, value[b].restore()) for b in value])
+    
+    def __delitem__(self, id):
+        self.data.pop(id)
+        self.nbytes -= self.sizes.pop(id)
+        
+    def __iter__(self):
+        return iter(self.data)
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self, id):
+        return id in self.data
+        
+    def evict(self, max_bytes):
+        """Evict least recently used entries until `nbytes <= max_bytes`
+        """
+        for id in list(self.data.keys()):
+            if self.nbytes <= max_bytes:
+                break
+                
+            value = self.data[id]
+            if not isinstance(value, OrderedDict):
+                continue
+            
+            ### Keep the 1D spectrum used to compute the model
+            b0 = list(value.keys())[0]
+            self.data[id] = value[b0].is_cgs, value[b0].spectrum_1d
+            self.nbytes -= self.sizes[id]
+            self.sizes[id] = 0
+            self.evictions += 1
+    
+    def stats(self):
+        """Summary of the store usage
+        """
+        n_compact = int(np.sum([isinstance(self.data[id], OrderedDict) 
+                                for id in self.data]))
+                                
+        return OrderedDict([('entries', len(self.data)), 
+                            ('compact', n_compact), 
+                            ('nbytes', self.nbytes),
+                            ('max_bytes', self.max_bytes),
+                            ('evictions', self.evictions), 
+                            ('rebuilds', self.rebuilds)])
+        
 class GrismFLT(object):
     """Scripts for modeling of individual grism FLT images"""
     def __init__(self, grism_file='', sci_extn=1, direct_file='',
@@ -1723,7 +2413,7 @@ class GrismFLT(object):
             Model of the grism exposure with the same dimensions as the 
             full detector array.
 
-        object_dispersers : dict
+        object_dispersers : dict or `DisperserStore`
             Container for storing information about what objects have been 
             added to the model of the grism exposure
         
@@ -1826,6 +2516,9 @@ class GrismFLT(object):
         self.conf = grismconf.load_grism_config(self.conf_file)
         
         self.object_dispersers = OrderedDict()
+        
+        ### Index of the segmentation image, see `get_segmentation_index`
+        self.reset_segmentation_index()
                     
         ### Blot reference image
         self.process_ref_file(ref_file, ref_ext=ref_ext, 
@@ -2047,11 +2740,95 @@ class GrismFLT(object):
                                np.diff(d))[0]/np.pi*180)*u.deg)
                         
         self.dispersion_PA = pa.wrap_at(360*u.deg).value
+    
+    def get_segmentation_index(self, ext=None):
+        """Index of the segmentation regions, see `utils.segmentation_index`
+        
+        One index is computed for each extension of the direct image and 
+        stored in `self._seg_index`.  It is recomputed if `self.seg` or the 
+        direct image array is replaced or if the sums of either array 
+        change, e.g., after an in-place edit.  In-place edits that preserve 
+        both sums (e.g., swapping two segmentation IDs) are not detected, so 
+        call `reset_segmentation_index` after those.
+        
+        Parameters
+        ----------
+        ext : str or None
+            Extension of `self.direct.data` used for the flux-weighted 
+            centroids.  If None, use 'REF' if available or 'SCI' otherwise.
+        
+        Returns
+        -------
+        index : dict
+            Segmentation index.
+        """
+        ext = self._segmentation_extension(ext)
+        flam = self.direct.data[ext]
+        
+        ### Sums as bytes so that NaN values compare equal
+        checksum = (self.seg.sum(dtype=np.float64).tobytes(), 
+                    flam.sum(dtype=np.float64).tobytes())
+        
+        if getattr(self, '_seg_index', None) is None:
+            self._seg_index = OrderedDict()
+            
+        if ext in self._seg_index:
+            seg_ref, flam_ref, checksum_ref, index = self._seg_index[ext]
+            if ((seg_ref is self.seg) & (flam_ref is flam) & 
+                (checksum_ref == checksum)):
+                return index
+        
+        index = utils.segmentation_index(self.seg, flam)
+        self._seg_index[ext] = (self.seg, flam, checksum, index)
+        return index
+    
+    def reset_segmentation_index(self):
+        """Clear the stored segmentation indices
+        """
+        self._seg_index = OrderedDict()
+    
+    def _segmentation_extension(self, ext=None):
+        """Direct image extension used for the segmentation index
+        """
+        if ext is not None:
+            return ext
+            
+        if self.direct.data['REF'] is None:
+            return 'SCI'
+        else:
+            return 'REF'
+        
+    def get_segmentation_limits(self, id, ext=None):
+        """Segmentation limits of a single object from the index
+        
+        Parameters
+        ----------
+        id : int
+            Object ID.
+        
+        ext : str or None
+            See `get_segmentation_index`.
+        
+        Returns
+        -------
+        Same output as `~grizli.utils_c.disperse.compute_segmentation_limits`
+        (ymin, ymax, y, xmin, xmax, x, area, flux).
+        """
+        ext = self._segmentation_extension(ext)
+        index = self.get_segmentation_index(ext=ext)
+        if id in index:
+            return index[id]
+        
+        ### Not in the index, e.g., id=0
+        return disperse.compute_segmentation_limits(self.seg, id,
+                                                    self.direct.data[ext],
+                                                    self.direct.sh)
         
     def compute_model_orders(self, id=0, x=None, y=None, size=10, mag=-1,
                       spectrum_1d=None, is_cgs=False,
                       compute_size=False, max_size=None, store=True, 
-                      in_place=True, add=True, get_beams=None, verbose=True):
+                      in_place=True, add=True, get_beams=None, verbose=True,
+                      num_threads=1):
         """Compute dispersed spectrum for a given object id
         
         Parameters
@@ -2101,11 +2878,18 @@ class GrismFLT(object):
             save memory, set to False and then the function just stores the
             input template spectrum (`spectrum_1d`) and the beams will have
             to be recomputed if necessary.
+            
+            See also `set_disperser_store` for storing the beams in a compact
+            form with a memory limit.
                     
         in_place : bool
             If True, add the computed spectral orders into `self.model`.  
             Otherwise, make a clean array with only the orders of the given
             object.
+        
+        num_threads : int
+            Number of OpenMP threads used to compute the dispersed models, 
+            see `~grizli.model.GrismDisperser.compute_model`.
             
         Returns
         -------
@@ -2130,6 +2914,9 @@ class GrismFLT(object):
             object_in_model = False
             beams = None
         
+        ### Beams already stored, which are updated in place
+        beams_stored = isinstance(beams, OrderedDict)
+        
         if self.direct.data['REF'] is None:
             ext = 'SCI'
         else:
@@ -2152,9 +2939,7 @@ class GrismFLT(object):
                 
             if (compute_size) | (x is None) | (y is None) | (size is None):
                 ### Get the array indices of the segmentation region
-                out = disperse.compute_segmentation_limits(self.seg, id,
-                                         self.direct.data[ext],
-                                         self.direct.sh)
+                out = self.get_segmentation_limits(id, ext=ext)
                 
                 ymin, ymax, y, xmin, xmax, x, area, segm_flux = out
                 if (area == 0) | ~np.isfinite(x) | ~np.isfinite(y):
@@ -2239,21 +3024,13 @@ class GrismFLT(object):
                     #old_spectrum_1d = beams
                     old_cgs, old_spectrum_1d = self.object_dispersers[id]
                     b.compute_model(id=id, spectrum_1d=old_spectrum_1d, 
-                                    is_cgs=old_cgs)
+                                    is_cgs=old_cgs, num_threads=num_threads)
                 
                 beams[beam] = b
                 
             if get_beams:
                 return beams
                 
-            if in_place:
-                if store:
-                    ### Save the computed beams 
-                    self.object_dispersers[id] = beams
-                else:
-                    ### Just save the model spectrum (or empty spectrum)
-                    self.object_dispersers[id] = is_cgs, spectrum_1d
-                        
         if in_place:
             ### Update the internal model attribute
             output = self.model
@@ -2271,17 +3048,58 @@ class GrismFLT(object):
                 beam.add_to_full_image(-beam.model, output)
             
             ### Add in new model
-            beam.compute_model(id=id, spectrum_1d=spectrum_1d, is_cgs=is_cgs)
+            beam.compute_model(id=id, spectrum_1d=spectrum_1d, is_cgs=is_cgs,
+                               num_threads=num_threads)
                 
             beam.add_to_full_image(beam.model, output)
         
         if in_place:
+            if not beams_stored:
+                if store:
+                    ### Save the computed beams 
+                    self.object_dispersers[id] = beams
+                else:
+                    ### Just save the model spectrum (or empty spectrum)
+                    self.object_dispersers[id] = is_cgs, spectrum_1d
+            
+            elif isinstance(self.object_dispersers, DisperserStore):
+                ### `DisperserStore` returns copies of the stored beams, so 
+                ### replace them with the updated models
+                self.object_dispersers[id] = beams
+                
             return True
         else:
             return beams, output
     
+    def set_disperser_store(self, max_bytes=512*1024**2):
+        """Keep `object_dispersers` in a memory-limited `DisperserStore`
+        
+        Beams stored with `compute_model_orders(store=True)` are kept in a 
+        compact form and the least recently used are dropped when the total
+        size exceeds `max_bytes`, to be recomputed if necessary.  Entries 
+        already in `object_dispersers` are copied to the new store.
+        
+        Parameters
+        ----------
+        max_bytes : int or None
+            Memory limit, in bytes.  If None, store all beams in compact form
+            without a limit.
+        
+        Returns
+        -------
+        store : `DisperserStore`
+            The new store, also set to `self.object_dispersers`.  
+            `store.stats()` summarizes the memory usage.
+        """
+        store = DisperserStore(max_bytes=max_bytes)
+        for id in self.object_dispersers:
+            store[id] = self.object_dispersers[id]
+        
+        self.object_dispersers = store
+        return store
+        
     def compute_full_model(self, ids=None, mags=None, mag_limit=22,
-                           store=True, verbose=False):
+                           store=True, verbose=False, num_threads=1):
         """Compute flat-spectrum model for multiple objects.
         
         Parameters
@@ -2295,6 +3113,10 @@ class GrismFLT(object):
             magnitudes based on the flux in segmentation regions and 
             zeropoints determined from PHOTFLAM and PHOTPLAM.
         
+        num_threads : int
+            Number of OpenMP threads used for the dispersion kernel.  If 
+            <= 0, use all available cores.
+            
         Returns
         -------
         Updated model stored in `self.model` attribute.
@@ -2310,9 +3132,8 @@ class GrismFLT(object):
             
             mags = np.zeros(len(ids))
             for i, id in enumerate(ids):
-                out = disperse.compute_segmentation_limits(self.seg, id,
-                                self.direct.data[self.direct.thumb_extension],
-                                     self.direct.sh)
+                out = self.get_segmentation_limits(id, 
+                                        ext=self.direct.thumb_extension)
             
                 ymin, ymax, y, xmin, xmax, x, area, segm_flux = out
                 mags[i] = self.direct.ABZP - 2.5*np.log10(segm_flux)
@@ -2334,7 +3155,8 @@ class GrismFLT(object):
                 logging.info(utils.NO_NEWLINE + 'compute model id={0:d}'.format(id_i))
                 
             self.compute_model_orders(id=id_i, compute_size=True, mag=mag_i, 
-                                      in_place=True, store=store)
+                                      in_place=True, store=store,
+                                      num_threads=num_threads)
     
     def smooth_mask(self, gaussian_width=4, threshold=2.5):
         """Compute a mask where smoothed residuals greater than some value
@@ -2359,6 +3181,11 @@ class GrismFLT(object):
         resid = (self.grism['SCI'] - self.model)*mask
         sm = nd.gaussian_filter(np.abs(resid), gaussian_width)
         resid_mask = (np.abs(sm) > threshold*self.grism['ERR'])
+        
+        ### Copy read-only arrays, e.g., from `load_from_npy`
+        if not self.grism.data['SCI'].flags.writeable:
+            self.grism.data['SCI'] = np.array(self.grism.data['SCI'])
+            
         self.grism.data['SCI'][resid_mask] = 0
         
     def blot_catalog(self, input_catalog, columns=['id','ra','dec'], 
@@ -2640,6 +3467,7 @@ class GrismFLT(object):
         
         ## zero out large data objects
         self.direct.data = self.grism.data = self.seg = self.model = None
+        self.reset_segmentation_index()
                                             
         fp = open('{0}.{1:02d}.GrismFLT.pkl'.format(root, self.grism.sci_extn), 'wb')
         pickle.dump(self, fp)
@@ -2710,6 +3538,147 @@ class GrismFLT(object):
                 
         return True
     
+    def save_npy_cache(self, verbose=True):
+        """Save the `GrismFLT` object to a directory of binary arrays
+        
+        The cache directory, `[root].[sci_extn].GrismFLT.npy`, contains
+        
+            - An `.npy` file for each of the data arrays, with names like the
+              extensions written by `save_full_pickle`: 'D[ext]' and 'G[ext]'
+              for the direct and grism extensions, 'SEG' and 'MODEL'.
+            
+            - 'GrismFLT.pkl': pickle of the object without the data arrays.
+            
+            - 'meta.json': extension names, shapes and data types of the 
+              arrays.
+        
+        The arrays can then be read back with memory-mapping, see 
+        `load_from_npy`.  Unlike `save_full_pickle`, the data arrays of 
+        `self` are left in place.
+        
+        Returns
+        -------
+        cache_dir : str
+            Name of the cache directory.
+        """
+        try:
+            import cPickle as pickle
+        except:
+            # Python 3
+            import pickle
+            
+        root = self.grism_file.split('_flt.fits')[0].split('_cmb.fits')[0]
+        root = root.split('_flc.fits')[0].split('_rate.fits')[0]
+        
+        cache_dir = '{0}.{1:02d}.GrismFLT.npy'.format(root, 
+                                                      self.grism.sci_extn)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        
+        meta = OrderedDict()
+        meta['direct'] = list(self.direct.data.keys())
+        meta['grism'] = list(self.grism.data.keys())
+        meta['arrays'] = OrderedDict()
+        
+        arrays = OrderedDict()
+        for key in self.direct.data.keys():
+            arrays['D'+key] = self.direct.data[key]
+        
+        for key in self.grism.data.keys():
+            arrays['G'+key] = self.grism.data[key]
+        
+        arrays['SEG'] = self.seg
+        arrays['MODEL'] = self.model
+        
+        for key in arrays:
+            file = os.path.join(cache_dir, '{0}.npy'.format(key))
+            if arrays[key] is None:
+                meta['arrays'][key] = None
+                if os.path.exists(file):
+                    os.remove(file)
+                
+                continue
+            
+            np.save(file, arrays[key])
+            meta['arrays'][key] = {'shape':list(arrays[key].shape),
+                                   'dtype':arrays[key].dtype.str}
+            
+        fp = open(os.path.join(cache_dir, 'meta.json'), 'w')
+        json.dump(meta, fp, indent=1)
+        fp.close()
+        
+        ## Pickle without the large data objects
+        direct_data, grism_data = self.direct.data, self.grism.data
+        seg, model = self.seg, self.model
+        npy_cache = getattr(self, 'npy_cache', None)
+        
+        self.direct.data = self.grism.data = self.seg = self.model = None
+        self.npy_cache = None
+        self.reset_segmentation_index()
+        
+        try:
+            fp = open(os.path.join(cache_dir, 'GrismFLT.pkl'), 'wb')
+            pickle.dump(self, fp)
+            fp.close()
+        finally:
+            self.direct.data, self.grism.data = direct_data, grism_data
+            self.seg, self.model = seg, model
+            self.npy_cache = npy_cache
+        
+        if verbose:
+            logging.info('Save {0}'.format(cache_dir))
+            
+        return cache_dir
+        
+    def load_from_npy(self, cache_dir, mmap_mode='r'):
+        """Load data arrays saved with `save_npy_cache`
+        
+        Parameters
+        ----------
+        cache_dir : str
+            Cache directory.
+        
+        mmap_mode : str or None
+            Memory-map mode passed to `numpy.load`.  With the default 'r',
+            the data arrays are read-only and only read from disk when 
+            accessed.  The `model` array is always opened copy-on-write 
+            ('c') so that it can be updated in place without changing the 
+            file on disk.  If None, read the arrays into memory.
+        
+        Returns
+        -------
+        True if completed successfully
+        """
+        fp = open(os.path.join(cache_dir, 'meta.json'))
+        meta = json.load(fp)
+        fp.close()
+        
+        def _load(key, mode=mmap_mode):
+            if meta['arrays'][key] is None:
+                return None
+            
+            file = os.path.join(cache_dir, '{0}.npy'.format(key))
+            return np.load(file, mmap_mode=mode)
+        
+        self.direct.data = OrderedDict()
+        for key in meta['direct']:
+            self.direct.data[key] = _load('D'+key)
+        
+        self.grism.data = OrderedDict()
+        for key in meta['grism']:
+            self.grism.data[key] = _load('G'+key)
+        
+        self.seg = _load('SEG')
+        if mmap_mode is None:
+            self.model = _load('MODEL', mode=None)
+        else:
+            self.model = _load('MODEL', mode='c')
+        
+        self.npy_cache = cache_dir
+        self.reset_segmentation_index()
+        
+        return True
+    
     def transform_NIRISS(self, verbose=True):
         """
         Rotate data & wcs so that spectra are increasing to +x
@@ -2815,7 +3784,9 @@ class GrismFLT(object):
         full_mask = nd.convolve(mask*1., kern.reshape((1,-1)),
                                 origin=(0,-kern.size//2+20))
         
-        self.grism.data['ERR'] *= np.exp(full_mask*scale)
+        ### Not in place, arrays can be read-only from `load_from_npy`
+        err = self.grism.data['ERR']*np.exp(full_mask*scale)
+        self.grism.data['ERR'] = err.astype(self.grism.data['ERR'].dtype)
         
         self.has_edge_mask = True
         
@@ -3168,7 +4139,118 @@ class BeamCutout(object):
         """
         result = self.beam.compute_model(*args, **kwargs)
         return result
+
+    def init_model_matrix(self):
+        """Precompute the sparse dispersion operator of `self.beam`
+
+        See `~grizli.model.GrismDisperser.init_model_matrix`.
+        """
+        self.beam.init_model_matrix(id=self.beam.id)
+        self._masked_model_matrix = None
+
+    def get_masked_model_matrix(self):
+        """Rows of the sparse dispersion operator within `fit_mask`
+
+        Returns
+        -------
+        matrix : `~scipy.sparse.csr_matrix` or None
+            Masked operator with shape (`fit_mask.sum()`, `beam.NX`), or
+            None if the operator hasn't been initialized with
+            `init_model_matrix` or if the ePSF model is used.
+        """
+        matrix = getattr(self.beam, 'model_matrix', None)
+        if (matrix is None) | hasattr(self, 'psf_params'):
+            return None
+
+        ### Cached version for the current mask
+        cached = getattr(self, '_masked_model_matrix', None)
+        if cached is not None:
+            mask, parent, masked = cached
+            if (parent is matrix) & np.array_equal(mask, self.fit_mask):
+                return masked
+        
+        with CACHE_LOCK:
+            cached = getattr(self, '_masked_model_matrix', None)
+            if cached is not None:
+                mask, parent, masked = cached
+                if (parent is matrix) & np.array_equal(mask, self.fit_mask):
+                    return masked
+                    
+            masked = matrix[self.fit_mask,:]
+            self._masked_model_matrix = (self.fit_mask.copy(), matrix, masked)
+            
+        return masked
+
+    def compute_masked_models(self, spectra, is_cgs=True):
+        """Masked 2D models for a list of spectra
+        
+        All spectra are computed together with 
+        `~grizli.model.GrismDisperser.compute_model_multi`, using the sparse
+        dispersion operator if it has been initialized.
+        
+        Parameters
+        ----------
+        spectra : list of [`~numpy.array`, `~numpy.array`]
+            List of 1D [wave, flux] spectra.
+        
+        is_cgs : bool
+            Units of the `spectra` fluxes are f_lambda cgs.
+        
+        Returns
+        -------
+        models : `~numpy.ndarray` or None
+            Flattened models with shape (len(`spectra`), `fit_mask.sum()`),
+            or None for the ePSF models that have to be computed with 
+            `compute_model`.
+        """
+        if hasattr(self, 'psf_params'):
+            return None
+            
+        matrix = self.get_masked_model_matrix()
+        if matrix is not None:
+            scale_spec = self.beam.interpolate_spectra(spectra, 
+                                                       is_cgs=is_cgs)
+            return matrix.dot(scale_spec.T).T
+        
+        models = self.beam.compute_model_multi(spectra, is_cgs=is_cgs)
+        return models[:,self.fit_mask]
+    
+    def compute_masked_log_models(self, flux_arr, wave, z=0, is_cgs=True,
+                                  igm=None):
+        """Masked 2D models for log-wavelength templates at redshift `z`
+        
+        Same as `compute_masked_models` but with the templates redshifted
+        and resampled with 
+        `~grizli.model.GrismDisperser.interpolate_log_spectra`.
         
+        Parameters
+        ----------
+        flux_arr, wave, z, igm : 
+            See `~grizli.model.GrismDisperser.interpolate_log_spectra`.
+        
+        is_cgs : bool
+            Units of the template fluxes are f_lambda cgs.
+            
+        Returns
+        -------
+        models : `~numpy.ndarray` or None
+            Flattened models with shape (NTEMP, `fit_mask.sum()`), or None 
+            for the ePSF models.
+        """
+        if hasattr(self, 'psf_params'):
+            return None
+        
+        scale_spec = self.beam.interpolate_log_spectra(flux_arr, wave, z=z, 
+                                                       is_cgs=is_cgs, 
+                                                       igm=igm)
+        
+        matrix = self.get_masked_model_matrix()
+        if matrix is not None:
+            return matrix.dot(scale_spec.T).T
+        
+        models = self.beam.compute_model_multi(None, scale_spec=scale_spec)
+        return models[:,self.fit_mask]
+
     def get_wavelength_wcs(self, wavelength=1.3e4):
         """Compute *celestial* WCS of the 2D spectrum array for a specified central wavelength
         
@@ -16,7 +16,9 @@ import peakutils
 import pysynphot
 import scipy.ndimage as nd
 import scipy.optimize
+import shutil
 import sklearn.linear_model
+import tempfile
 import time      
 
 try:
@@ -25,6 +27,13 @@ except:
     # Python 3
     import pickle
 
+try:
+    from multiprocessing import shared_memory
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    # Python < 3.8, fall back to memory-mapped files
+    HAS_SHARED_MEMORY = False
+
 from astropy import log
 from astropy.modeling import models, fitting
 from astropy.table import Table
@@ -165,10 +174,20 @@ def test():
     m2d = mb.reshape_flat(modelf)
     
 def _loadFLT(grism_file, sci_extn, direct_file, pad, ref_file, 
-               ref_ext, seg_file, verbose, catalog, ix):
+               ref_ext, seg_file, verbose, catalog, ix, use_npy=True,
+               detach_npy=False):
     """Helper function for loading `.model.GrismFLT` objects with `multiprocessing`.
     
-    TBD
+    If a binary cache directory written by 
+    `~grizli.model.GrismFLT.save_npy_cache` is found, the arrays are opened
+    memory-mapped from there.  Otherwise try the FITS / pickle products of 
+    `~grizli.model.GrismFLT.save_full_pickle` or initialize from the 
+    exposure files.
+    
+    If `detach_npy` is set, the memory-mapped arrays are removed from the 
+    output object, which then has to be reattached with 
+    `flt.load_from_npy(flt.npy_cache)`.  This avoids copying the arrays 
+    when the object is returned from a `multiprocessing` worker.
     """
         
     ## slight random delay to avoid synchronization problems
@@ -187,8 +206,19 @@ def _loadFLT(grism_file, sci_extn, direct_file, pad, ref_file,
     
     if (grism_file.find('_') < 0) & ('GrismFLT' not in grism_file):
         save_file = 'xxxxxxxxxxxxxxxxxxx'
+    
+    npy_cache = save_file.replace('GrismFLT.fits', 'GrismFLT.npy')
+    
+    if use_npy & os.path.exists(os.path.join(npy_cache, 'meta.json')):
+        logging.info('Load {0}!'.format(npy_cache))
+        
+        fp = open(os.path.join(npy_cache, 'GrismFLT.pkl'), 'rb')
+        flt = pickle.load(fp)
+        fp.close()
+        
+        status = flt.load_from_npy(npy_cache, mmap_mode='r')
         
-    if os.path.exists(save_file):
+    elif os.path.exists(save_file):
         logging.info('Load {0}!'.format(save_file))
         
         fp = open(save_file.replace('GrismFLT.fits', 'GrismFLT.pkl'), 'rb')
@@ -214,6 +244,10 @@ def _loadFLT(grism_file, sci_extn, direct_file, pad, ref_file,
 
     if flt.grism.instrument in ['NIRISS', 'NIRCAM']:
         flt.transform_NIRISS()
+    
+    elif detach_npy & (getattr(flt, 'npy_cache', None) is not None):
+        flt.direct.data = flt.grism.data = flt.seg = flt.model = None
+        flt.reset_segmentation_index()
         
     return flt #, out_cat
     
@@ -276,12 +310,451 @@ def _compute_model(i, flt, fit_info, is_cgs, store):
         
     return i, flt.model, flt.object_dispersers
     
+def _flt_array_refs(flt):
+    """List the large data arrays of a `~grizli.model.GrismFLT` object
+    
+    Returns
+    -------
+    refs : list
+        List of (`key`, `container`, `attr`) tuples, where the array is
+        found at `container[attr]` for dictionaries or
+        `getattr(container, attr)` otherwise.
+    """
+    refs = []
+    for prefix, base in zip(['D', 'G'], [flt.direct, flt.grism]):
+        if base.data is None:
+            continue
+            
+        for ext in base.data:
+            refs.append((prefix+ext, base.data, ext))
+    
+    refs.append(('SEG', flt, 'seg'))
+    refs.append(('MODEL', flt, 'model'))
+    return refs
+
+def _get_ref(container, attr):
+    if isinstance(container, dict):
+        return container[attr]
+    else:
+        return getattr(container, attr)
+
+def _set_ref(container, attr, value):
+    if isinstance(container, dict):
+        container[attr] = value
+    else:
+        setattr(container, attr, value)
+        
+def _create_shared_array(data, tmpdir=None):
+    """Copy an array into shared memory
+    
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        Input array.
+    
+    tmpdir : str or None
+        If specified, use a `~numpy.memmap` file in this directory rather
+        than `multiprocessing.shared_memory`.
+    
+    Returns
+    -------
+    handle : `~multiprocessing.shared_memory.SharedMemory` or str
+        Shared memory block or memmap filename.
+    
+    spec : tuple
+        Information needed to attach to the array from another process with
+        `_attach_shared_array`.
+        
+    shared : `~numpy.ndarray`
+        Array view of the shared data.
+    """
+    data = np.ascontiguousarray(data)
+    if tmpdir is None:
+        handle = shared_memory.SharedMemory(create=True, 
+                                            size=max(data.nbytes, 1))
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=handle.buf)
+        spec = ('shm', handle.name, data.shape, data.dtype.str)
+    else:
+        fd, handle = tempfile.mkstemp(suffix='.npy', dir=tmpdir)
+        os.close(fd)
+        shared = np.lib.format.open_memmap(handle, mode='w+', 
+                                           dtype=data.dtype, shape=data.shape)
+        spec = ('memmap', handle, data.shape, data.dtype.str)
+    
+    shared[...] = data
+    return handle, spec, shared
+
+def _attach_shared_array(spec):
+    """Attach to an array created by `_create_shared_array`
+    
+    Returns
+    -------
+    handle : `~multiprocessing.shared_memory.SharedMemory` or None
+        Shared memory block, which must be kept referenced as long as the 
+        array is used.
+    
+    shared : `~numpy.ndarray`
+        Array view of the shared data.
+    """
+    kind, name, shape, dtype = spec
+    if kind == 'shm':
+        handle = shared_memory.SharedMemory(name=name)
+        shared = np.ndarray(shape, dtype=np.dtype(dtype), buffer=handle.buf)
+    else:
+        handle = None
+        shared = np.load(name, mmap_mode='r+')
+    
+    return handle, shared
+    
+def _flt_skeleton(flt):
+    """Pickle a `~grizli.model.GrismFLT` object without its data arrays
+    """
+    refs = _flt_array_refs(flt)
+    saved = [_get_ref(container, attr) for key, container, attr in refs]
+    for key, container, attr in refs:
+        _set_ref(container, attr, None)
+    
+    seg_index = getattr(flt, '_seg_index', None)
+    flt.reset_segmentation_index()
+    
+    try:
+        data = pickle.dumps(flt, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for (key, container, attr), arr in zip(refs, saved):
+            _set_ref(container, attr, arr)
+        
+        flt._seg_index = seg_index
+        
+    return data
+    
+def _shared_compute_model_orders(flt, kwargs):
+    """Run `~grizli.model.GrismFLT.compute_model_orders` in a worker
+    """
+    return flt.compute_model_orders(**kwargs)
+
+def _shared_compute_model(flt, fit_info, is_cgs, store):
+    """Run `_compute_model` in a worker, keeping the model in shared memory
+    """
+    _compute_model(0, flt, fit_info, is_cgs, store)
+    return True
+
+def _shared_get_beam(flt, id, size, beam_id, min_overlap, get_slice_header):
+    """Extract a `~grizli.model.BeamCutout` in a worker
+    """
+    beams = flt.compute_model_orders(id=id, verbose=False, size=size,
+                          compute_size=(size < 0), store=False,
+                          get_beams=[beam_id])
+    
+    if not isinstance(beams, OrderedDict):
+        return None
+        
+    try:
+        out_beam = model.BeamCutout(flt=flt, beam=beams[beam_id],
+                                    conf=flt.conf, 
+                                    get_slice_header=get_slice_header)
+    except:
+        logging.info('Except: get_beams. Failed at model.BeamCutout for FLT {}, beam {}.'.format(flt.grism.parent_file, beam_id))
+        return None
+    
+    hasdata = ((out_beam.grism['SCI'] != 0).sum(axis=0) > 0).sum()
+    if hasdata*1./out_beam.model.shape[1] < min_overlap:
+        return None
+    
+    return out_beam
+
+def _shared_get_dispersers(flt):
+    return flt.object_dispersers
+        
+_SHARED_FLT_COMMANDS = {'compute_model_orders':_shared_compute_model_orders,
+                        'compute_model':_shared_compute_model,
+                        'get_beam':_shared_get_beam,
+                        'get_dispersers':_shared_get_dispersers}
+
+def _shared_flt_worker(conn):
+    """Persistent worker process for `SharedFLTPool`
+    
+    Messages received on `conn` are tuples of 
+    
+        >>> (command, indices, args)
+        
+    where `indices` are the exposures owned by the worker to which the 
+    command is applied.  A single reply is sent for each message with a list
+    of the results, or the exception raised by the command.
+    """
+    FLTs = {}
+    handles = []
+    
+    while True:
+        try:
+            cmd, indices, args = conn.recv()
+        except EOFError:
+            break
+            
+        if cmd == 'close':
+            break
+            
+        try:
+            if cmd == 'init':
+                out = []
+                for i, data, specs in zip(indices, *args):
+                    flt = pickle.loads(data)
+                    for key, container, attr in _flt_array_refs(flt):
+                        if specs[key] is None:
+                            continue
+                        
+                        handle, arr = _attach_shared_array(specs[key])
+                        handles.append(handle)
+                        _set_ref(container, attr, arr)
+                        
+                    FLTs[i] = flt
+                    out.append(True)
+            else:
+                func = _SHARED_FLT_COMMANDS[cmd]
+                out = [func(FLTs[i], *args) for i in indices]
+        except Exception as err:
+            out = err
+        
+        conn.send(out)
+    
+    ### Release arrays before detaching from the shared memory
+    FLTs = None
+    for handle in handles:
+        if handle is not None:
+            try:
+                handle.close()
+            except BufferError:
+                pass
+    
+    conn.close()
+    
+class SharedFLTPool(object):
+    def __init__(self, FLTs, cpu_count=0, use_memmap=False, verbose=True):
+        """Persistent worker pool operating on shared `GrismFLT` arrays
+        
+        The large data arrays of each `~grizli.model.GrismFLT` object 
+        (direct and grism extensions, `seg` and `model`) are moved into 
+        `multiprocessing.shared_memory` blocks (or memory-mapped files) and
+        the attributes of the objects in `FLTs` are replaced by views of the
+        shared arrays.  Each exposure is owned by one of the worker processes,
+        which receives a copy of the object without its arrays only once and
+        then updates `model` in place, so only small results are sent back 
+        to the parent process.
+        
+        Parameters
+        ----------
+        FLTs : list
+            List of `~grizli.model.GrismFLT` objects.
+        
+        cpu_count : int
+            Number of worker processes.  If <= 0, use `mp.cpu_count()`.
+            No more than `len(FLTs)` workers are started.
+        
+        use_memmap : bool
+            Use memory-mapped files in a temporary directory rather than
+            `multiprocessing.shared_memory`, which is used by default if 
+            available.
+            
+        verbose : bool
+            Print status messages.
+            
+        Attributes
+        ----------
+        owner : list
+            Index of the worker process that owns each exposure.
+        
+        """
+        self.FLTs = FLTs
+        self.N = len(FLTs)
+        self.verbose = verbose
+        
+        if cpu_count <= 0:
+            cpu_count = mp.cpu_count()
+        
+        self.n_workers = int(np.maximum(np.minimum(cpu_count, self.N), 1))
+        
+        if use_memmap | (not HAS_SHARED_MEMORY):
+            self.tmpdir = tempfile.mkdtemp(prefix='grizli_shared_')
+        else:
+            self.tmpdir = None
+            
+        t0 = time.time()
+        
+        ### Move arrays to shared memory
+        self.handles = []
+        specs = []
+        for flt in self.FLTs:
+            spec = OrderedDict()
+            for key, container, attr in _flt_array_refs(flt):
+                arr = _get_ref(container, attr)
+                if arr is None:
+                    spec[key] = None
+                    continue
+                    
+                handle, spec[key], shared = _create_shared_array(arr, 
+                                                           tmpdir=self.tmpdir)
+                self.handles.append(handle)
+                _set_ref(container, attr, shared)
+            
+            flt.reset_segmentation_index()    
+            specs.append(spec)
+        
+        ### Start workers
+        self.owner = [i % self.n_workers for i in range(self.N)]
+        self.conns = []
+        self.processes = []
+        for w in range(self.n_workers):
+            conn, child_conn = mp.Pipe()
+            proc = mp.Process(target=_shared_flt_worker, args=(child_conn,))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            
+            self.conns.append(conn)
+            self.processes.append(proc)
+        
+        args = [[_flt_skeleton(flt) for flt in self.FLTs], specs]
+        self.run('init', args=args, per_exposure_args=True)
+        
+        if verbose:
+            logging.info('SharedFLTPool: {0} exposures, {1} workers - {2:.2f} sec.'.format(self.N, self.n_workers, time.time()-t0))
+    
+    @property 
+    def active(self):
+        return len(self.conns) > 0
+        
+    def run(self, cmd, args=(), indices=None, per_exposure_args=False):
+        """Run a command on the worker processes
+        
+        Parameters
+        ----------
+        cmd : str
+            Command name, see `_shared_flt_worker`.
+        
+        args : tuple
+            Arguments passed to the command. 
+        
+        indices : list or None
+            Exposure indices to process.  If None, process all exposures.
+        
+        per_exposure_args : bool
+            `args` is a list of lists with an entry for every exposure, 
+            which are distributed to the workers.
+            
+        Returns
+        -------
+        results : list
+            Results of the command for each of the exposures in `indices`.
+        """
+        if not self.active:
+            raise RuntimeError('SharedFLTPool has been closed.')
+            
+        if indices is None:
+            indices = list(range(self.N))
+            
+        ### Send one message per worker before collecting results so that 
+        ### the workers run simultaneously
+        assigned = OrderedDict()
+        for w in range(self.n_workers):
+            assigned[w] = [i for i in indices if self.owner[i] == w]
+            if len(assigned[w]) == 0:
+                continue
+            
+            if per_exposure_args:
+                w_args = [[arg[i] for i in assigned[w]] for arg in args]
+            else:
+                w_args = args
+                    
+            self.conns[w].send((cmd, assigned[w], w_args))
+        
+        results = {}
+        error = None
+        for w in assigned:
+            if len(assigned[w]) == 0:
+                continue
+            
+            out = self.conns[w].recv()
+            if isinstance(out, Exception):
+                error = out
+                continue
+                
+            for i, res in zip(assigned[w], out):
+                results[i] = res
+        
+        if error is not None:
+            raise error
+            
+        return [results[i] for i in indices]
+    
+    def sync_dispersers(self):
+        """Copy `object_dispersers` from the workers to the parent objects
+        """
+        dispersers = self.run('get_dispersers')
+        for flt, disp in zip(self.FLTs, dispersers):
+            flt.object_dispersers = disp
+    
+    def close(self, sync=True):
+        """Stop the workers and copy the shared arrays back to local memory
+        
+        Parameters
+        ----------
+        sync : bool
+            Run `sync_dispersers` before stopping the workers.
+        """
+        if not self.active:
+            return True
+            
+        if sync:
+            self.sync_dispersers()
+            
+        for conn in self.conns:
+            try:
+                conn.send(('close', [], ()))
+            except (BrokenPipeError, OSError):
+                pass
+                
+        for proc in self.processes:
+            proc.join(timeout=10)
+        
+        for conn in self.conns:
+            conn.close()
+            
+        self.conns = []
+        self.processes = []
+        
+        ### Local copies of the arrays
+        for flt in self.FLTs:
+            for key, container, attr in _flt_array_refs(flt):
+                arr = _get_ref(container, attr)
+                if arr is not None:
+                    _set_ref(container, attr, np.array(arr))
+            
+            flt.reset_segmentation_index()
+            
+        for handle in self.handles:
+            if self.tmpdir is None:
+                handle.close()
+                handle.unlink()
+        
+        self.handles = []
+        
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+        
+        return True
+    
+    def __del__(self):
+        try:
+            self.close(sync=False)
+        except:
+            pass
+            
 class GroupFLT():
     def __init__(self, grism_files=[], sci_extn=1, direct_files=[],
                  pad=200, group_name='group', 
                  ref_file=None, ref_ext=0, seg_file=None,
                  shrink_segimage=True, verbose=True, cpu_count=0,
-                 catalog='', polyx=[0.3, 2.35]):
+                 catalog='', polyx=[0.3, 2.35], use_shared_pool=False):
         """Main container for handling multiple grism exposures together
         
         Parameters
@@ -339,6 +812,11 @@ class GroupFLT():
             Catalog filename assocated with `seg_file`.  These are typically
             generated with "SExtractor", but the source of the files 
             themselves isn't critical.
+        
+        use_shared_pool : bool
+            Start a `SharedFLTPool` after reading the files, where the FLT 
+            arrays are kept in shared memory and the model computations are 
+            done by persistent worker processes, see `start_shared_pool`.
             
         Attributes
         ----------
@@ -408,7 +886,7 @@ class GroupFLT():
             t0_pool = time.time()
         
             pool = mp.Pool(processes=cpu_count)
-            results = [pool.apply_async(_loadFLT, (self.grism_files[i], sci_extn, self.direct_files[i], pad, ref_file, ref_ext, seg_file, verbose, self.catalog, i)) for i in range(self.N)]
+            results = [pool.apply_async(_loadFLT, (self.grism_files[i], sci_extn, self.direct_files[i], pad, ref_file, ref_ext, seg_file, verbose, self.catalog, i, True, True)) for i in range(self.N)]
         
             pool.close()
             pool.join()
@@ -422,6 +900,10 @@ class GroupFLT():
                     for obj in [flt_i.grism, flt_i.direct]:
                         obj.get_wcs()
                 
+                ### Memory-mapped arrays detached in the worker
+                if flt_i.grism.data is None:
+                    flt_i.load_from_npy(flt_i.npy_cache, mmap_mode='r')
+                    
                 self.FLTs.append(flt_i)
                 
                 
@@ -429,8 +911,69 @@ class GroupFLT():
         
         if verbose:
             logging.info('Files loaded - {0:.2f} sec.'.format(t1_pool - t0_pool))
+        
+        self.shared_pool = None
+        if use_shared_pool:
+            self.start_shared_pool(cpu_count=cpu_count, verbose=verbose)
+    
+    def start_shared_pool(self, cpu_count=0, use_memmap=False, verbose=True):
+        """Keep the FLT arrays in shared memory and start persistent workers
+        
+        With the pool running, `compute_single_model`, `compute_full_model`
+        and `get_beams` are computed by the worker processes directly on the
+        shared arrays, rather than sending the full `~grizli.model.GrismFLT`
+        objects to and from a new `multiprocessing.Pool` with every call.  
+        `self.FLTs[i].model` is updated in place.  
+        
+        The `object_dispersers` attributes of the FLTs are maintained by the 
+        workers and are copied back with `close_shared_pool`.
+        
+        Parameters
+        ----------
+        cpu_count : int
+            Number of worker processes.  If <= 0, use `mp.cpu_count()`.
+        
+        use_memmap : bool
+            Use memory-mapped files rather than 
+            `multiprocessing.shared_memory`.
+        
+        verbose : bool
+            Print status messages.
+            
+        Returns
+        -------
+        Sets the `shared_pool` attribute, a `SharedFLTPool` object.
+        """
+        self.close_shared_pool()
+        self.shared_pool = SharedFLTPool(self.FLTs, cpu_count=cpu_count,
+                                         use_memmap=use_memmap,
+                                         verbose=verbose)
+        
+    def close_shared_pool(self, sync=True):
+        """Stop the `SharedFLTPool` workers, if running
+        
+        Parameters
+        ----------
+        sync : bool
+            Copy the `object_dispersers` from the workers back to `self.FLTs`.
+        """
+        pool = getattr(self, 'shared_pool', None)
+        if pool is not None:
+            pool.close(sync=sync)
+        
+        self.shared_pool = None
     
-    def save_full_data(self, warn=True):
+    @property
+    def has_shared_pool(self):
+        """A `SharedFLTPool` is running
+        """
+        pool = getattr(self, 'shared_pool', None)
+        if pool is None:
+            return False
+        else:
+            return pool.active
+    
+    def save_full_data(self, warn=True, npy=False):
         """Save models and data files for fast regeneration.
         
         The filenames of the outputs are generated from the input grism 
@@ -454,6 +997,14 @@ class GroupFLT():
         warn : bool
             Print a warning and skip if an output file is already found to
             exist.
+        
+        npy : bool
+            Save to the binary cache directory 
+            `save_file.replace('.fits', '.npy')` with 
+            `~grizli.model.GrismFLT.save_npy_cache` rather than the FITS 
+            file, and reload the arrays memory-mapped from there.  These 
+            caches are read preferentially by `_loadFLT` and are much 
+            faster to load than the FITS files.
                 
         Notes
         -----
@@ -462,7 +1013,10 @@ class GroupFLT():
         allow easier filename parsing and also to allow for instruments that 
         have multiple `SCI` extensions in a single calibrated file
         (e.g., ACS and WFC3/UVIS).
-        """      
+        """
+        ### Saved arrays are reloaded into local memory
+        self.close_shared_pool()
+              
         for i in range(self.N):
             file = self.FLTs[i].grism_file
             if self.FLTs[i].grism.data is None:
@@ -476,6 +1030,12 @@ class GroupFLT():
             save_file = save_file.replace('_flc.fits', new_root)
             save_file = save_file.replace('_cmb.fits', new_root)
             save_file = save_file.replace('_rate.fits', new_root)
+            
+            if npy:
+                cache_dir = self.FLTs[i].save_npy_cache(verbose=True)
+                self.FLTs[i].load_from_npy(cache_dir, mmap_mode='r')
+                continue
+                
             logging.info('Save {0}'.format(save_file))
             self.FLTs[i].save_full_pickle()
             
@@ -490,6 +1050,15 @@ class GroupFLT():
         generate separate `GroupFLT` instances for different grisms and 
         reference images with different filters.
         """
+        ### Restart shared pool with all of the exposures
+        restart_pool = self.has_shared_pool
+        if restart_pool:
+            n_workers = self.shared_pool.n_workers
+            self.close_shared_pool()
+        
+        if getattr(new, 'shared_pool', None) is not None:
+            new.close_shared_pool()
+            
         self.FLTs.extend(new.FLTs)
         self.N = len(self.FLTs)
         
@@ -506,6 +1075,9 @@ class GroupFLT():
         
         if verbose:
             logging.info('Now we have {0:d} FLTs'.format(self.N))
+        
+        if restart_pool:
+            self.start_shared_pool(cpu_count=n_workers, verbose=verbose)
             
     def compute_single_model(self, id, mag=-99, size=-1, store=False, spectrum_1d=None, is_cgs=False, get_beams=None, in_place=True):
         """Compute model spectrum in all exposures
@@ -533,6 +1105,19 @@ class GroupFLT():
         TBD
                
         """
+        if self.has_shared_pool:
+            kwargs = dict(id=id, verbose=False, size=size, 
+                          compute_size=(size < 0), mag=mag, in_place=in_place,
+                          store=store, spectrum_1d=spectrum_1d, is_cgs=is_cgs,
+                          get_beams=get_beams)
+            
+            out_beams = self.shared_pool.run('compute_model_orders',
+                                             args=(kwargs,))
+            if get_beams:
+                return out_beams
+            else:
+                return True
+                
         out_beams = []
         for flt in self.FLTs:
             status = flt.compute_model_orders(id=id, verbose=False,
@@ -577,6 +1162,17 @@ class GroupFLT():
             
         t0_pool = time.time()
         
+        if self.has_shared_pool:
+            ### Models updated in shared memory
+            self.shared_pool.run('compute_model', 
+                                 args=(fit_info, is_cgs, store))
+            
+            t1_pool = time.time()
+            if verbose:
+                logging.info('Models computed - {0:.2f} sec.'.format(t1_pool - t0_pool))
+            
+            return True
+            
         pool = mp.Pool(processes=cpu_count)
         results = [pool.apply_async(_compute_model, (i, self.FLTs[i], fit_info, is_cgs, store)) for i in range(self.N)]
 
@@ -596,6 +1192,13 @@ class GroupFLT():
                   get_slice_header=True):
         """TBD
         """
+        if self.has_shared_pool:
+            ### Cutouts extracted by the workers
+            beams = self.shared_pool.run('get_beam', args=(id, size, beam_id,
+                                                min_overlap, get_slice_header))
+            
+            return [beam for beam in beams if beam is not None]
+            
         beams = self.compute_single_model(id, size=size, store=False, get_beams=[beam_id])
         
         out_beams = []
@@ -1266,8 +1869,15 @@ class MultiBeam(GroupFitter):
                                     is_cgs=is_cgs)
             
     def fit_at_z(self, z=0., templates={}, fitter='nnls',
-                 fit_background=True, poly_order=0):
+                 fit_background=True, poly_order=0, normal_equations=False):
         """TBD
+        
+        Parameters
+        ----------
+        normal_equations : bool
+            For the 'lstsq' and 'nnls' fitters, solve for the coefficients
+            with the small normal system of the design matrix, see 
+            `~grizli.utils.normal_equations_lstsq`.
         """
 
         #print 'xxx Init poly'
@@ -1292,8 +1902,7 @@ class MultiBeam(GroupFitter):
             
             if z > 4:
                 try:
-                    import eazy.igm
-                    igm = eazy.igm.Inoue14()
+                    igm = utils.get_igm_table()
                     igmz = igm.full_IGM(z, spectrum_1d[0])
                     spectrum_1d[1]*=igmz    
                     #logging.info('IGM')            
@@ -1339,28 +1948,44 @@ class MultiBeam(GroupFitter):
                 ### Weight by ivar
                 y *= np.sqrt(self.ivarf[self.fit_mask])
 
-                try:
-                    out = np.linalg.lstsq(Ax,y)                         
-                except:
-                    logging.info(A.min(), Ax.min(), self.fit_mask.sum(), y.min())
-                    raise ValueError
+                if normal_equations:
+                    coeffs, ATA, R = utils.normal_equations_lstsq(Ax, y,
+                                                            fitter='lstsq')
+                else:
+                    coeffs = None
                     
-                lstsq_coeff, residuals, rank, s = out
-                coeffs = lstsq_coeff
+                if coeffs is None:
+                    try:
+                        out = np.linalg.lstsq(Ax,y)                         
+                    except:
+                        logging.info(A.min(), Ax.min(), self.fit_mask.sum(), y.min())
+                        raise ValueError
+                    
+                    lstsq_coeff, residuals, rank, s = out
+                    coeffs = lstsq_coeff
             
             if fitter == 'nnls':
                 if fit_background:
                     off = 0.04
                     y = self.scif[self.fit_mask]+off
                     y *= np.sqrt(self.ivarf[self.fit_mask])
-
-                    coeffs, rnorm = scipy.optimize.nnls(Ax, y+off)
-                    coeffs[:self.N] -= 0.04
+                    y_fit = y+off
                 else:
                     y = self.scif[self.fit_mask]
                     y *= np.sqrt(self.ivarf[self.fit_mask])
+                    y_fit = y
+                
+                if normal_equations:
+                    coeffs, ATA, R = utils.normal_equations_lstsq(Ax, y_fit,
+                                                             fitter='nnls')
+                else:
+                    coeffs = None
                     
-                    coeffs, rnorm = scipy.optimize.nnls(Ax, y)  
+                if coeffs is None:
+                    coeffs, rnorm = scipy.optimize.nnls(Ax, y_fit)
+                
+                if fit_background:
+                    coeffs[:self.N] -= 0.04
             
             # if fitter == 'bounded':
             #     if fit_background:
@@ -2551,8 +3176,21 @@ class MultiBeam(GroupFitter):
             
         return fit, fig, fig2, hdu2, hdu_full
     
-    def fit_trace_shift(self, split_groups=True, max_shift=5, tol=1.e-2, verbose=True):
+    def fit_trace_shift(self, split_groups=True, max_shift=5, tol=1.e-2, verbose=True, fast=False, nsub=8):
         """TBD
+        
+        Parameters
+        ----------
+        fast : bool
+            Minimize the objective with models interpolated from a grid 
+            of subpixel trace shifts (`init_trace_shift_models`) and its 
+            analytic gradient (`eval_trace_shift_fast`) with the 
+            quasi-Newton 'L-BFGS-B' method, rather than computing the models
+            at every step of the 'Powell' minimization.  The final 
+            shifts are applied with the full `eval_trace_shift`.
+        
+        nsub : int
+            Number of subpixel shifts for `fast=True`.
         """
         
         if split_groups:
@@ -2569,7 +3207,15 @@ class MultiBeam(GroupFitter):
         bounds = np.array([[-max_shift,max_shift]]*len(indices))
         
         args = (self, indices, 0, verbose)
-        out = scipy.optimize.minimize(self.eval_trace_shift, shifts, bounds=bounds, args=args, method='Powell', tol=tol)
+        if fast:
+            self.init_trace_shift_models(nsub=nsub)
+            fast_args = (self, indices, verbose)
+            out = scipy.optimize.minimize(self.eval_trace_shift_fast, shifts,
+                                          bounds=bounds, args=fast_args, 
+                                          method='L-BFGS-B', jac=True,
+                                          tol=tol)
+        else:
+            out = scipy.optimize.minimize(self.eval_trace_shift, shifts, bounds=bounds, args=args, method='Powell', tol=tol)
         
         self.eval_trace_shift(out.x, *args)
         
@@ -2613,6 +3259,116 @@ class MultiBeam(GroupFitter):
         
         return chi2/self.DoF    
     
+    def init_trace_shift_models(self, nsub=8):
+        """Precompute flat-spectrum models on a grid of subpixel trace shifts
+        
+        For every beam, compute the model with `compute_model` and trace 
+        offsets `yoffset = j/nsub` for `j = 0...nsub`.  Models at other 
+        offsets are then interpolated linearly between the subpixel offsets
+        and shifted by the integer part of the offset, see 
+        `trace_shift_model`.  The original traces are restored afterwards.
+        
+        Parameters
+        ----------
+        nsub : int
+            Number of subpixel steps.
+            
+        """
+        self.trace_shift_nsub = nsub
+        self.trace_shift_models = []
+        
+        for b in self.beams:
+            yoffset = getattr(b.beam, 'yoffset', 0.)
+            
+            models = np.zeros((nsub+1,) + tuple(b.beam.sh_beam))
+            for j in range(nsub+1):
+                b.beam.add_ytrace_offset(j/nsub)
+                b.compute_model()
+                models[j,:,:] = b.beam.model
+            
+            self.trace_shift_models.append(models)
+            
+            b.beam.add_ytrace_offset(yoffset)
+            b.compute_model()
+            
+    def trace_shift_model(self, i, yoffset):
+        """Interpolated model and derivative for a trace offset
+        
+        Parameters
+        ----------
+        i : int
+            Index of the beam in `self.beams`.
+        
+        yoffset : float
+            Trace offset, pixels.
+        
+        Returns
+        -------
+        model, dmodel : `~numpy.ndarray`
+            Flattened 2D model and its derivative with respect to `yoffset`.
+            
+        """
+        models = self.trace_shift_models[i]
+        nsub = self.trace_shift_nsub
+        
+        ishift = int(np.floor(yoffset))
+        fsub = (yoffset - ishift)*nsub
+        j = int(np.minimum(np.floor(fsub), nsub-1))
+        w = fsub - j
+        
+        model = (1-w)*models[j,:,:] + w*models[j+1,:,:]
+        dmodel = (models[j+1,:,:] - models[j,:,:])*nsub
+        
+        model = _shift_rows(model, ishift)
+        dmodel = _shift_rows(dmodel, ishift)
+        
+        return model.flatten(), dmodel.flatten()
+        
+    @staticmethod
+    def eval_trace_shift_fast(shifts, self, indices, verbose):
+        """Objective function of `eval_trace_shift` and its gradient
+        
+        Same as `eval_trace_shift` with `poly_order=0` but with the models 
+        interpolated from `init_trace_shift_models`.
+        
+        Returns
+        -------
+        chi2 : float
+            Chi-squared divided by `self.DoF`.
+        
+        grad : `~numpy.ndarray`
+            Gradient of `chi2` with respect to `shifts`.
+            
+        """
+        m = np.zeros(self.Ntot)
+        dm = np.zeros((len(indices), self.Ntot))
+        for il, l in enumerate(indices):
+            for i in l:
+                sl = self.slices[i]
+                m[sl], dm[il,sl] = self.trace_shift_model(i, shifts[il])
+        
+        # Scale factor, unweighted least squares as in `eval_trace_shift`
+        y = self.scif
+        mm = np.dot(m, m)
+        if mm == 0:
+            return np.sum((y**2*self.ivarf)[self.fit_mask])/self.DoF, np.zeros(len(indices))
+            
+        c = np.dot(m, y)/mm
+        
+        w = self.ivarf*self.fit_mask
+        resid = y - c*m
+        chi2 = np.sum(w*resid**2)
+        
+        # d(chi2)/dm, including the dependence of the scale factor c(m)
+        dc = (y - 2*c*m)/mm
+        grad_m = -2*c*w*resid - 2*np.sum(w*resid*m)*dc
+        grad = np.dot(dm, grad_m)
+        
+        if verbose:
+            logging.info('{0} {1}'.format(shifts, chi2/self.DoF))
+            
+        return chi2/self.DoF, grad/self.DoF
+    
     def drizzle_grisms_and_PAs(self, size=10, fcontam=0, flambda=False, scale=1, pixfrac=0.5, kernel='square', make_figure=True, usewcs=False, zfit=None, diff=True):
         """Make figure showing spectra at different orients/grisms
         
@@ -2953,6 +3709,20 @@ class MultiBeam(GroupFitter):
             
         return binned_spectrum
         
+def _shift_rows(data, shift):
+    """Shift a 2D array by an integer number of rows, filling with zeros
+    """
+    out = np.zeros_like(data)
+    if shift == 0:
+        out[:] = data
+    elif abs(shift) < data.shape[0]:
+        if shift > 0:
+            out[shift:,:] = data[:-shift,:]
+        else:
+            out[:shift,:] = data[-shift:,:]
+    
+    return out
+    
 def get_redshift_fit_defaults():
     """TBD
     """
@@ -12,6 +12,7 @@ import glob
 import lacosmicx
 import logging
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 import numpy as np
 import os
 import pyregion
@@ -28,6 +29,7 @@ from astroquery.irsa import Irsa
 from astroquery.sdss import SDSS
 from astroquery.ukidss import Ukidss
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from drizzlepac import updatehdr
 from drizzlepac.astrodrizzle import AstroDrizzle
 from scipy import polyfit
@@ -493,13 +495,452 @@ def clip_lists(input, output, clip=20):
     
     return in_arr, out_arr
 
+def _quad_invariants(xy, nnearest=5, anchors=None):
+    """Quads formed by points and triplets of their nearest neighbors
+    
+    The quad vertices are ordered (A,B,C,D), where A and B are the most 
+    widely separated pair.  The invariants are the coordinates of C and D 
+    in the frame where A=(0,0) and B=(1,0), which are unchanged by shifts, 
+    rotations and scale changes.  The symmetries of the frame are broken by
+    requiring `xC + xD <= 1` and `xC <= xD`.
+    
+    Parameters
+    ----------
+    xy : `~numpy.ndarray`, shape (N,2)
+        Point coordinates.
+    
+    nnearest : int
+        Number of nearest neighbors used to form the quads.
+    
+    anchors : `~numpy.ndarray` or None
+        Indices of the points whose neighbors are used to form the quads.
+        If None, use all points.
+        
+    Returns
+    -------
+    quads : `~numpy.ndarray`, shape (NQ,4)
+        Indices of the ordered quad vertices.
+    
+    inv : `~numpy.ndarray`, shape (NQ,4)
+        Invariants (xC, yC, xD, yD).
+        
+    """
+    N = len(xy)
+    k = int(np.minimum(nnearest, N-1))
+    if k < 3:
+        return np.zeros((0,4), dtype=int), np.zeros((0,4))
+    
+    if anchors is None:
+        anchors = np.arange(N)
+        
+    tree = scipy.spatial.cKDTree(xy)
+    dist, idx = tree.query(xy[anchors,:], k=k+1)
+    
+    # Triplets of the neighbors
+    i0, i1, i2 = np.indices((k,k,k)).reshape((3,-1))
+    trip = (i0 < i1) & (i1 < i2)
+    combos = np.array([i0[trip], i1[trip], i2[trip]]).T + 1
+    
+    quads = np.hstack((np.repeat(idx[:,:1], len(combos), axis=0),
+                       idx[:,combos].reshape((-1,3))))
+    
+    # Remove duplicates, sorted on integer keys of the vertex indices
+    quads = np.sort(quads, axis=1)
+    qkey = [quads[:,0]*N + quads[:,1], quads[:,2]*N + quads[:,3]]
+    if N**4 < 2**62:
+        qkey = [qkey[0]*N**2 + qkey[1]]
+    
+    so = np.lexsort(qkey[::-1])
+    quads = quads[so,:]
+    keep = np.zeros(len(quads), dtype=bool)
+    keep[0] = True
+    for key in qkey:
+        keep[1:] |= np.diff(key[so]) != 0
+    
+    quads = quads[keep,:]
+    
+    # Most distant pair -> (A,B)
+    z = xy[quads,0] + 1j*xy[quads,1]
+    pairs = np.array([[0,1,2,3], [0,2,1,3], [0,3,1,2], 
+                      [1,2,0,3], [1,3,0,2], [2,3,0,1]])
+    
+    sep = np.zeros((len(quads), len(pairs)))
+    for i, pair in enumerate(pairs):
+        dz = z[:,pair[0]] - z[:,pair[1]]
+        sep[:,i] = dz.real**2 + dz.imag**2
+        
+    order = pairs[np.argmax(sep, axis=1),:]
+    quads = np.take_along_axis(quads, order, axis=1)
+    z = np.take_along_axis(z, order, axis=1)
+    
+    u = ((z[:,2:].T - z[:,0])/(z[:,1]-z[:,0])).T
+    
+    # Break symmetries
+    flip = u.sum(axis=1).real > 1
+    quads[flip,:2] = quads[flip,1::-1]
+    u[flip,:] = 1-u[flip,:]
+    
+    flip = u[:,0].real > u[:,1].real
+    quads[flip,2:] = quads[flip,:1:-1]
+    u[flip,:] = u[flip,::-1]
+    
+    inv = np.array([u[:,0].real, u[:,0].imag, u[:,1].real, u[:,1].imag]).T
+    
+    valid = np.isfinite(inv).sum(axis=1) == 4
+    
+    return quads[valid,:], inv[valid,:]
+
+def _in_bounding_box(z, zbox):
+    """Complex points `z` within the bounding box of the points `zbox`
+    """
+    return ((z.real >= zbox.real.min()) & (z.real <= zbox.real.max()) &
+            (z.imag >= zbox.imag.min()) & (z.imag <= zbox.imag.max()))
+    
+def _similarity_lstsq(z, w):
+    """Least-squares similarity transforms between complex point sets
+    
+    Solves `w = a*z + b` for complex `a` (scale and rotation) and `b` 
+    (translation) along the last axis of `z` and `w`.
+    """
+    zm = z.mean(axis=-1)
+    wm = w.mean(axis=-1)
+    dz = (z.T-zm.T).T
+    dw = (w.T-wm.T).T
+    a = (np.conj(dz)*dw).sum(axis=-1)/(np.abs(dz)**2).sum(axis=-1)
+    b = wm - a*zm
+    return a, b
+    
+def match_quads(input, output, toler=5, input_mag=None, output_mag=None,
+                max_density_ratio=1.5, nnearest=5, max_quads=100000,
+                quad_toler=0.03, max_query=20000, max_votes=500, 
+                max_trials=50, max_group=100, nsample=1000, niter=20, 
+                min_match=5, min_fraction=0.2, scale_range=[0.5, 2.], 
+                seed=1):
+    """Match two [x,y] lists with asterism (quad) hashing and RANSAC
+    
+    Quads are formed from points and triplets of their `nnearest` nearest
+    neighbors (see `_quad_invariants`) and matched between the lists in the
+    space of their similarity-invariant coordinates with a 
+    `~scipy.spatial.cKDTree` built from the quads of the sparser list.  
+    Each quad match defines a trial similarity transformation (shift, 
+    rotation, scale).  The trials are ranked by the number of other trials
+    that agree with them, and the best `max_trials` are scored by the 
+    number of transformed `input` points that have an `output` neighbor 
+    within `toler`.  
+    
+    Matching quads have to be formed from the same points in both lists,
+    which requires that the nearest neighbors of the common sources are 
+    mostly common to both lists.  This fails if one list is much denser 
+    than the other, e.g., a deep catalog matched to a shallow one, so the
+    quads of the denser list are formed from its brightest sources, down to
+    `max_density_ratio` times the density of the sparser list, if its 
+    magnitudes are provided.  Otherwise, the lists should be cut to 
+    comparable densities before they are matched.
+    
+    Solutions with fewer than `min_match` matched points, a scale outside 
+    of `scale_range` or fewer matched points than `min_fraction` of the
+    points of either list that fall within the bounding box of the other
+    are rejected.
+    
+    Parameters
+    ----------
+    input, output : `~numpy.ndarray`, shape (N,2)
+        Point lists.  The transformation maps `input` to `output`.
+    
+    toler : float
+        Matching tolerance, in the units of `output`.
+    
+    input_mag, output_mag : `~numpy.ndarray` or None
+        Magnitudes of the points in each list, or any other brightness 
+        ranking where brighter points have smaller values.  Only used for 
+        the denser list, see `max_density_ratio`.
+    
+    max_density_ratio : float
+        Maximum ratio of the densities (number per area of the bounding 
+        box) of the points used to form the quads of the two lists.  The 
+        brightest points of the denser list are used if its magnitudes are
+        provided.
+    
+    nnearest : int
+        Number of nearest neighbors used to form the quads.
+    
+    max_quads : int
+        Maximum number of quads of the sparser list.  If necessary, the 
+        quads are formed from a random subset of the points.
+        
+    quad_toler : float
+        Matching tolerance of the quad invariants, which are in units of the
+        size of the quads.
+    
+    max_query : int
+        Maximum number of quads of the denser list to match.
+    
+    max_votes : int
+        Maximum number of trial transformations for which the number of
+        similar trials is counted.
+        
+    max_trials : int
+        Number of trial transformations to score.
+    
+    max_group : int
+        Maximum number of similar quads used to refit each trial 
+        transformation.
+    
+    nsample : int
+        Maximum number of `input` points used to score the trials.
+    
+    niter : int
+        Maximum number of iterations of the final match and transformation
+        fit, which stop when the list of matches doesn't change.
+    
+    min_match : int
+        Minimum number of matched points.
+    
+    min_fraction : float
+        Minimum number of matched points as a fraction of the number of 
+        points of either list within the bounding box of the other, after 
+        the transformation.
+    
+    scale_range : [float, float] or None
+        Allowed range of the scale of the transformation.
+        
+    seed : int
+        Random seed for the subsamples.
+        
+    Returns
+    -------
+    input_ix, output_ix : `~numpy.ndarray`
+        Indices of the matched pairs.
+    
+    tf : `~skimage.transform.SimilarityTransform`
+        Best-fit transformation.
+    
+    Raises
+    ------
+    ValueError
+        If no transformation is found that satisfies `min_match`, 
+        `min_fraction` and `scale_range`.
+        
+    """
+    input = np.asarray(input, dtype=float)
+    output = np.asarray(output, dtype=float)
+    
+    Nin, Nout = len(input), len(output)
+    if (Nin < 4) | (Nout < 4):
+        raise ValueError('Need at least 4 points in each list.')
+    
+    rng = np.random.RandomState(seed)
+    
+    ### Brightest points of the denser list
+    area = [np.prod(np.maximum(xy.max(axis=0)-xy.min(axis=0), 1.e-12))
+            for xy in [input, output]]
+    
+    density = np.array([Nin/area[0], Nout/area[1]])
+    
+    sel = [np.arange(Nin), np.arange(Nout)]
+    for i, mag in enumerate([input_mag, output_mag]):
+        if (mag is None) | (density[i] <= max_density_ratio*density[1-i]):
+            continue
+        
+        nbright = int(np.maximum(max_density_ratio*density[1-i]*area[i], 4))
+        so = np.argsort(np.asarray(mag), kind='mergesort')
+        sel[i] = np.sort(so[:nbright])
+    
+    ### Quads of the sparse (tree) and dense (query) lists
+    if len(sel[1]) > len(sel[0]):
+        xy_tree, xy_query = input[sel[0]], output[sel[1]]
+        sel_tree, sel_query = sel
+    else:
+        xy_tree, xy_query = output[sel[1]], input[sel[0]]
+        sel_query, sel_tree = sel
+        
+    k = int(np.minimum(nnearest, np.minimum(len(sel[0]), len(sel[1]))-1))
+    nquad = np.maximum(k*(k-1)*(k-2)//6, 1)
+    
+    quads = []
+    for xy, nmax in zip([xy_tree, xy_query], [max_quads, max_query]):
+        nanchor = int(np.maximum(nmax//nquad, 1))
+        if len(xy) > nanchor:
+            anchors = rng.choice(len(xy), size=nanchor, replace=False)
+        else:
+            anchors = None
+        
+        quads.append(_quad_invariants(xy, nnearest=k, anchors=anchors))
+    
+    (quad_tree, inv_tree), (quad_query, inv_query) = quads
+    if (len(quad_tree) == 0) | (len(quad_query) == 0):
+        raise ValueError('No quads found.')
+    
+    # Indices in the full lists
+    quad_tree, quad_query = sel_tree[quad_tree], sel_query[quad_query]
+        
+    ### Match quads
+    kq = int(np.minimum(4, len(quad_tree)))
+    tree = scipy.spatial.cKDTree(inv_tree)
+    dist, idx = tree.query(inv_query, k=kq, distance_upper_bound=quad_toler)
+    dist = dist.reshape((len(inv_query),-1))
+    idx = idx.reshape((len(inv_query),-1))
+    
+    ii, jj = np.where(np.isfinite(dist))
+    if len(ii) == 0:
+        raise ValueError('No matching quads found.')
+    
+    zin = input[:,0] + 1j*input[:,1]
+    zout = output[:,0] + 1j*output[:,1]
+    
+    if len(sel[1]) > len(sel[0]):
+        z = zin[quad_tree[idx[ii,jj],:]]
+        w = zout[quad_query[ii,:]]
+    else:
+        z = zin[quad_query[ii,:]]
+        w = zout[quad_tree[idx[ii,jj],:]]
+    
+    ### Trial transformations from the quad vertices
+    a, b = _similarity_lstsq(z, w)
+    resid = np.abs((z.T*a + b).T - w).max(axis=1)
+    ok = (resid < toler) & (np.abs(a) > 0)
+    if scale_range is not None:
+        ok &= (np.abs(a) >= scale_range[0]) & (np.abs(a) <= scale_range[1])
+        
+    if ok.sum() == 0:
+        raise ValueError('No matching quads found.')
+    
+    a, b = a[ok], b[ok]
+    
+    ### Rank the trials by the number of similar trials.  The features are
+    ### the transformed centroid and (scale, rotation) scaled by the rms 
+    ### radius of the input list, where the scatter of the trials is set by 
+    ### the fractional precision of the quads.
+    zc = zin.mean()
+    rc = np.sqrt(np.mean(np.abs(zin-zc)**2))
+    zt = a*zc + b
+    feat = np.array([zt.real, zt.imag, a.real*rc, a.imag*rc]).T
+    
+    # Votes are first counted for a random subset of the trials, which 
+    # is enough if there are many correct trials.  Otherwise, count the 
+    # votes of all trials, which is then fast because few trials are similar.
+    vote_radius = np.maximum(toler, 2*rc*quad_toler)
+    feat_tree = scipy.spatial.cKDTree(feat)
+    
+    centers = np.arange(len(feat))
+    if len(feat) > max_votes:
+        sub = rng.choice(len(feat), size=max_votes, replace=False)
+        votes = feat_tree.query_ball_point(feat[sub,:], r=vote_radius, 
+                                           return_length=True)
+        
+        # Expected number of similar trials in the subset
+        if votes.max()*max_votes/len(feat) > 10:
+            centers = sub
+        
+    if len(centers) == len(feat):
+        votes = feat_tree.query_ball_point(feat, r=vote_radius, 
+                                           return_length=True)
+    
+    trials = centers[np.argsort(-votes, kind='mergesort')[:max_trials]]
+    
+    # Refit the trials with the vertices of the (up to `max_group`) most 
+    # similar quads, which span a larger area than the individual quads
+    z, w = z[ok,:], w[ok,:]
+    kg = int(np.minimum(max_group, len(feat)))
+    gdist, groups = feat_tree.query(feat[trials,:], k=kg, 
+                                    distance_upper_bound=vote_radius)
+    gdist = gdist.reshape((len(trials),-1))
+    groups = groups.reshape((len(trials),-1))
+    
+    a_trial = a[trials]
+    b_trial = b[trials]
+    for i in range(len(trials)):
+        g = groups[i,np.isfinite(gdist[i,:])]
+        zg, wg = z[g,:].flatten(), w[g,:].flatten()
+        for clip_iter in range(3):
+            resid = np.abs(a_trial[i]*zg + b_trial[i] - wg)
+            clip = resid < toler
+            if clip.sum() < 3:
+                break
+            
+            a_trial[i], b_trial[i] = _similarity_lstsq(zg[clip], wg[clip])
+    
+    ### Score the trials on a sample of the points
+    out_tree = scipy.spatial.cKDTree(output)
+    if Nin > nsample:
+        sample = rng.choice(Nin, size=nsample, replace=False)
+    else:
+        sample = np.arange(Nin)
+        
+    zs = np.outer(a_trial, zin[sample]) + b_trial[:,None]
+    xys = np.array([zs.real.flatten(), zs.imag.flatten()]).T
+    dist, idx = out_tree.query(xys, k=1, distance_upper_bound=toler)
+    ninlier = np.isfinite(dist).reshape(zs.shape).sum(axis=1)
+    
+    best = np.argmax(ninlier)
+    a_best, b_best = a_trial[best], b_trial[best]
+    
+    ### Final matches and transformation
+    input_ix = None
+    for iter in range(niter):
+        prev_ix = input_ix
+        zt = a_best*zin + b_best
+        dist, idx = out_tree.query(np.array([zt.real, zt.imag]).T, k=1,
+                                   distance_upper_bound=toler)
+        
+        input_ix = np.where(np.isfinite(dist))[0]
+        
+        # Unique matches, keep the closest
+        so = np.argsort(dist[input_ix], kind='mergesort')
+        un, ui = np.unique(idx[input_ix][so], return_index=True)
+        input_ix = np.sort(input_ix[so][ui])
+        output_ix = idx[input_ix]
+        
+        if len(input_ix) < 3:
+            raise ValueError('Fewer than 3 matched points.')
+        
+        if prev_ix is not None:
+            if np.array_equal(input_ix, prev_ix):
+                break
+                
+        a_best, b_best = _similarity_lstsq(zin[input_ix], zout[output_ix])
+    
+    ### Reject spurious solutions.  The fraction of matched points is 
+    ### relative to the points in the overlap of the bounding boxes of 
+    ### the lists.
+    zt = a_best*zin + b_best
+    zi = (zout - b_best)/a_best
+    Nover = np.minimum(_in_bounding_box(zt, zout).sum(), 
+                       _in_bounding_box(zi, zin).sum())
+    
+    min_N = int(np.maximum(min_match, np.ceil(min_fraction*Nover)))
+    if len(input_ix) < min_N:
+        msg = 'Only {0:d} matched points, {1:d} required.'
+        raise ValueError(msg.format(len(input_ix), min_N))
+    
+    if scale_range is not None:
+        if ((np.abs(a_best) < scale_range[0]) | 
+            (np.abs(a_best) > scale_range[1])):
+            msg = 'Scale {0:.3f} outside of `scale_range` {1}.'
+            raise ValueError(msg.format(np.abs(a_best), scale_range))
+            
+    tf = skimage.transform.SimilarityTransform(scale=np.abs(a_best), 
+                                     rotation=np.angle(a_best), 
+                                     translation=(b_best.real, b_best.imag))
+    
+    return input_ix, output_ix, tf
+    
 def match_lists(input, output, transform=None, scl=3600., simple=True,
-                outlier_threshold=5, toler=5):
+                outlier_threshold=5, toler=5, method='xyxymatch', 
+                input_mag=None, output_mag=None):
     """TBD
     
     Compute matched objects and transformation between two [x,y] lists.
     
     If `transform` is None, use Similarity transform (shift, scale, rot) 
+    
+    With `method='xyxymatch'`, the lists are matched with 
+    `stsci.stimage.xyxymatch` within `toler` of the identity 
+    transformation.  With `method='quads'`, use `match_quads`, which 
+    doesn't require an initial guess of the transformation and scales to 
+    large catalogs.  The optional magnitudes `input_mag` and `output_mag` 
+    are passed to `match_quads`, which raises a `ValueError` if no 
+    acceptable match is found.
     """
     
     if transform is None:
@@ -510,7 +951,12 @@ def match_lists(input, output, transform=None, scl=3600., simple=True,
         logging.info('No entries!')
         return input, output, None, transform()
     
-    match = stsci.stimage.xyxymatch(copy.copy(input), copy.copy(output), 
+    if method == 'quads':
+        input_ix, output_ix = match_quads(input, output, toler=toler,
+                                          input_mag=input_mag, 
+                                          output_mag=output_mag)[:2]
+    elif method == 'xyxymatch':
+        match = stsci.stimage.xyxymatch(copy.copy(input), copy.copy(output), 
                                     origin=np.median(input, axis=0), 
                                     mag=(1.0, 1.0), rotation=(0.0, 0.0),
                                     ref_origin=np.median(input, axis=0), 
@@ -518,10 +964,12 @@ def match_lists(input, output, transform=None, scl=3600., simple=True,
                                     separation=0.5, nmatch=10, maxratio=10.0, 
                                     nreject=10)
                                     
-    m = Table(match)
+        m = Table(match)
 
-    output_ix = m['ref_idx'].data
-    input_ix = m['input_idx'].data
+        output_ix = m['ref_idx'].data
+        input_ix = m['input_idx'].data
+    else:
+        raise ValueError("method must be 'xyxymatch' or 'quads'")
     
     tf = transform()
     tf.estimate(input[input_ix,:], output[output_ix])
@@ -547,8 +995,13 @@ def match_lists(input, output, transform=None, scl=3600., simple=True,
 
 def align_drizzled_image(root='', mag_limits=[14,23], radec=None, NITER=3, 
                          clip=20, log=True, outlier_threshold=5, 
-                         verbose=True, guess=[0., 0., 0., 1]):
+                         verbose=True, guess=[0., 0., 0., 1],
+                         match_method='xyxymatch'):
     """TBD
+    
+    `match_method` is passed to `match_lists`, along with the magnitude 
+    ranks of the catalog sources.  Raises a `ValueError` if the lists can't 
+    be matched.
     """
     if hasattr(radec, 'upper'):
         rd_ref = np.loadtxt(radec)
@@ -577,7 +1030,10 @@ def align_drizzled_image(root='', mag_limits=[14,23], radec=None, NITER=3,
                                                                  mag_limits))
         return False
     
-    xy_drz = np.array([cat['X_IMAGE'][ok], cat['Y_IMAGE'][ok]]).T
+    ### Sorted by magnitude, which is preserved by `clip_lists`, so that 
+    ### `match_quads` can use the brightest sources of the denser list
+    so = np.argsort(cat['MAG_AUTO'][ok], kind='mergesort')
+    xy_drz = np.array([cat['X_IMAGE'][ok][so], cat['Y_IMAGE'][ok][so]]).T
     
     drz_file = glob.glob('{0}_dr[zc]_sci.fits'.format(root))[0]
     drz_im = pyfits.open(drz_file)
@@ -609,18 +1065,27 @@ def align_drizzled_image(root='', mag_limits=[14,23], radec=None, NITER=3,
         
         #print np.sum(input) + np.sum(output)
         
+        # Magnitude ranks of the drz sources
+        drz_rank = np.arange(len(input))
+        
         toler=5
         titer=0
+        res = None
         while (titer < 3):
             try:
                 res = match_lists(output, input, scl=1., simple=True,
-                          outlier_threshold=outlier_threshold, toler=toler)
+                          outlier_threshold=outlier_threshold, toler=toler,
+                          method=match_method, output_mag=drz_rank)
                 output_ix, input_ix, outliers, tf = res
                 break
             except:
                 toler += 5
                 titer += 1
         
+        if res is None:
+            msg = '{0}: no match found with match_method={1}'
+            raise ValueError(msg.format(root, match_method))
+        
         #logging.info(output.shape, output_ix.shape, output_ix.min(), output_ix.max(), titer, toler, input_ix.shape, input.shape)
               
         titer = 0 
@@ -630,7 +1095,8 @@ def align_drizzled_image(root='', mag_limits=[14,23], radec=None, NITER=3,
             try:
                 res = match_lists(output, input, scl=1., simple=True,
                               outlier_threshold=outlier_threshold,
-                              toler=toler)
+                              toler=toler, method=match_method,
+                              output_mag=drz_rank)
             except:
                 pass
                 
@@ -648,7 +1114,7 @@ def align_drizzled_image(root='', mag_limits=[14,23], radec=None, NITER=3,
             res2 = match_lists(output[output_ix][~outliers],
                               input[input_ix][~outliers], scl=1., simple=True,
                               outlier_threshold=outlier_threshold,
-                              toler=toler)
+                              toler=toler, method=match_method)
             
             output_ix2, input_ix2, outliers2, tf = res2
         
@@ -1026,7 +1492,47 @@ def get_ukidss_catalog(ra=165., dec=34.8, radius=3, database='UKIDSSDR9PLUS',
     
     return table
     
-def get_sdss_catalog(ra=165.86, dec=34.829694, radius=3):
+def _tiled_catalog_query(query_func, name, ra=0., dec=0., radius=3., 
+                         cache_dir=None, offline=False, max_rows=None,
+                         **kwargs):
+    """Cone query through a `~grizli.utils.SkyTileCache`
+    
+    Parameters
+    ----------
+    query_func : function
+        Catalog query function, e.g., `get_gaia_catalog`.
+    
+    name : str
+        Name of the cached catalog.
+    
+    ra, dec, radius : float
+        Cone center (decimal degrees) and radius (arcmin).
+    
+    cache_dir : False, None or str
+        Cache directory.  False or None for the default directory.
+    
+    offline, max_rows : 
+        Passed to `~grizli.utils.SkyTileCache`.
+        
+    kwargs : dict
+        Additional keywords passed to `query_func`.
+    
+    Returns
+    -------
+    table : `~astropy.table.Table`
+        Result of the query
+    """
+    if cache_dir is False:
+        cache_dir = None
+        
+    cache = utils.SkyTileCache(name, query_func=query_func, 
+                               cache_dir=cache_dir, offline=offline, 
+                               max_rows=max_rows, **kwargs)
+    
+    return cache.query(ra=ra, dec=dec, radius=radius)
+    
+def get_sdss_catalog(ra=165.86, dec=34.829694, radius=3, cache_dir=False,
+                     offline=False):
     """Query for objects in the SDSS photometric catalog 
     
     Parameters
@@ -1037,13 +1543,26 @@ def get_sdss_catalog(ra=165.86, dec=34.829694, radius=3):
     radius : float
         Radius of the query, in arcmin
     
+    cache_dir : False, None or str
+        If not False, answer the query from the tiles of a 
+        `~grizli.utils.SkyTileCache` in `cache_dir`, fetching only the 
+        tiles that aren't already cached.  If None, use the default cache
+        directory `$GRIZLI/catalogs/cache`.
+    
+    offline : bool
+        Only use the cached tiles, see `~grizli.utils.SkyTileCache`.
+    
     Returns
     -------
     table : `~astropy.table.Table`
         Result of the query
         
     """
-    
+    if (cache_dir is not False) | offline:
+        return _tiled_catalog_query(get_sdss_catalog, 'sdss', ra=ra, dec=dec,
+                                    radius=radius, cache_dir=cache_dir, 
+                                    offline=offline)
+        
     coo = coord.SkyCoord(ra*u.deg, dec*u.deg)
     
     fields = ['ra', 'dec', 'raErr', 'decErr', 'petroMag_r', 'petroMagErr_r']
@@ -1055,7 +1574,7 @@ def get_sdss_catalog(ra=165.86, dec=34.829694, radius=3):
                               
     return table
 
-def get_irsa_catalog(ra=165.86, dec=34.829694, radius=3, catalog='allwise_p3as_psd', wise=False, twomass=False):
+def get_irsa_catalog(ra=165.86, dec=34.829694, radius=3, catalog='allwise_p3as_psd', wise=False, twomass=False, cache_dir=False, offline=False):
     """Query for objects in the `AllWISE <http://wise2.ipac.caltech.edu/docs/release/allwise/>`_ source catalog 
     
     Parameters
@@ -1066,6 +1585,15 @@ def get_irsa_catalog(ra=165.86, dec=34.829694, radius=3, catalog='allwise_p3as_p
     radius : float
         Radius of the query, in arcmin
     
+    cache_dir : False, None or str
+        If not False, answer the query from the tiles of a 
+        `~grizli.utils.SkyTileCache` in `cache_dir`, fetching only the 
+        tiles that aren't already cached.  If None, use the default cache
+        directory `$GRIZLI/catalogs/cache`.
+    
+    offline : bool
+        Only use the cached tiles, see `~grizli.utils.SkyTileCache`.
+    
     Returns
     -------
     table : `~astropy.table.Table`
@@ -1079,6 +1607,13 @@ def get_irsa_catalog(ra=165.86, dec=34.829694, radius=3, catalog='allwise_p3as_p
         catalog = 'allwise_p3as_psd'
     elif twomass:
         catalog = 'fp_psc'
+    
+    if (cache_dir is not False) | offline:
+        return _tiled_catalog_query(get_irsa_catalog, 
+                                    'irsa_{0}'.format(catalog), ra=ra, 
+                                    dec=dec, radius=radius, 
+                                    cache_dir=cache_dir, offline=offline, 
+                                    catalog=catalog)
         
     coo = coord.SkyCoord(ra*u.deg, dec*u.deg)
     
@@ -1087,7 +1622,33 @@ def get_irsa_catalog(ra=165.86, dec=34.829694, radius=3, catalog='allwise_p3as_p
     
     return table
 
-def get_gaia_catalog(ra=165.86, dec=34.829694, radius=3.):
+def _gaia_adql_query(ra=165.86, dec=34.829694, radius=3.):
+    """ADQL cone query of the GAIA DR1 source catalog
+    
+    The radius is rounded up to 1e-6 deg so that the query covers the full
+    cone, e.g., the corners of the tiles of a `~grizli.utils.SkyTileCache`.
+    
+    Parameters
+    ----------
+    ra, dec : float
+        Center of the query region, decimal degrees
+    
+    radius : float
+        Radius of the query, in arcmin
+    
+    Returns
+    -------
+    query : str
+        ADQL query.
+    """
+    radius_deg = np.ceil(radius/60.*1.e6)/1.e6
+    
+    query = "SELECT TOP 5000 * FROM gaiadr1.gaia_source  WHERE CONTAINS(POINT('ICRS',gaiadr1.gaia_source.ra,gaiadr1.gaia_source.dec),CIRCLE('ICRS',{0},{1},{2:.6f}))=1".format(ra, dec, radius_deg)
+    
+    return query
+    
+def get_gaia_catalog(ra=165.86, dec=34.829694, radius=3., cache_dir=False,
+                     offline=False):
     """Query GAIA DR1 astrometric catalog
     
     Parameters
@@ -1098,12 +1659,27 @@ def get_gaia_catalog(ra=165.86, dec=34.829694, radius=3.):
     radius : float
         Radius of the query, in arcmin
     
+    cache_dir : False, None or str
+        If not False, answer the query from the tiles of a 
+        `~grizli.utils.SkyTileCache` in `cache_dir`, fetching only the 
+        tiles that aren't already cached.  If None, use the default cache
+        directory `$GRIZLI/catalogs/cache`.
+    
+    offline : bool
+        Only use the cached tiles, see `~grizli.utils.SkyTileCache`.
+    
     Returns
     -------
     table : `~astropy.table.Table`
         Result of the query
     
     """
+    if (cache_dir is not False) | offline:
+        return _tiled_catalog_query(get_gaia_catalog, 'gaia_dr1', ra=ra, 
+                                    dec=dec, radius=radius, 
+                                    cache_dir=cache_dir, offline=offline,
+                                    max_rows=5000)
+    
     try:
         import httplib
         from urllib import urlencode
@@ -1130,7 +1706,7 @@ def get_gaia_catalog(ra=165.86, dec=34.829694, radius=3.):
     	"LANG":    "ADQL", \
     	"FORMAT":  "votable", \
     	"PHASE":  "RUN", \
-    	"QUERY":   "SELECT TOP 5000 * FROM gaiadr1.gaia_source  WHERE CONTAINS(POINT('ICRS',gaiadr1.gaia_source.ra,gaiadr1.gaia_source.dec),CIRCLE('ICRS',{0},{1},{2:.2f}))=1".format(ra, dec, radius/60.)
+    	"QUERY":   _gaia_adql_query(ra=ra, dec=dec, radius=radius)
     	})
 
     headers = {\
@@ -1207,9 +1783,31 @@ def get_gaia_catalog(ra=165.86, dec=34.829694, radius=3.):
     table = Table.read('gaia.vot', format='votable')
     return table
 
-def get_panstarrs_catalog(ra=0., dec=0., radius=3, columns='objName,objID,raStack,decStack,raStackErr,decStackErr,rMeanKronMag,rMeanKronMagErr,iMeanKronMag,iMeanKronMagErr', max_records=10000):
+def get_panstarrs_catalog(ra=0., dec=0., radius=3, columns='objName,objID,raStack,decStack,raStackErr,decStackErr,rMeanKronMag,rMeanKronMagErr,iMeanKronMag,iMeanKronMagErr', max_records=10000, cache_dir=False, offline=False):
     """TBD
+    
+    Parameters
+    ----------
+    cache_dir : False, None or str
+        If not False, answer the query from the tiles of a 
+        `~grizli.utils.SkyTileCache` in `cache_dir`, fetching only the 
+        tiles that aren't already cached.  If None, use the default cache
+        directory `$GRIZLI/catalogs/cache`.
+    
+    offline : bool
+        Only use the cached tiles, see `~grizli.utils.SkyTileCache`.
+    
     """
+    if (cache_dir is not False) | offline:
+        import hashlib
+        col_hash = hashlib.md5(columns.encode('utf-8')).hexdigest()[:8]
+        return _tiled_catalog_query(get_panstarrs_catalog, 
+                                    'ps1_{0}'.format(col_hash), ra=ra, 
+                                    dec=dec, radius=radius, 
+                                    cache_dir=cache_dir, offline=offline,
+                                    max_rows=max_records, columns=columns,
+                                    max_records=max_records)
+    
     try:
         import httplib
         from urllib import urlencode
@@ -1239,7 +1837,7 @@ def get_panstarrs_catalog(ra=0., dec=0., radius=3, columns='objName,objID,raStac
     table['dec'] = table['decStack']
     return table[clip]
     
-def get_radec_catalog(ra=0., dec=0., radius=3., product='cat', verbose=True, reference_catalogs = ['GAIA', 'PS1', 'SDSS', 'WISE']):
+def get_radec_catalog(ra=0., dec=0., radius=3., product='cat', verbose=True, reference_catalogs = ['GAIA', 'PS1', 'SDSS', 'WISE'], cache_dir=False, offline=False):
     """Decide what reference astrometric catalog to use
     
     First search SDSS, then WISE looking for nearby matches.  
@@ -1261,6 +1859,10 @@ def get_radec_catalog(ra=0., dec=0., radius=3., product='cat', verbose=True, ref
     reference_catalogs : list
         Order in which to query reference catalogs.  Options are 'GAIA',
         'PS1' (STScI PanSTARRS), 'SDSS', 'WISE'.
+    
+    cache_dir, offline : 
+        Passed to the query functions to use the cached catalog tiles, 
+        e.g., `get_gaia_catalog`.
         
     Returns
     -------
@@ -1300,7 +1902,9 @@ def get_radec_catalog(ra=0., dec=0., radius=3., product='cat', verbose=True, ref
     
     for ref_src in reference_catalogs:
         try:
-            ref_cat = query_functions[ref_src](ra=ra, dec=dec, radius=2)
+            ref_cat = query_functions[ref_src](ra=ra, dec=dec, radius=2,
+                                               cache_dir=cache_dir, 
+                                               offline=offline)
             if len(ref_cat) < 2:
                 raise ValueError
                 
@@ -1376,12 +1980,16 @@ def process_direct_grism_visit(direct={}, grism={}, radec=None,
                                align_mag_limits = [14,23],
                                column_average=True, 
                                sky_iter=10,
+                               sky_threads=1,
                                run_tweak_align=True,
                                tweak_fit_order=-1,
                                skip_direct=False,
                                fix_stars=True,
                                tweak_max_dist=1.,
                                tweak_threshold=1.5,
+                               tweak_method='sextractor',
+                               tweak_cpu_count=1,
+                               catalog_cache_dir=False,
                              reference_catalogs=['GAIA','PS1','SDSS','WISE']):
     """Full processing of a direct + grism image visit.
     
@@ -1464,7 +2072,8 @@ def process_direct_grism_visit(direct={}, grism={}, radec=None,
             #if run_tweak_align:
             tweak_align(direct_group=direct, grism_group=grism,
                         max_dist=tweak_max_dist, key=' ', drizzle=False,
-                        threshold=tweak_threshold, fit_order=tweak_fit_order)
+                        threshold=tweak_threshold, fit_order=tweak_fit_order,
+                        method=tweak_method, cpu_count=tweak_cpu_count)
       
         ### Get reference astrometry from SDSS or WISE
         if radec is None:
@@ -1472,7 +2081,8 @@ def process_direct_grism_visit(direct={}, grism={}, radec=None,
             radec, ref_catalog = get_radec_catalog(ra=im[0].header['RA_TARG'],
                             dec=im[0].header['DEC_TARG'], 
                             product=direct['product'],
-                            reference_catalogs=reference_catalogs)
+                            reference_catalogs=reference_catalogs,
+                            cache_dir=catalog_cache_dir)
         
             if ref_catalog == 'VISIT':
                 align_mag_limits = [16,23]
@@ -1515,7 +2125,8 @@ def process_direct_grism_visit(direct={}, grism={}, radec=None,
         if isACS & run_tweak_align:
             tweak_align(direct_group=direct, grism_group=grism,
                     max_dist=tweak_max_dist, key=' ', drizzle=False,
-                    threshold=tweak_threshold)
+                    threshold=tweak_threshold, method=tweak_method,
+                    cpu_count=tweak_cpu_count)
             
             # Redrizzle with no CR rejection
             AstroDrizzle(direct['files'], output=direct['product'],
@@ -1638,12 +2249,14 @@ def process_direct_grism_visit(direct={}, grism={}, radec=None,
         
     ### Subtract grism sky
     status = visit_grism_sky(grism=grism, apply=True, sky_iter=sky_iter,
-                          column_average=column_average, verbose=True, ext=1)
+                          column_average=column_average, verbose=True, ext=1,
+                          n_threads=sky_threads)
     
     # Run on second chip (also for UVIS/G280)
     if isACS:
         visit_grism_sky(grism=grism, apply=True, sky_iter=sky_iter,
-                        column_average=column_average, verbose=True, ext=2)
+                        column_average=column_average, verbose=True, ext=2,
+                        n_threads=sky_threads)
         
         # Add back in some pedestal or CR rejection fails for ACS
         for file in grism['files']:
@@ -1716,7 +2329,8 @@ def set_grism_dfilter(direct, grism):
         flt.flush()
     
 def tweak_align(direct_group={}, grism_group={}, max_dist=1., key=' ', 
-                threshold=3, drizzle=False, fit_order=-1):
+                threshold=3, drizzle=False, fit_order=-1, 
+                method='sextractor', cpu_count=1):
     """
     Intra-visit shifts (WFC3/IR)
     """
@@ -1727,7 +2341,8 @@ def tweak_align(direct_group={}, grism_group={}, max_dist=1., key=' ',
         
     wcs_ref, shift_dict = tweak_flt(files=direct_group['files'],
                                     max_dist=max_dist, threshold=threshold,
-                                    verbose=True)
+                                    verbose=True, method=method, 
+                                    cpu_count=cpu_count)
 
     grism_matches = find_direct_grism_pairs(direct=direct_group, grism=grism_group, check_pixel=[507, 507], toler=0.1, key=key)
     
@@ -1828,63 +2443,147 @@ def clean_drizzle(root):
     sci[0].data[mask] = 0
     sci.flush()
 
-def tweak_flt(files=[], max_dist=0.4, threshold=3, verbose=True):
+def _tweak_flt_catalog(file, threshold=3, method='sextractor'):
+    """Source catalog of a single exposure for `tweak_flt`
+    
+    Parameters
+    ----------
+    file : str
+        FLT filename.
+    
+    threshold : float
+        Detection threshold, in sigma.
+    
+    method : 'sextractor', 'photutils'
+        With 'sextractor', write temporary '_xsci.fits' and '_xrms.fits'
+        images and run SExtractor with `sewpy`.  With 'photutils', detect 
+        the sources in memory with `~grizli.utils.detect_with_photutils`.
+    
+    Returns
+    -------
+    xy : `~numpy.ndarray`, shape (N,2)
+        1-indexed source positions in the exposure frame.
+    
+    """
+    root = file.split('.fits')[0]
+    
+    im = pyfits.open(file)
+    ok = im['DQ',1].data == 0
+    sci = im['SCI',1].data*ok - np.median(im['SCI',1].data[ok])
+    
+    if method == 'photutils':
+        cat, seg = utils.detect_with_photutils(sci, err=im['ERR',1].data, 
+                              dq=(~ok)*1, detect_thresh=threshold, 
+                              npixels=8, wcs=None, root=root,
+                              verbose=False)
+        
+        # photutils centroids are zero-indexed
+        return np.array([cat['x_flt']+1, cat['y_flt']+1]).T
+        
+    sew = sewpy.SEW(params=["X_IMAGE", "Y_IMAGE", "X_WORLD", "Y_WORLD",
+                            "FLUX_RADIUS(3)", "FLAGS"],
+                    config={"DETECT_THRESH":threshold, "DETECT_MINAREA":8,
+                            "PHOT_FLUXFRAC":"0.3, 0.5, 0.8",
+                            "WEIGHT_TYPE":"MAP_RMS",
+                            "WEIGHT_IMAGE":"{0}_xrms.fits".format(root)})
+    
+    pyfits.writeto('{0}_xsci.fits'.format(root), data=sci,
+                   header=im['SCI',1].header,
+                   clobber=True)
+    
+    pyfits.writeto('{0}_xrms.fits'.format(root), data=im['ERR',1].data,
+                   header=im['ERR',1].header, clobber=True)
+    
+    output = sew('{0}_xsci.fits'.format(root))        
+    
+    for ext in ['xsci', 'xrms']:
+        os.remove('{0}_{1}.fits'.format(root, ext))
+    
+    return np.array([output['table']['X_IMAGE'], 
+                     output['table']['Y_IMAGE']]).T
+    
+def tweak_flt(files=[], max_dist=0.4, threshold=3, verbose=True, 
+              method='sextractor', cpu_count=1):
     """TBD
     
     Refine shifts of FLT files
+    
+    Parameters
+    ----------
+    files : list
+        FLT filenames.  The shifts are computed relative to the first.
+    
+    max_dist : float
+        Maximum match distance, pixels.
+    
+    threshold : float
+        Source detection threshold, in sigma.
+    
+    verbose : bool
+        Print status messages.
+    
+    method : 'sextractor', 'photutils'
+        Source extraction method, see `_tweak_flt_catalog`.  With 
+        'photutils', the sources are detected in memory without writing
+        temporary files.
+    
+    cpu_count : int
+        Number of processes used for the source extraction with 
+        `method='photutils'`.  If <= 0, use `mp.cpu_count()`.
+    
+    Returns
+    -------
+    wcs_ref : `~astropy.wcs.WCS`
+        WCS of the reference (first) exposure.
+    
+    d : `~collections.OrderedDict`
+        Shifts of each exposure, [dx, dy, rot, scale, N, rms].
     """
     
+    if method not in ['sextractor', 'photutils']:
+        raise ValueError("method must be 'sextractor' or 'photutils'")
+    
+    if cpu_count <= 0:
+        cpu_count = mp.cpu_count()
+    
+    cpu_count = int(np.minimum(cpu_count, len(files)))
+    
     ### Make FLT catalogs
-    cats = []
-    for i, file in enumerate(files):
-        root = file.split('.fits')[0]
-
-        sew = sewpy.SEW(params=["X_IMAGE", "Y_IMAGE", "X_WORLD", "Y_WORLD",
-                                "FLUX_RADIUS(3)", "FLAGS"],
-                        config={"DETECT_THRESH":threshold, "DETECT_MINAREA":8,
-                                "PHOT_FLUXFRAC":"0.3, 0.5, 0.8",
-                                "WEIGHT_TYPE":"MAP_RMS",
-                                "WEIGHT_IMAGE":"{0}_xrms.fits".format(root)})
-        
-        im = pyfits.open(file)
-        ok = im['DQ',1].data == 0
-        sci = im['SCI',1].data*ok - np.median(im['SCI',1].data[ok])
-        
-        pyfits.writeto('{0}_xsci.fits'.format(root), data=sci,
-                       header=im['SCI',1].header,
-                       clobber=True)
+    if (method == 'photutils') & (cpu_count > 1):
+        pool = mp.Pool(processes=cpu_count)
+        results = [pool.apply_async(_tweak_flt_catalog, 
+                                    (file, threshold, method))
+                   for file in files]
         
-        pyfits.writeto('{0}_xrms.fits'.format(root), data=im['ERR',1].data,
-                       header=im['ERR',1].header, clobber=True)
-        
-        output = sew('{0}_xsci.fits'.format(root))        
+        pool.close()
+        pool.join()
         
+        xys = [res.get() for res in results]
+    else:
+        xys = [_tweak_flt_catalog(file, threshold=threshold, method=method)
+               for file in files]
+    
+    cats = []
+    for file, xy in zip(files, xys):
+        im = pyfits.open(file)
         if '_flc' in file:
             wcs = pywcs.WCS(im['SCI',1].header, fobj=im, relax=True)
         else:
             wcs = pywcs.WCS(im['SCI',1].header, relax=True)
             
-        cats.append([output['table'], wcs])
+        cats.append([xy, wcs])
         
-        for ext in ['xsci', 'xrms']:
-            os.remove('{0}_{1}.fits'.format(root, ext))
-            
-    c0 = cats[0][0]
+    xy_0 = cats[0][0]
     wcs_0 = cats[0][1]
-    xy_0 = np.array([c0['X_IMAGE'], c0['Y_IMAGE']]).T
     tree = scipy.spatial.cKDTree(xy_0, 10)
     
     d = OrderedDict()
     for i in range(0, len(files)):
-        c_i, wcs_i = cats[i]
+        xy_i, wcs_i = cats[i]
         ## SExtractor doesn't do SIP WCS?
-        rd = np.array(wcs_i.all_pix2world(c_i['X_IMAGE'], c_i['Y_IMAGE'], 1))
+        rd = np.array(wcs_i.all_pix2world(xy_i[:,0], xy_i[:,1], 1))
         xy = np.array(wcs_0.all_world2pix(rd.T, 1))
-        N = xy.shape[0]
-        dist, ix = np.zeros(N), np.zeros(N, dtype=int)
-        for j in range(N):
-            dist[j], ix[j] = tree.query(xy[j,:], k=1,
-                                        distance_upper_bound=np.inf)
+        dist, ix = tree.query(xy, k=1, distance_upper_bound=np.inf)
         
         ok = dist < max_dist
         if ok.sum() == 0:
@@ -2146,13 +2845,111 @@ def align_multiple_drizzled(mag_limits=[16,23]):
         imt = pyfits.open('total_drz_sci.fits')
 
         
-def visit_grism_sky(grism={}, apply=True, column_average=True, verbose=True, ext=1, sky_iter=10):
+def _read_grism_sky_exposure(file, ext=1, bits=576, isACS=False):
+    """Read the arrays of a single exposure needed by `visit_grism_sky`
+    
+    Parameters
+    ----------
+    file : str
+        FLT filename.
+    
+    ext : int
+        SCI/ERR/DQ extension version.
+    
+    bits : int
+        DQ bits to ignore.
+    
+    isACS : bool
+        Normalize the exposure by EXPTIME.
+    
+    Returns
+    -------
+    data, wht : `~numpy.ndarray`
+        Flattened science and inverse variance arrays.  Pixels with 
+        non-zero DQ (other than `bits`) are set to zero.
+    
+    dq_mask : `~numpy.ndarray`
+        Flattened boolean mask of valid pixels.
+    
+    exptime : float
+        Exposure time, or 1 for WFC3.
+    
+    median : float
+        Median of the valid pixels.
+        
+    """
+    flt = pyfits.open(file)
+    dq = utils.unset_dq_bits(flt['DQ',ext].data, okbits=bits)
+    dq_mask = dq == 0
+    
+    data = np.cast[float]((flt['SCI',ext].data*dq_mask).flatten())
+    with np.errstate(divide='ignore'):
+        wht = np.cast[float](1./(flt['ERR',ext].data**2*dq_mask).flatten())
+    
+    wht[~np.isfinite(wht)] = 0.
+    
+    if isACS:
+        exptime = flt[0].header['EXPTIME']
+        data /= exptime
+        wht *= exptime**2
+        median = np.median(flt['SCI',ext].data[dq_mask]/exptime)
+    else:
+        exptime = 1.
+        median = np.median(flt['SCI',ext].data[dq_mask])
+    
+    flt.close()
+    
+    return data, wht, dq_mask.flatten(), exptime, median
+    
+def visit_grism_sky(grism={}, apply=True, column_average=True, verbose=True, ext=1, sky_iter=10, stream=False, n_threads=1):
     """Subtract sky background from grism exposures
     
     Implementation of grism sky subtraction from ISR 2015-17    
     
-    TBD
+    The model for each exposure is a linear combination of the "fixed" sky 
+    images, with coefficients common to all exposures in the visit, and
+    the "variable" sky images, with coefficients fit separately for each 
+    exposure.  The least-squares problem is solved with the normal 
+    equations accumulated exposure by exposure, so the full design matrix
+    of the visit is never computed.
+    
+    Parameters
+    ----------
+    grism : dict
+        Visit information from `~grizli.utils.parse_flt_files`.
+    
+    apply : bool
+        Subtract the sky from the FLT files and write header keywords.
+    
+    column_average : bool
+        Fit and subtract the residual column average (WFC3/IR only).
+    
+    verbose : bool
+        Print status messages.
+    
+    ext : int
+        Extension version to process (ACS/UVIS chips).
+    
+    sky_iter : int
+        Number of iterations of the object mask.
+    
+    stream : bool
+        Re-read the exposures from disk for each iteration rather than 
+        keeping them in memory, so that the memory usage scales with the
+        size of a single exposure (per thread) rather than the size of the 
+        full visit.
+    
+    n_threads : int
+        Number of threads used to read, mask and write the exposures, 
+        which mostly run in parallel since the FITS I/O and the 
+        `~scipy.ndimage` filters release the GIL.  If <= 0, use 
+        `mp.cpu_count()`.  The results don't depend on `n_threads`.
     
+    Returns
+    -------
+    isACS : bool
+        True for ACS/UVIS.
+        
     """
     
     ### Figure out which grism 
@@ -2207,8 +3004,6 @@ def visit_grism_sky(grism={}, apply=True, column_average=True, verbose=True, ext
         data_vary.append(im[0].data.flatten()*1)
         sh = im[0].data.shape
         
-    yp, xp = np.indices(sh)
-    
     ### Hard-coded (1014,1014) WFC3/IR images
     Npix = sh[0]*sh[1]
     Nexp = len(grism['files'])
@@ -2216,135 +3011,209 @@ def visit_grism_sky(grism={}, apply=True, column_average=True, verbose=True, ext
     Nvary = len(data_vary)
     Nimg = Nexp*Nvary + Nfix
     
-    A = np.zeros((Npix*Nexp, Nimg))
-    data = np.zeros(Npix*Nexp)
-    wht = data*0.    
-    mask = data > -1
-    medians = np.zeros(Nexp)
-    exptime = np.ones(Nexp)
+    ### Sky images and the pixels where they're all valid
+    bg_images = np.array(data_fixed + data_vary)
+    bg_mask = np.isfinite(bg_images).sum(axis=0) == (Nfix+Nvary)
+    for j in range(Nfix):
+        bg_mask &= data_fixed[j] > 0
+    
+    def coeff_index(i):
+        """
+        Indices of the coefficients of exposure `i` in the full array
+        """
+        return np.hstack((np.arange(Nfix), Nfix+Nvary*i+np.arange(Nvary)))
     
-    ### Build combined arrays
     if isACS:
         bits = 64+32
     else:
         bits = 576
     
-    for i in range(Nexp):
-        flt = pyfits.open(grism['files'][i])
-        dq = utils.unset_dq_bits(flt['DQ',ext].data, okbits=bits)
-        dq_mask = dq == 0
+    if n_threads <= 0:
+        n_threads = mp.cpu_count()
+    
+    n_threads = int(np.minimum(n_threads, Nexp))
+    
+    def read_exposure(i):
+        """
+        Read exposure `i` and apply the sky image mask
+        """
+        out = _read_grism_sky_exposure(grism['files'][i], ext=ext, 
+                                       bits=bits, isACS=isACS)
         
-        ## Data
-        data[i*Npix:(i+1)*Npix] = (flt['SCI',ext].data*dq_mask).flatten()
-        mask[i*Npix:(i+1)*Npix] &= dq_mask.flatten() #== 0
-        wht[i*Npix:(i+1)*Npix] = 1./(flt['ERR',ext].data**2*dq_mask).flatten()
-        wht[~np.isfinite(wht)] = 0.
+        return (out[0], out[1], out[2] & bg_mask) + out[3:]
+    
+    def read_exposure_stats(i):
+        """
+        Exposure time and median of exposure `i`, without keeping the arrays
+        """
+        return read_exposure(i)[3:]
         
-        if isACS:
-            exptime[i] = flt[0].header['EXPTIME']
-            data[i*Npix:(i+1)*Npix] /= exptime[i]
-            wht[i*Npix:(i+1)*Npix] *= exptime[i]**2
-
-            medians[i] = np.median(flt['SCI',ext].data[dq_mask]/exptime[i])
+    if n_threads > 1:
+        pool = ThreadPool(processes=n_threads)
+        map_exposures = pool.map
+    else:
+        pool = None
+        map_exposures = lambda func, items: [func(item) for item in items]
+    
+    ### Make sure that the threads are closed if the fit fails
+    try:
+        ### Read the exposures
+        if stream:
+            exp_stats = map_exposures(read_exposure_stats, range(Nexp))
+            arrays = None
         else:
-            medians[i] = np.median(flt['SCI',ext].data[dq_mask])
-            
-        ## Fixed arrays      
-        for j in range(Nfix):
-            for k in range(Nexp):
-                A[k*Npix:(k+1)*Npix,j] = data_fixed[j]
-            
-            mask_j = (data_fixed[j] > 0) & np.isfinite(data_fixed[j])
-            mask[i*Npix:(i+1)*Npix] &= mask_j
-        
-        ## Variable arrays    
-        for j in range(Nvary):
-            k = Nfix+j+Nvary*i
-            A[i*Npix:(i+1)*Npix,k] = data_vary[j]
-            mask[i*Npix:(i+1)*Npix] &= np.isfinite(data_vary[j])
-                
-    ### Initial coeffs based on image medians
-    coeffs = np.array([np.min(medians)])
-    if Nvary > 0:
-        coeffs = np.hstack((coeffs, np.zeros(Nexp*Nvary)))
-        coeffs[1::Nvary] = medians-medians.min()
-        
-    model = np.dot(A, coeffs)
-    
-    for iter in range(sky_iter):
-        model = np.dot(A, coeffs)
-        resid = (data-model)*np.sqrt(wht)
-        obj_mask = (resid < 2.5) & (resid > -3)
-        for j in range(Nexp):
-            obj_j = nd.minimum_filter(obj_mask[j*Npix:(j+1)*Npix], size=30)
-            obj_mask[j*Npix:(j+1)*Npix] = (obj_j > 0).flatten()
-        
-        if False:
-            j = 1
-            mask_i = (obj_mask & mask)[j*Npix:(j+1)*Npix].reshape(sh)
-            r_i = (data-model)[j*Npix:(j+1)*Npix].reshape(sh)
-            ds9.view(r_i * mask_i)
+            exposures = map_exposures(read_exposure, range(Nexp))
+            exp_stats = [exp[3:] for exp in exposures]
+            arrays = [exp[:3] for exp in exposures]
+            del(exposures)
+    
+        exptime = np.array([st[0] for st in exp_stats])
+        medians = np.array([st[1] for st in exp_stats])
+    
+        def exposure_arrays(i):
+            """
+            (data, wht, mask) arrays of exposure `i`
+            """
+            if stream:
+                return read_exposure(i)[:3]
+            else:
+                return arrays[i]
+    
+        def normal_equations(i):
+            """
+            Object mask and normal equations of exposure `i`
+            """
+            data_i, wht_i, mask_i = exposure_arrays(i)
+        
+            ix = coeff_index(i)
+            model_i = np.dot(coeffs[ix], bg_images)
+            resid = (data_i-model_i)*np.sqrt(wht_i)
+            obj_i = (resid < 2.5) & (resid > -3)
+            obj_i = nd.minimum_filter(obj_i, size=30) > 0
+        
+            ok = mask_i & obj_i
+            A_i = bg_images[:,ok]
+        
+            return ok, obj_i.sum(), np.dot(A_i, A_i.T), np.dot(A_i, data_i[ok])
+        
+        ### Initial coeffs based on image medians
+        coeffs = np.array([np.min(medians)])
+        if Nvary > 0:
+            coeffs = np.hstack((coeffs, np.zeros(Nexp*Nvary)))
+            coeffs[1::Nvary] = medians-medians.min()
+    
+        for iter in range(sky_iter):
+            # Normal equations, summed in order so that the result doesn't
+            # depend on the number of threads
+            ATA = np.zeros((Nimg, Nimg))
+            ATy = np.zeros(Nimg)
+            obj_masks = []
+            Nobj = 0
+        
+            for i, res in enumerate(map_exposures(normal_equations, range(Nexp))):
+                ix = coeff_index(i)
+                obj_masks.append(res[0])
+                Nobj += res[1]
+                ATA[np.ix_(ix, ix)] += res[2]
+                ATy[ix] += res[3]
         
-        if verbose:
-            logging.info('   {0} > Iter: {1:d}, masked: {2:d}, {3}'.format(grism['product'], iter+1, obj_mask.sum(), coeffs))
-                                                
-        out = np.linalg.lstsq(A[mask & obj_mask,:], data[mask & obj_mask])
-        coeffs = out[0]
-            
-    ### Best-fit sky
-    sky = np.dot(A, coeffs).reshape(Nexp, Npix)
+            if verbose:
+                logging.info('   {0} > Iter: {1:d}, masked: {2:d}, {3}'.format(grism['product'], iter+1, Nobj, coeffs))
         
-    ## log file
-    fp = open('{0}_{1}_sky_background.info'.format(grism['product'],ext), 'w')
-    fp.write('# file c1 {0}\n'.format(' '.join(['c{0:d}'.format(v+2) 
-                                            for v in range(Nvary)])))
+            coeffs = np.linalg.lstsq(ATA, ATy, rcond=None)[0]
     
-    fp.write('# {0}\n'.format(grism['product']))
+        ### Best-fit sky
+        def sky_model(i):
+            """
+            Sky model of exposure `i`
+            """
+            return np.dot(coeffs[coeff_index(i)], bg_images)
     
-    fp.write('# bg1: {0}\n'.format(bg_fixed[0]))
-    for v in range(Nvary):
-        fp.write('# bg{0:d}: {1}\n'.format(v+2, bg_vary[v]))
+        ## log file
+        fp = open('{0}_{1}_sky_background.info'.format(grism['product'],ext), 'w')
+        fp.write('# file c1 {0}\n'.format(' '.join(['c{0:d}'.format(v+2) 
+                                                for v in range(Nvary)])))
     
-    for j in range(Nexp):
-        file = grism['files'][j]
-        line = '{0} {1:9.4f}'.format(file, coeffs[0])           
+        fp.write('# {0}\n'.format(grism['product']))
+    
+        fp.write('# bg1: {0}\n'.format(bg_fixed[0]))
         for v in range(Nvary):
-            k = Nfix + j*Nvary + v
-            line = '{0} {1:9.4f}'.format(line, coeffs[k])
+            fp.write('# bg{0:d}: {1}\n'.format(v+2, bg_vary[v]))
+    
+        for j in range(Nexp):
+            file = grism['files'][j]
+            line = '{0} {1:9.4f}'.format(file, coeffs[0])           
+            for v in range(Nvary):
+                k = Nfix + j*Nvary + v
+                line = '{0} {1:9.4f}'.format(line, coeffs[k])
         
-        fp.write(line+'\n')
+            fp.write(line+'\n')
     
-    fp.close()
+        fp.close()
     
-    if apply:
-        for j in range(Nexp):
+        def apply_sky(j):
+            """
+            Subtract the sky from exposure `j` and set the header keywords
+            """
             file = grism['files'][j]
-            
+        
             flt = pyfits.open(file, mode='update')
-            flt['SCI',ext].data -= sky[j,:].reshape(sh)*exptime[j]
-                
+            flt['SCI',ext].data -= sky_model(j).reshape(sh)*exptime[j]
+            
             header = flt[0].header
             header['GSKYCOL{0:d}'.format(ext)] = (False, 'Subtract column average')
             header['GSKYN{0:d}'.format(ext)] = (Nfix+Nvary, 'Number of sky images')
             header['GSKY{0:d}01'.format(ext)] = (coeffs[0], 
                                 'Sky image {0} (fixed)'.format(bg_fixed[0]))
-            
+        
             header['GSKY{0:d}01F'.format(ext)] = (bg_fixed[0], 'Sky image (fixed)')
+        
             
-                
             for v in range(Nvary):
                 k = Nfix + j*Nvary + v
                 #print coeffs[k]
                 header['GSKY{0}{1:02d}'.format(ext, v+Nfix+1)] = (coeffs[k], 
                                 'Sky image {0} (variable)'.format(bg_vary[v]))
-                
+            
                 header['GSKY{0}{1:02d}F'.format(ext, v+Nfix+1)] = (bg_vary[v], 
                                                       'Sky image (variable)')
-                
+            
             flt.flush()
+            flt.close()
+        
+        im_shape = (1014,1014)
+    
+        def column_statistics(j):
+            """
+            Median and uncertainty of the column averages of the residuals of
+            exposure `j`
+            """
+            data_j = exposure_arrays(j)[0]
+            resid = (data_j - sky_model(j)).reshape(im_shape)
+            m = obj_masks[j].reshape(im_shape)
+        
+            ## Statistics of masked arrays    
+            ma = np.ma.masked_array(resid, mask=(~m))
+            med = np.ma.median(ma, axis=0)
+            yrms = np.ma.std(ma, axis=0)/np.sqrt(np.sum(m, axis=0))
+            return med, yrms
     
-    ### Don't do `column_average` for ACS
-    if (not column_average) | isACS:
+        ### Don't do `column_average` for ACS
+        fit_columns = column_average & (not isACS)
+    
+        ### Residual column statistics, computed before the sky is subtracted 
+        ### from the files that are re-read with `stream`
+        if fit_columns:
+            column_stats = map_exposures(column_statistics, range(Nexp))
+        
+        if apply:
+            map_exposures(apply_sky, range(Nexp))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    if not fit_columns:
         return isACS
         
     ######
@@ -2355,18 +3224,10 @@ def visit_grism_sky(grism={}, apply=True, column_average=True, verbose=True, ext
     fig = plt.figure(figsize=[6.,6.])
     ax = fig.add_subplot(111)
     
-    im_shape = (1014,1014)
-    
     for j in range(Nexp):
-        resid = (data[j*Npix:(j+1)*Npix] - sky[j,:]).reshape(im_shape)
-        m = (mask & obj_mask)[j*Npix:(j+1)*Npix].reshape(im_shape)
+        med, yrms = column_stats[j]
         
-        ## Statistics of masked arrays    
-        ma = np.ma.masked_array(resid, mask=(~m))
-        med = np.ma.median(ma, axis=0)
-    
         bg_sky = 1
-        yrms = np.ma.std(ma, axis=0)/np.sqrt(np.sum(m, axis=0))
         xmsk = np.arange(im_shape[0])
         yres = med
         yok = (~yrms.mask) & np.isfinite(yrms) & np.isfinite(xmsk) & np.isfinite(yres)
@@ -2427,7 +3288,7 @@ def visit_grism_sky(grism={}, apply=True, column_average=True, verbose=True, ext
     plt.close()
     
     ## Clean up large arrays
-    del(data); del(A); del(wht); del(mask); del(model)
+    del(arrays); del(obj_masks); del(bg_images)
     
     if interactive_status:
         plt.ion()
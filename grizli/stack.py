@@ -541,9 +541,8 @@ class StackFitter(GroupFitter):
         for i, t in enumerate(templates):
             ti = templates[t]
             try:
-                import eazy.igm
                 if z > 7:
-                    igm = eazy.igm.Inoue14()
+                    igm = grizli.utils.get_igm_table()
                     igmz = igm.full_IGM(z, ti.wave*(1+z))         
                 else:
                     igmz = 1.
@@ -601,7 +600,136 @@ class StackFitter(GroupFitter):
         
         return chi2, background, full, full_coeffs, full_coeffs_err
     
-    def fit_zgrid(self, dz0=0.005, zr=[0.4, 3.4], fitter='nnls', make_plot=True, save_data=True, prior=None, templates_file='templates.npy', verbose=True, outlier_threshold=1e30, eazyp=None, ix=0, order=0, scale_fit=None):
+    def fit_zgrid_batch(self, zgrid, templates=None, fitter='nnls', max_memory=2**26, verbose=False):
+        """Fit templates on a redshift grid with batched model evaluation
+        
+        Since the models of `~grizli.stack.StackedSpectrum` are linear in 
+        the 1D spectra, the template models for a chunk of redshifts are 
+        computed together with 
+        `~grizli.stack.StackedSpectrum.apply_kernel` and the normal 
+        equations of all of the fits in the chunk are computed with a single
+        batched matrix product.  The results are the same as for 
+        `fit_at_z` evaluated at each redshift of `zgrid`.
+        
+        Parameters
+        ----------
+        zgrid : array-like
+            Redshift grid.
+        
+        templates : `~collections.OrderedDict`
+            Templates to fit, e.g., from `make_templates`.
+        
+        fitter : str
+            Minimization algorithm, 'nnls' or 'lstsq', see `fit_at_z`.
+        
+        max_memory : int
+            Approximate memory limit, in bytes, of the design matrices of 
+            a chunk of redshifts.  The full and masked design matrices of 
+            the chunk are held in memory at the same time.
+        
+        verbose : bool
+            Print the chi-squared at each redshift.
+            
+        Returns
+        -------
+        chi2 : `~np.ndarray`
+            Chi-squared of the fits, shape `(NZ,)`.
+        
+        coeffs : `~np.ndarray`
+            Template coefficients, shape `(NZ, NTEMP)`.
+        
+        """
+        if templates is None:
+            raise ValueError('No templates specified')
+            
+        zgrid = np.atleast_1d(zgrid)
+        NZ = len(zgrid)
+        NTEMP = len(templates)
+        NA = self.N+NTEMP
+        
+        # Number of redshifts per chunk, full and masked design matrices
+        zchunk = int(np.clip(max_memory // (2*8*NA*self.Ntot), 1, NZ))
+        
+        pedestal = 0.04
+        data = ((self.scif+pedestal)*self.sivarf)[self.fit_mask]
+        
+        clips = [E.ivar.sum(axis=0) > 0 for E in self.beams]
+        keys = list(templates.keys())
+        
+        chi2 = np.zeros(NZ)
+        full_coeffs = np.zeros((NZ, NTEMP))
+        
+        for iz0 in range(0, NZ, zchunk):
+            zi = zgrid[iz0:iz0+zchunk]
+            NZi = len(zi)
+            
+            A = np.zeros((NZi, NA, self.Ntot))
+            A[:,:self.N,:] += self.A_bg
+            
+            # 1D spectra interpolated to the wavelengths of the beams
+            for j, E in enumerate(self.beams):
+                fl = np.zeros((NZi, NTEMP, E.sh[1]))
+                for k, z in enumerate(zi):
+                    for i, t in enumerate(keys):
+                        ti = templates[t]
+                        try:
+                            if z > 7:
+                                igm = grizli.utils.get_igm_table()
+                                igmz = igm.full_IGM(z, ti.wave*(1+z))         
+                            else:
+                                igmz = 1.
+                        except:
+                            igmz = 1.
+                        
+                        s = [ti.wave*(1+z), ti.flux/(1+z)*igmz]
+                        if ((s[0][0] > E.wave[clips[j]].max()) | 
+                            (s[0][-1] < E.wave[clips[j]].min())):
+                            continue
+                    
+                        fl[k,i,:] = u.interp.interp_conserve_c(E.wave, 
+                                                               s[0], s[1])
+                
+                models = E.apply_kernel(fl.reshape((NZi*NTEMP, -1)))
+                A[:,self.N:,self.slices[j]] = models.reshape((NZi, NTEMP, -1))
+            
+            # Templates with nonzero models in the fit mask
+            oktemp_z = np.dot(A, self.fit_mask*1.) != 0
+            
+            # Batched normal equations, weight the design matrix in place 
+            # so that only its masked copy is added to the memory
+            A *= self.sivarf
+            Ax = A[:,:,self.fit_mask]
+            del(A)
+            
+            ATA = np.matmul(Ax, Ax.transpose((0,2,1)))
+            ATy = np.matmul(Ax, data)
+            
+            for k in range(NZi):
+                oktemp = oktemp_z[k]
+                AxT = Ax[k,oktemp,:].T
+                
+                out = grizli.utils.normal_equations_lstsq(AxT, data,
+                                         fitter=fitter,
+                                         ATA=ATA[k][oktemp,:][:,oktemp],
+                                         ATy=ATy[k][oktemp])
+                coeffs = out[0]
+                
+                if coeffs is None:
+                    if fitter == 'nnls':
+                        coeffs, rnorm = scipy.optimize.nnls(AxT, data)
+                    else:
+                        coeffs = np.linalg.lstsq(AxT, data, rcond=None)[0]
+                
+                chi2[iz0+k] = np.sum((data - np.dot(AxT, coeffs))**2)
+                full_coeffs[iz0+k, oktemp[self.N:]] = coeffs[self.N:]
+                
+                if verbose:
+                    logging.info('{0:.4f} - {1:10.1f}'.format(zi[k], 
+                                                             chi2[iz0+k]))
+        
+        return chi2, full_coeffs
+        
+    def fit_zgrid(self, dz0=0.005, zr=[0.4, 3.4], fitter='nnls', make_plot=True, save_data=True, prior=None, templates_file='templates.npy', verbose=True, outlier_threshold=1e30, eazyp=None, ix=0, order=0, scale_fit=None, batch=False, max_memory=2**26):
         """Fit templates on a redshift grid.
         
         Parameters
@@ -634,6 +762,13 @@ class StackFitter(GroupFitter):
         verbose : bool
             Print the redshift grid steps.
         
+        batch : bool
+            Evaluate the redshift grids with `fit_zgrid_batch` rather than
+            calling `fit_at_z` for each redshift.  Not used with `eazyp`.
+        
+        max_memory : int
+            Memory limit of the batched fits, see `fit_zgrid_batch`.
+            
         Returns
         -------
         hdu : `~astropy.io.fits.HDUList`
@@ -645,16 +780,23 @@ class StackFitter(GroupFitter):
         
         z = grizli.utils.log_zgrid(zr=zr, dz=dz0)
         chi2 = z*0.
-        for i in range(len(z)):
-            if eazyp:
-                out = self.fit_combined_at_z(z=z[i], eazyp=eazyp, ix=ix, order=order, scale_fit=scale_fit)
-                chi2[i], bg, full, coeffs, err, scale_fit = out            
-            else:
-                out = self.fit_at_z(z=z[i], templates=t_complex)
-                chi2[i], bg, full, coeffs, err = out
+        
+        batch &= (eazyp is None)
+        if batch:
+            chi2, coeffs = self.fit_zgrid_batch(z, templates=t_complex, 
+                                                max_memory=max_memory,
+                                                verbose=verbose)
+        else:
+            for i in range(len(z)):
+                if eazyp:
+                    out = self.fit_combined_at_z(z=z[i], eazyp=eazyp, ix=ix, order=order, scale_fit=scale_fit)
+                    chi2[i], bg, full, coeffs, err, scale_fit = out            
+                else:
+                    out = self.fit_at_z(z=z[i], templates=t_complex)
+                    chi2[i], bg, full, coeffs, err = out
             
-            if verbose:
-                logging.info('{0:.4f} - {1:10.1f}'.format(z[i], chi2[i]))
+                if verbose:
+                    logging.info('{0:.4f} - {1:10.1f}'.format(z[i], chi2[i]))
         
         # Zoom in on the chi-sq minimum.
         ci = chi2
@@ -671,22 +813,29 @@ class StackFitter(GroupFitter):
             dz = dz0/2.02**iter
             zi = grizli.utils.log_zgrid(zr=[z0-dz*4, z0+dz*4], dz=dz)
             ci = zi*0.
-            for i in range(len(zi)):
+            
+            if batch:
+                ci, coeffs = self.fit_zgrid_batch(zi, templates=t_complex,
+                                                  fitter=fitter,
+                                                  max_memory=max_memory,
+                                                  verbose=verbose)
+            else:
+                for i in range(len(zi)):
                 
-                if eazyp:
-                    out = self.fit_combined_at_z(z=zi[i], eazyp=eazyp, ix=ix, order=order, scale_fit=scale_fit)
-                    ci[i], bg, full, coeffs, err, scale_fit = out            
-                else:
-                    out = self.fit_at_z(z=zi[i], templates=t_complex, fitter=fitter)
-                    ci[i], bg, full, coeffs, err = out
+                    if eazyp:
+                        out = self.fit_combined_at_z(z=zi[i], eazyp=eazyp, ix=ix, order=order, scale_fit=scale_fit)
+                        ci[i], bg, full, coeffs, err, scale_fit = out            
+                    else:
+                        out = self.fit_at_z(z=zi[i], templates=t_complex, fitter=fitter)
+                        ci[i], bg, full, coeffs, err = out
                 
-                # out = self.fit_at_z(z=zi[i], templates=t_complex,
-                #                     fitter=fitter)
-                # 
-                # ci[i], bg, full, coeffs, err = out
+                    # out = self.fit_at_z(z=zi[i], templates=t_complex,
+                    #                     fitter=fitter)
+                    # 
+                    # ci[i], bg, full, coeffs, err = out
                 
-                if verbose:
-                    logging.info('{0:.4f} - {1:10.1f}'.format(zi[i], ci[i]))
+                    if verbose:
+                        logging.info('{0:.4f} - {1:10.1f}'.format(zi[i], ci[i]))
             
             z = np.append(z, zi)
             chi2 = np.append(chi2, ci)
@@ -1195,22 +1344,11 @@ class StackedSpectrum(object):
     def _build_model(self):
         """
         Initiazize components for generating 2D model
-        """
-        NY = self.sh[0]
-        data = np.zeros((self.header['NAXIS1'], self.header['NAXIS2'], self.header['NAXIS1']))
-                                            
-        for j in range(NY//2):
-            data[j,:,:j+NY//2] += self.kernel[:, -NY//2-j:]
-        
-        for j in range(self.sh[1]-NY//2, self.sh[1]):
-            data[j,:,-NY//2+j:] += self.kernel[:, :self.sh[1]-j+NY//2]
-        
-        for j in range(NY//2, self.sh[1]-NY//2):
-            #logging.info(j)
-            data[j,:,j-NY//2:j+NY//2] += self.kernel
-                
-        self.fit_data = data.reshape(self.sh[1],-1)
         
+        The 2D model is the 1D spectrum (times the sensitivity for spectra
+        not in f-lambda units) convolved along the wavelength axis with the 
+        spatial kernel, see `apply_kernel`.
+        """
         if not self.is_flambda:
             sens = u.interp.interp_conserve_c(self.wave, 
                                 self.conf.sens[self.beam_name]['WAVELENGTH'],
@@ -1237,8 +1375,54 @@ class StackedSpectrum(object):
                 sens *= scale
                 
             self.sens = sens*dlam #*1.e-17
-            self.fit_data = (self.fit_data.T*self.sens).T
-            
+    
+    def apply_kernel(self, fl):
+        """
+        Convolve 1D spectra evaluated at `wave` with the spatial kernel
+        
+        For every row `y` of the 2D spectrum,
+        
+            >>> model[y,x] = sum_k kernel[y,k] * fl[x-k+NY//2]
+        
+        which is computed as a matrix product of the kernel with a sliding
+        window view of the (zero-padded) spectra, so the memory scales as 
+        `NAXIS1*NAXIS2` and the time as `NAXIS1*NAXIS2*NKERNEL`.
+        
+        Parameters
+        ----------
+        fl : array-like
+            1D spectrum with shape `(NAXIS1,)` or several spectra with shape
+            `(NSPEC, NAXIS1)`.
+        
+        Returns
+        -------
+        model : `~numpy.ndarray`
+            Flattened 2D model(s) with shape `(NSPEC, NAXIS1*NAXIS2)`.
+        """
+        fl = np.atleast_2d(fl)
+        if not self.is_flambda:
+            fl = fl*self.sens
+        
+        NSPEC = fl.shape[0]
+        NY, NX = self.sh
+        NK = self.kernel.shape[1]
+        
+        # Zero-padded spectra, padded[:,x+NK-1-k] = fl[:,x+NY//2-k]
+        off = NK-1-NY//2
+        padded = np.zeros((NSPEC, NX+NK-1+max(-off, 0)))
+        x0 = max(off, 0)
+        x1 = min(NX+off, NX+NK-1)
+        padded[:,x0:x1] = fl[:,x0-off:x1-off]
+        
+        # windows[:,x,m] = padded[:,x+m]
+        st = padded.strides
+        windows = np.lib.stride_tricks.as_strided(padded, 
+                                                  shape=(NSPEC, NX, NK),
+                                                  strides=(st[0], st[1], st[1]))
+        
+        model = np.matmul(windows, self.kernel[:,::-1].T)
+        return model.transpose((0,2,1)).reshape((NSPEC, -1))
+        
     def compute_model(self, spectrum_1d=None, is_cgs=None, in_place=False):
         """
         Generate the model spectrum
@@ -1250,7 +1434,7 @@ class StackedSpectrum(object):
         else:
             fl = u.interp.interp_conserve_c(self.wave, spectrum_1d[0], spectrum_1d[1])
             
-        model = np.dot(fl, self.fit_data)#.reshape(self.sh)
+        model = self.apply_kernel(fl)[0]#.reshape(self.sh)
         #self.model = model
         return model
         
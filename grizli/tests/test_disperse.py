@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+from ..utils_c import disperse
+
+class Dummy(unittest.TestCase):  
+    def _get_inputs(self, seed=1):
+        rng = np.random.RandomState(seed)
+        
+        sh = np.array([41, 41])
+        x0 = sh // 2
+        
+        flam = np.cast[np.float32](rng.rand(*sh))
+        flam[rng.rand(*sh) > 0.8] = 0
+        
+        segm = np.ones(sh, dtype=np.float32)*2
+        segm[:5,:] = 1
+        
+        NX = 120
+        shg = np.array([sh[0], sh[1]+NX])
+        ytrace = 0.5*np.sin(np.arange(NX)/30.)+0.3
+        dyc = np.cast[int](ytrace+20)-20+1
+        idx = np.arange(shg[0]*shg[1]).reshape(shg)
+        flat_index = idx[dyc+x0[0], np.arange(NX)+x0[1]]
+        yfrac = ytrace - np.floor(ytrace)
+        ysens = rng.rand(NX)
+        
+        return flam, segm, flat_index, yfrac, ysens, x0, sh, shg
+        
+    @unittest.skipIf(not hasattr(disperse, 'disperse_grism_object_parallel'),
+                     'disperse extension built without the parallel kernel')
+    def test_disperse_parallel(self):
+        flam, segm, flat_index, yfrac, ysens, x0, sh, shg = self._get_inputs()
+        
+        full = np.zeros(shg[0]*shg[1])
+        disperse.disperse_grism_object(flam, segm, 2, flat_index, yfrac, 
+                                       ysens, full, x0, sh, x0, shg)
+        
+        for num_threads in [1, 2, 4]:
+            full_par = np.zeros(shg[0]*shg[1])
+            disperse.disperse_grism_object_parallel(flam, segm, 2, 
+                                       flat_index, yfrac, ysens, full_par, 
+                                       x0, sh, x0, shg, 
+                                       num_threads=num_threads)
+            
+            np.testing.assert_allclose(full_par, full, rtol=1e-10, 
+                                       atol=1e-12*full.max())
+    
+    @unittest.skipIf(not hasattr(disperse, 'disperse_grism_object_multi'),
+                     'disperse extension built without the batched kernel')
+    def test_disperse_multi(self):
+        flam, segm, flat_index, yfrac, ysens, x0, sh, shg = self._get_inputs()
+        
+        spec_scale = np.array([1., 0.5, 2.])
+        ysens_multi = ysens[None,:]*spec_scale[:,None]
+        
+        full = np.zeros((len(spec_scale), shg[0]*shg[1]))
+        disperse.disperse_grism_object_multi(flam, segm, 2, flat_index, 
+                                   yfrac, ysens_multi, full, x0, sh, x0, shg)
+        
+        for i in range(len(spec_scale)):
+            full_i = np.zeros(shg[0]*shg[1])
+            disperse.disperse_grism_object(flam, segm, 2, flat_index, yfrac, 
+                                   ysens_multi[i,:], full_i, x0, sh, x0, shg)
+            
+            np.testing.assert_allclose(full[i,:], full_i, rtol=1e-12)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from .. import grismconf
+
+CONF = """# Synthetic trace definitions for testing
+BEAMA -10 200
+XOFF_A 0.3 1.e-3 -2.e-3
+YOFF_A -1.2 2.e-4 1.e-4
+DYDX_A_0 0.5 1.e-3 2.e-3
+DYDX_A_1 0.02 1.e-5 -3.e-5
+DLDP_A_0 8950. 0.1 0.05
+DLDP_A_1 44.9 1.e-3 2.e-3
+BEAMB -10 200
+XOFF_B 0.3 1.e-3 -2.e-3
+YOFF_B -1.2 2.e-4 1.e-4
+DYDX_B_0 0.5 1.e-3 2.e-3
+DYDX_B_1 0.02 1.e-5 -3.e-5
+DYDX_B_2 1.e-4 1.e-7 2.e-7
+DLDP_B_0 8950. 0.1 0.05
+DLDP_B_1 44.9 1.e-3 2.e-3
+DLDP_B_2 1.e-3 1.e-6 1.e-6
+BEAMC -10 200
+XOFF_C 0.3 1.e-3 -2.e-3
+YOFF_C -1.2 2.e-4 1.e-4
+DYDX_C_0 0.5 1.e-3 2.e-3
+DYDX_C_1 0.02 1.e-5 -3.e-5
+DYDX_C_2 1.e-4 1.e-7 2.e-7
+DYDX_C_3 1.e-7 1.e-10 2.e-10
+DLDP_C_0 8950. 0.1 0.05
+DLDP_C_1 44.9 1.e-3 2.e-3
+DLDP_C_2 1.e-3 1.e-6 1.e-6
+DLDP_C_3 0. 0. 0.
+"""
+
+class Dummy(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.conf_file = os.path.join(self.path, 'test.conf')
+        with open(self.conf_file, 'w') as fp:
+            fp.write(CONF)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_beam_traces(self):
+        conf = grismconf.aXeConf(self.conf_file)
+
+        np.random.seed(1)
+        x = np.random.rand(20)*1000
+        y = np.random.rand(20)*1000
+        dx = np.arange(-10, 200)+0.3
+
+        # Linear, quadratic and numerically-integrated traces
+        for beam in ['A', 'B', 'C']:
+            dy, lam = conf.get_beam_traces(x=x, y=y, dx=dx, beam=beam)
+            self.assertEqual(dy.shape, (len(x), len(dx)))
+
+            for i in range(len(x)):
+                dy_i, lam_i = conf.get_beam_trace(x=x[i], y=y[i], dx=dx,
+                                                  beam=beam)
+
+                np.testing.assert_allclose(dy[i,:], dy_i, rtol=1e-12)
+                np.testing.assert_allclose(lam[i,:], lam_i, rtol=1e-12)
+
+    def test_compiled_beams(self):
+        conf = grismconf.aXeConf(self.conf_file)
+        dy, lam = conf.get_beam_trace(x=500, y=500, dx=np.arange(100),
+                                      beam='B')
+
+        # Replace trace parameters after the beam has been compiled
+        conf.conf['DLDP_B_0'] = conf.conf['DLDP_B_0']+np.array([100,0,0])
+        dy2, lam2 = conf.get_beam_trace(x=500, y=500, dx=np.arange(100),
+                                        beam='B')
+
+        np.testing.assert_allclose(dy2, dy, rtol=1e-12)
+        np.testing.assert_allclose(lam2, lam+100, rtol=1e-12)
+
+        conf.conf['DYDX_B_1'] = conf.conf['DYDX_B_1']*2
+        dy2, lam2 = conf.get_beam_trace(x=500, y=500, dx=np.arange(100),
+                                        beam='B')
+
+        self.assertFalse(np.allclose(dy2, dy))
+
+        ref = grismconf.aXeConf(self.conf_file)
+        ref.conf['DYDX_B_1'] = ref.conf['DYDX_B_1']*2
+        ref.conf['DLDP_B_0'] = ref.conf['DLDP_B_0']+np.array([100,0,0])
+        dy_ref, lam_ref = ref.get_beam_trace(x=500, y=500, dx=np.arange(100),
+                                             beam='B')
+
+        np.testing.assert_allclose(dy2, dy_ref, rtol=1e-12)
+        np.testing.assert_allclose(lam2, lam_ref, rtol=1e-12)
@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+from .. import model
+from .test_multifit import make_test_exposures
+
+class Dummy(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.grizli_env = os.getenv('GRIZLI')
+        os.environ['GRIZLI'] = self.path
+
+        files, seg, direct = make_test_exposures(self.path, N=1)
+        self.flt = model.GrismFLT(grism_file=files[0], pad=20, verbose=False)
+        self.flt.seg[20:-20, 20:-20] = seg
+        self.flt.direct.data['SCI'][20:-20, 20:-20] = direct
+        self.flt.reset_segmentation_index()
+
+        wave = np.linspace(0.9e4, 1.9e4, 100)
+        self.spectra = [[wave, (wave/1.4e4)**p] for p in [1, -2]]
+
+    def tearDown(self):
+        if self.grizli_env is None:
+            os.environ.pop('GRIZLI')
+        else:
+            os.environ['GRIZLI'] = self.grizli_env
+
+        shutil.rmtree(self.path)
+
+    def test_disperser_store(self):
+        flt = self.flt
+
+        # Reference models updated in place with stored beams
+        for spec in self.spectra:
+            flt.compute_model_orders(id=1, compute_size=True, store=True,
+                                     spectrum_1d=spec)
+
+        ref = flt.model.copy()
+        self.assertTrue(ref.max() > 0)
+
+        flt.model *= 0
+        flt.object_dispersers = OrderedDict()
+        store = flt.set_disperser_store(max_bytes=None)
+
+        for spec in self.spectra:
+            flt.compute_model_orders(id=1, compute_size=True, store=True,
+                                     spectrum_1d=spec)
+
+        self.assertTrue(isinstance(store.data[1], OrderedDict))
+        self.assertEqual(store.stats()['compact'], 1)
+        np.testing.assert_array_equal(flt.model, ref)
+
+        # Only the spectrum stored with store=False
+        flt.compute_model_orders(id=2, compute_size=True, store=False,
+                                 spectrum_1d=self.spectra[0])
+        self.assertTrue(isinstance(store.data[2], tuple))
+
+        # Evicted beams recomputed from the stored spectrum
+        store.evict(0)
+        self.assertEqual(store.stats()['compact'], 0)
+        flt.compute_model_orders(id=1, compute_size=True, store=True,
+                                 spectrum_1d=self.spectra[1])
+
+        self.assertTrue(isinstance(store.data[1], OrderedDict))
+
+    def test_segmentation_index(self):
+        flt = self.flt
+        flt.direct.data['REF'] = flt.direct.data['SCI']*2
+        flt.reset_segmentation_index()
+
+        calls = []
+        segmentation_index = model.utils.segmentation_index
+        def counted_index(seg, flam):
+            calls.append(1)
+            return segmentation_index(seg, flam)
+
+        model.utils.segmentation_index = counted_index
+        try:
+            # One index per extension, not rebuilt when alternating
+            for i in range(3):
+                for ext in ['SCI', 'REF', None]:
+                    flt.get_segmentation_limits(1, ext=ext)
+
+            self.assertEqual(len(calls), 2)
+
+            # In-place segmentation edit
+            ref = flt.get_segmentation_limits(2, ext='SCI')
+            flt.seg[flt.seg == 2] = 0
+            out = flt.get_segmentation_limits(2, ext='SCI')
+            self.assertEqual(len(calls), 3)
+            self.assertTrue(ref[6] > 0)
+            self.assertEqual(out[6], 0)
+
+            # In-place edit of the direct image
+            flt.direct.data['REF'] *= 2
+            out = flt.get_segmentation_limits(1, ext='REF')
+            self.assertEqual(len(calls), 4)
+        finally:
+            model.utils.segmentation_index = segmentation_index
+
+        full = model.disperse.compute_segmentation_limits(flt.seg, 1,
+                                                  flt.direct.data['REF'],
+                                                  flt.direct.sh)
+        np.testing.assert_allclose(out, full)
+
+    def test_trace_cache_conf(self):
+        flt = self.flt
+        model.TRACE_CACHE.clear()
+
+        def dispersed_model():
+            flt.model *= 0
+            flt.object_dispersers = OrderedDict()
+            flt.compute_model_orders(id=1, compute_size=True, store=False,
+                                     spectrum_1d=self.spectra[0])
+            return flt.model.copy()
+
+        def uncached_model():
+            trace_cache = model.TRACE_CACHE
+            model.TRACE_CACHE = None
+            try:
+                return dispersed_model()
+            finally:
+                model.TRACE_CACHE = trace_cache
+
+        ref = dispersed_model()
+        np.testing.assert_array_equal(dispersed_model(), ref)
+        self.assertTrue(model.TRACE_CACHE.stats()['hits'] > 0)
+
+        # Replaced trace parameter
+        flt.conf.conf['DYDX_A_1'] = flt.conf.conf['DYDX_A_1']*2
+        out = dispersed_model()
+        self.assertFalse(np.allclose(out, ref))
+        np.testing.assert_array_equal(out, uncached_model())
+
+        # Sensitivity modified in place and replaced
+        sens = flt.conf.sens['A']
+        sens['SENSITIVITY'] *= np.linspace(0.5, 2, len(sens))
+        out2 = dispersed_model()
+        self.assertFalse(np.allclose(out2, out))
+        np.testing.assert_array_equal(out2, uncached_model())
+
+        flt.conf.sens['A'] = sens.copy()
+        flt.conf.sens['A']['SENSITIVITY'] *= 2
+        np.testing.assert_allclose(dispersed_model(), 2*out2, rtol=1e-10)
@@ -0,0 +1,213 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+import astropy.io.fits as pyfits
+from astropy.table import Table
+
+from .. import multifit
+
+CONF = """# Synthetic first order for testing
+BEAMA -5 60
+MMAG_EXTRACT_A 30
+XOFF_A 0.1 1.e-3 -2.e-3
+YOFF_A -1.2 2.e-4 1.e-4
+DYDX_A_0 0.5 1.e-3 2.e-3
+DYDX_A_1 0.02 1.e-5 -3.e-5
+DLDP_A_0 10500. 0.1 0.05
+DLDP_A_1 46.5 1.e-3 2.e-3
+SENSITIVITY_A sens.fits
+"""
+
+def make_test_exposures(path, N=2, sh=(80, 80)):
+    """
+    Write a synthetic configuration file to `path`/CONF and `N` dithered
+    G141 exposures with two sources to `path`.
+
+    Returns
+    -------
+    files : list
+        Exposure filenames.
+
+    seg, direct : `~numpy.ndarray`
+        Segmentation image and direct image of the sources.
+    """
+    os.mkdir(os.path.join(path, 'CONF'))
+    with open(os.path.join(path, 'CONF', 'G141.F140W.V4.32.conf'), 'w') as fp:
+        fp.write(CONF)
+
+    sens = Table()
+    sens['WAVELENGTH'] = np.linspace(1.0e4, 1.8e4, 200)
+    sens['SENSITIVITY'] = np.exp(-(sens['WAVELENGTH']-1.4e4)**2/2/2000**2)
+    sens['ERROR'] = sens['SENSITIVITY']*0.01
+    sens.write(os.path.join(path, 'CONF', 'sens.fits'))
+
+    yp, xp = np.indices(sh)
+    seg = np.zeros(sh, dtype=np.float32)
+    direct = np.zeros(sh, dtype=np.float32)
+    for id, xc, yc in [(1, 20.3, 30.6), (2, 25.1, 55.2)]:
+        R = np.sqrt((xp-xc)**2+(yp-yc)**2)
+        seg[R < 4] = id
+        direct += np.exp(-R**2/2/1.5**2)
+
+    files = []
+    for i in range(N):
+        h = pyfits.Header()
+        h['INSTRUME'] = 'WFC3'
+        h['FILTER'] = 'G141'
+        h['EXPTIME'] = 1000.
+        h['PHOTFLAM'] = 1.
+        h['PHOTPLAM'] = 1.4e4
+
+        hs = pyfits.Header()
+        hs['CRPIX1'], hs['CRPIX2'] = sh[1]/2.+i, sh[0]/2.-i
+        hs['CRVAL1'], hs['CRVAL2'] = 150., 2.2
+        hs['CD1_1'], hs['CD2_2'] = -0.128/3600, 0.128/3600
+        hs['CTYPE1'], hs['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+
+        rng = np.random.RandomState(i)
+        sci = rng.normal(size=sh).astype(np.float32)*0.01
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU(header=h),
+                   pyfits.ImageHDU(data=sci, header=hs, name='SCI'),
+                   pyfits.ImageHDU(data=sci*0+0.01, header=hs, name='ERR'),
+                   pyfits.ImageHDU(data=np.zeros(sh, dtype=np.int16),
+                                   header=hs, name='DQ')])
+
+        file = os.path.join(path, 'test{0}_flt.fits'.format(i))
+        hdul.writeto(file)
+        files.append(file)
+
+    return files, seg, direct
+
+class Dummy(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.grizli_env = os.getenv('GRIZLI')
+        os.environ['GRIZLI'] = self.path
+
+        files, seg, direct = make_test_exposures(self.path)
+        self.grp = multifit.GroupFLT(grism_files=files, pad=20, cpu_count=-1,
+                                     verbose=False)
+
+        pad = 20
+        for flt in self.grp.FLTs:
+            flt.seg[pad:-pad, pad:-pad] = seg
+            flt.direct.data['SCI'][pad:-pad, pad:-pad] = direct
+            flt.reset_segmentation_index()
+
+        wave = np.linspace(0.9e4, 1.9e4, 100)
+        self.fit_info = OrderedDict()
+        for id, mag in zip([1, 2], [20, 21]):
+            self.fit_info[id] = {'mag':mag, 'spec':[wave, (wave/1.4e4)**id]}
+
+    def tearDown(self):
+        self.grp.close_shared_pool(sync=False)
+
+        if self.grizli_env is None:
+            os.environ.pop('GRIZLI')
+        else:
+            os.environ['GRIZLI'] = self.grizli_env
+
+        shutil.rmtree(self.path)
+
+    def test_shared_pool_model(self):
+        self.grp.compute_full_model(fit_info=self.fit_info, verbose=False,
+                                    cpu_count=1, store=True)
+        ref = [flt.model.copy() for flt in self.grp.FLTs]
+        for flt in self.grp.FLTs:
+            self.assertTrue(flt.model.max() > 0)
+            flt.model *= 0
+            flt.object_dispersers = OrderedDict()
+
+        for use_memmap in [False, True]:
+            self.grp.start_shared_pool(cpu_count=2, use_memmap=use_memmap,
+                                       verbose=False)
+
+            self.grp.compute_full_model(fit_info=self.fit_info,
+                                        verbose=False, store=True)
+
+            for flt, model_i in zip(self.grp.FLTs, ref):
+                np.testing.assert_allclose(flt.model, model_i, rtol=1e-12,
+                                           atol=1e-12*model_i.max())
+
+            self.grp.close_shared_pool()
+
+            for flt, model_i in zip(self.grp.FLTs, ref):
+                np.testing.assert_allclose(flt.model, model_i, rtol=1e-12,
+                                           atol=1e-12*model_i.max())
+
+                self.assertEqual(list(flt.object_dispersers.keys()), [1, 2])
+                flt.model *= 0
+                flt.object_dispersers = OrderedDict()
+
+    def test_close_shared_pool(self):
+        self.grp.start_shared_pool(cpu_count=2, verbose=False)
+        pool = self.grp.shared_pool
+
+        if pool.tmpdir is None:
+            names = [handle.name for handle in pool.handles]
+            self.assertTrue(len(names) > 0)
+        else:
+            names = []
+            tmpdir = pool.tmpdir
+
+        self.grp.close_shared_pool()
+        self.assertFalse(self.grp.has_shared_pool)
+        self.assertEqual(pool.handles, [])
+
+        # Shared memory blocks are unlinked
+        for name in names:
+            with self.assertRaises(FileNotFoundError):
+                multifit.shared_memory.SharedMemory(name=name)
+
+        if len(names) == 0:
+            self.assertFalse(os.path.exists(tmpdir))
+
+        # Arrays copied back from the shared memory
+        for flt in self.grp.FLTs:
+            self.assertTrue(flt.seg.max() == 2)
+            self.assertTrue(flt.model.flags['OWNDATA'])
+
+    def test_trace_shift_fast(self):
+        self.grp.compute_full_model(fit_info=self.fit_info, verbose=False,
+                                    cpu_count=1, store=False)
+
+        # Add the sources to the noise
+        for flt in self.grp.FLTs:
+            flt.grism.data['SCI'] += flt.model*0.01
+
+        beams = self.grp.get_beams(1, size=16)
+        mb = multifit.MultiBeam(beams, fcontam=0, group_name='test')
+        self.assertEqual(mb.N, 2)
+
+        nsub = 8
+        mb.init_trace_shift_models(nsub=nsub)
+        indices = [[0], [1]]
+
+        # Same as the full models at the subpixel grid nodes
+        for shifts in [[0., 0.], [2./nsub, 5./nsub], [7./nsub, 1./nsub]]:
+            shifts = np.array(shifts)
+            chi2, grad = mb.eval_trace_shift_fast(shifts, mb, indices, False)
+            ref = mb.eval_trace_shift(shifts, mb, indices, 0, False)
+            np.testing.assert_allclose(chi2, ref, rtol=1e-8)
+
+        # Analytic gradient, including integer pixel shifts
+        h = 1.e-6
+        for shifts in [[0.31, 0.77], [-0.43, 1.52]]:
+            shifts = np.array(shifts)
+            chi2, grad = mb.eval_trace_shift_fast(shifts, mb, indices, False)
+            self.assertTrue(np.abs(grad).max() > 0)
+
+            num_grad = np.zeros(len(shifts))
+            for i in range(len(shifts)):
+                dx = np.zeros(len(shifts))
+                dx[i] = h
+                c1 = mb.eval_trace_shift_fast(shifts+dx, mb, indices, False)
+                c0 = mb.eval_trace_shift_fast(shifts-dx, mb, indices, False)
+                num_grad[i] = (c1[0]-c0[0])/2/h
+
+            np.testing.assert_allclose(grad, num_grad, rtol=1e-5,
+                                       atol=1e-8*np.abs(num_grad).max())
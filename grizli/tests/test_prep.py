@@ -0,0 +1,385 @@
+import glob
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as pyfits
+
+from .. import prep, utils
+
+def make_test_visit(path, N=3, sh=(1014, 1014)):
+    """
+    Write synthetic G141 sky images to `path`/CONF and `N` G141 FLT
+    exposures with a sky, column residuals and a few sources to `path`.
+
+    Returns
+    -------
+    files : list
+        Exposure filenames.
+    """
+    conf_path = os.path.join(path, 'CONF')
+    if not os.path.exists(conf_path):
+        os.mkdir(conf_path)
+
+    yp, xp = np.indices(sh)
+    sky_images = {'zodi_G141_clean.fits': 1+0.1*xp/sh[1],
+                  'excess_lo_G141_clean.fits': 1+0.2*yp/sh[0],
+                  'G141_scattered_light.fits': np.exp(-(xp-300.)**2/2/200**2)}
+
+    for file in sky_images:
+        pyfits.writeto(os.path.join(conf_path, file),
+                       data=np.cast[np.float32](sky_images[file]),
+                       overwrite=True)
+
+    files = []
+    for i in range(N):
+        rng = np.random.RandomState(i)
+        sci = 0.8*sky_images['zodi_G141_clean.fits']
+        sci += (0.1+0.05*i)*sky_images['excess_lo_G141_clean.fits']
+        sci += 0.02*i*sky_images['G141_scattered_light.fits']
+
+        # Column residuals and sources
+        sci += 0.01*np.sin(xp/100.+i)
+        for xc, yc in [(200, 300), (600, 700), (850, 150)]:
+            sci += 5*np.exp(-((xp-xc)**2+(yp-yc)**2)/2/3.**2)
+
+        sci += rng.normal(size=sh)*0.02
+
+        h = pyfits.Header()
+        h['INSTRUME'] = 'WFC3'
+        h['DETECTOR'] = 'IR'
+        h['FILTER'] = 'G141'
+        h['EXPTIME'] = 1000.
+
+        dq = np.zeros(sh, dtype=np.int16)
+        dq[500:510, 100:110] = 4
+
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU(header=h),
+               pyfits.ImageHDU(data=np.cast[np.float32](sci), name='SCI'),
+               pyfits.ImageHDU(data=np.ones(sh, dtype=np.float32)*0.02,
+                               name='ERR'),
+               pyfits.ImageHDU(data=dq, name='DQ')])
+
+        file = os.path.join(path, 'test{0}_flt.fits'.format(i))
+        hdul.writeto(file, overwrite=True)
+        files.append(file)
+
+    return files
+
+def make_test_direct_visit(path, shifts, offsets, N=25, sh=(256, 256)):
+    """
+    Write F140W FLT exposures of the same random field to `path`, with
+    the sources moved by `offsets` (integer pixels, also applied to the
+    WCS) plus `shifts` (sub-pixel offsets not in the WCS).
+
+    Returns
+    -------
+    files : list
+        Exposure filenames.
+
+    xy : `~numpy.ndarray`, shape (N,2)
+        Zero-indexed source positions in the first exposure.
+    """
+    # Isolated sources on a jittered grid
+    rng = np.random.RandomState(4)
+    ng = int(np.ceil(np.sqrt(N)))
+    step = (sh[0]-60.)/(ng-1)
+    yg, xg = np.indices((ng, ng))*step + 30
+    xy = np.array([xg.flatten(), yg.flatten()]).T[:N]
+    xy += rng.uniform(-0.2, 0.2, size=xy.shape)*step
+
+    yp, xp = np.indices(sh)
+    files = []
+    for i, (shift, offset) in enumerate(zip(shifts, offsets)):
+        sci = rng.normal(size=sh)*0.02
+        for xc, yc in xy + np.array(shift) + np.array(offset):
+            sci += 5*np.exp(-((xp-xc)**2+(yp-yc)**2)/2/1.5**2)
+
+        h = pyfits.Header()
+        h['INSTRUME'] = 'WFC3'
+        h['DETECTOR'] = 'IR'
+        h['FILTER'] = 'F140W'
+        h['EXPTIME'] = 300.
+
+        hs = pyfits.Header()
+        hs['CTYPE1'], hs['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+        hs['CRVAL1'], hs['CRVAL2'] = 150.1, 2.2
+        hs['CRPIX1'] = sh[1]/2. + offset[0]
+        hs['CRPIX2'] = sh[0]/2. + offset[1]
+        hs['CD1_1'], hs['CD2_2'] = -0.128/3600, 0.128/3600
+        hs['CD1_2'], hs['CD2_1'] = 0., 0.
+
+        dq = np.zeros(sh, dtype=np.int16)
+        dq[100:104, 10:14] = 4
+
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU(header=h),
+               pyfits.ImageHDU(data=np.cast[np.float32](sci), header=hs,
+                               name='SCI'),
+               pyfits.ImageHDU(data=np.ones(sh, dtype=np.float32)*0.02,
+                               header=hs, name='ERR'),
+               pyfits.ImageHDU(data=dq, name='DQ')])
+
+        file = os.path.join(path, 'direct{0}_flt.fits'.format(i))
+        hdul.writeto(file, overwrite=True)
+        files.append(file)
+
+    return files, xy
+
+class Dummy(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.grizli_env = os.getenv('GRIZLI')
+        os.environ['GRIZLI'] = self.path
+        self.cwd = os.getcwd()
+        os.chdir(self.path)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        if self.grizli_env is None:
+            os.environ.pop('GRIZLI')
+        else:
+            os.environ['GRIZLI'] = self.grizli_env
+
+        shutil.rmtree(self.path)
+
+    def test_visit_grism_sky(self):
+        files = make_test_visit(self.path)
+        grism = {'product': 'test-g141', 'files': files}
+
+        # Reference sky-subtracted exposures
+        prep.visit_grism_sky(grism=grism, apply=True, column_average=True,
+                             verbose=False, sky_iter=3, stream=False)
+
+        ref = [pyfits.open(file)['SCI'].data*1 for file in files]
+        self.assertTrue(np.abs(np.median(ref[0])) < 0.01)
+
+        # Streamed exposures and threads
+        for stream, n_threads in [(True, 1), (False, 3), (True, 3)]:
+            files = make_test_visit(self.path)
+            prep.visit_grism_sky(grism=grism, apply=True,
+                                 column_average=True, verbose=False,
+                                 sky_iter=3, stream=stream,
+                                 n_threads=n_threads)
+
+            for file, ref_i in zip(files, ref):
+                im = pyfits.open(file)
+                np.testing.assert_allclose(im['SCI'].data, ref_i, rtol=0,
+                                           atol=1.e-6)
+
+                self.assertTrue(im[0].header['GSKYCOL'])
+
+    def test_match_quads(self):
+        rng = np.random.RandomState(3)
+
+        # Known similarity transformation
+        scale, rot, shift = 1.02, 0.3, np.array([30., -50.])
+        R = scale*np.array([[np.cos(rot), -np.sin(rot)],
+                            [np.sin(rot), np.cos(rot)]])
+
+        N = 200
+        xy = rng.uniform(0, 1000, size=(N,2))
+        common = rng.rand(N) < 0.85
+
+        # Noisy, shuffled output list with spurious sources
+        out_xy = np.dot(xy[common], R.T) + shift
+        out_xy += rng.normal(size=out_xy.shape)*0.3
+        spurious = np.dot(rng.uniform(0, 1000, size=(60,2)), R.T) + shift
+        output = np.vstack([out_xy, spurious])
+
+        perm = rng.permutation(len(output))
+        output = output[perm]
+
+        # Spurious sources in the input list
+        input = np.vstack([xy, rng.uniform(0, 1000, size=(40,2))])
+
+        true_ix = -np.ones(len(input), dtype=int)
+        true_ix[np.where(common)[0]] = np.argsort(perm)[:common.sum()]
+
+        input_ix, output_ix, tf = prep.match_quads(input, output, toler=2)
+
+        self.assertAlmostEqual(tf.scale, scale, delta=1.e-3)
+        self.assertAlmostEqual(tf.rotation, rot, delta=1.e-3)
+        np.testing.assert_allclose(tf.translation, shift, atol=0.3)
+
+        correct = true_ix[input_ix] == output_ix
+        self.assertTrue(correct.sum() > 0.95*common.sum())
+        self.assertTrue(correct.mean() > 0.98)
+
+    def test_match_quads_density(self):
+        # Shallow list of the brightest 10% of a dense reference list
+        scale, rot, shift = 1.0, 0.01, np.array([13., -7.])
+        R = scale*np.array([[np.cos(rot), -np.sin(rot)],
+                            [np.sin(rot), np.cos(rot)]])
+
+        for seed in range(5):
+            rng = np.random.RandomState(seed)
+            ref = rng.uniform(0, 1000, size=(400,2))
+            ref_mag = rng.uniform(16, 26, size=400)
+
+            bright = np.argsort(ref_mag)[:40]
+            input = np.dot(ref[bright]-shift, np.linalg.inv(R).T)
+            input += rng.normal(size=input.shape)*0.1
+            input_mag = ref_mag[bright] + rng.normal(size=40)*0.1
+
+            # Without magnitudes, no spurious solutions
+            try:
+                input_ix, output_ix, tf = prep.match_quads(input, ref,
+                                                           toler=1)
+            except ValueError:
+                pass
+            else:
+                self.assertTrue(np.all(bright[input_ix] == output_ix))
+                self.assertAlmostEqual(tf.scale, scale, delta=1.e-3)
+
+            # Brightest sources of the denser list
+            input_ix, output_ix, tf = prep.match_quads(input, ref, toler=1,
+                                                       output_mag=ref_mag)
+
+            self.assertEqual(len(input_ix), 40)
+            self.assertTrue(np.all(bright[input_ix] == output_ix))
+            self.assertAlmostEqual(tf.scale, scale, delta=1.e-3)
+            self.assertAlmostEqual(tf.rotation, rot, delta=1.e-3)
+
+            res = prep.match_lists(input, ref, toler=1, method='quads',
+                                   output_mag=ref_mag)
+            np.testing.assert_array_equal(res[0], input_ix)
+            np.testing.assert_array_equal(res[1], output_ix)
+
+        # Scale outside of `scale_range`
+        with self.assertRaises(ValueError):
+            prep.match_quads(input, ref*3, toler=3, output_mag=ref_mag)
+
+    def test_gaia_tile_query(self):
+        from astropy.table import Table
+
+        # Local stand-in for the Gaia TAP service, which answers the ADQL
+        # cone query
+        rng = np.random.RandomState(2)
+        N = 20000
+        full = Table()
+        full['ra'] = 150. + (rng.rand(N)-0.5)*0.6
+        full['dec'] = 2.2 + (rng.rand(N)-0.5)*0.6
+
+        def gaia_service(ra=0., dec=0., radius=3.):
+            query = prep._gaia_adql_query(ra=ra, dec=dec, radius=radius)
+            circle = re.search(r"CIRCLE\('ICRS',(.+),(.+),(.+)\)\)", query)
+            ra_q, dec_q, r_q = [float(v) for v in circle.groups()]
+            sep = utils.angular_separation(ra_q, dec_q, full['ra'],
+                                           full['dec'])
+            return full[sep <= r_q]
+
+        cache = utils.SkyTileCache('gaia_dr1', query_func=gaia_service,
+                                   cache_dir=self.path, verbose=False)
+
+        # Sources just inside the tile corners
+        ra, dec = 150.02, 2.19
+        tiles = cache.tiles_in_cone(ra=ra, dec=dec, radius=5.)
+        eps = 1.e-5
+        for tile in tiles:
+            ra0, ra1, dec0, dec1 = cache.tile_limits(tile)
+            for ra_i, dec_i in [(ra0+eps, dec0+eps), (ra0+eps, dec1-eps),
+                                (ra1-eps, dec0+eps), (ra1-eps, dec1-eps)]:
+                full.add_row([ra_i, dec_i])
+
+        # Full tiles
+        for tile in tiles:
+            in_tile = cache.in_tile(tile, np.asarray(full['ra']),
+                                    np.asarray(full['dec']))
+            table = cache.fetch_tile(tile)
+            self.assertEqual(len(table), in_tile.sum())
+
+        sep = utils.angular_separation(ra, dec, full['ra'], full['dec'])
+        table = cache.query(ra=ra, dec=dec, radius=5.)
+        self.assertEqual(len(table), (sep <= 5./60).sum())
+
+        # Repeated query from the cache
+        n_fetch = cache.n_fetch
+        self.assertEqual(n_fetch, len(tiles))
+        repeat = cache.query(ra=ra, dec=dec, radius=5.)
+        self.assertEqual(cache.n_fetch, n_fetch)
+        for col in ['ra', 'dec']:
+            np.testing.assert_array_equal(repeat[col], table[col])
+
+        # Offline, without the remote service
+        offline = utils.SkyTileCache('gaia_dr1', query_func=None,
+                                     cache_dir=self.path, offline=True,
+                                     verbose=False)
+
+        gaia = prep.get_gaia_catalog(ra=ra, dec=dec, radius=5.,
+                                     cache_dir=self.path, offline=True)
+
+        for result in [offline.query(ra=ra, dec=dec, radius=5.), gaia]:
+            for col in ['ra', 'dec']:
+                np.testing.assert_array_equal(result[col], table[col])
+
+        self.assertEqual(offline.n_fetch, 0)
+
+        # Cone reaching outside of the cached tiles
+        ra2 = ra + 0.1
+        with self.assertRaises(IOError):
+            offline.query(ra=ra2, dec=dec, radius=5.)
+
+        with self.assertRaises(IOError):
+            prep.get_gaia_catalog(ra=ra2, dec=dec, radius=5.,
+                                  cache_dir=self.path, offline=True)
+
+        self.assertEqual(offline.n_fetch, 0)
+
+        # Only the missing tiles are fetched
+        missing = offline.missing_tiles(ra=ra2, dec=dec, radius=5.)
+        self.assertTrue(0 < len(missing) < len(tiles))
+
+        ntile = len(os.listdir(cache.path))
+        table2 = prep._tiled_catalog_query(gaia_service, 'gaia_dr1', ra=ra2,
+                                           dec=dec, radius=5.,
+                                           cache_dir=self.path, verbose=False)
+
+        self.assertEqual(len(os.listdir(cache.path)), ntile+len(missing))
+
+        sep = utils.angular_separation(ra2, dec, full['ra'], full['dec'])
+        self.assertEqual(len(table2), (sep <= 5./60).sum())
+
+        result = offline.query(ra=ra2, dec=dec, radius=5.)
+        self.assertEqual(len(result), len(table2))
+        self.assertEqual(offline.n_fetch, 0)
+
+    def test_tweak_flt_photutils(self):
+        shifts = [(0., 0.), (0.15, -0.1), (-0.2, 0.25)]
+        offsets = [(0, 0), (10, -5), (-7, 12)]
+        files, xy = make_test_direct_visit(self.path, shifts, offsets)
+
+        # 1-indexed centroids
+        xy_i = prep._tweak_flt_catalog(files[1], threshold=5,
+                                       method='photutils')
+
+        xy_true = xy + np.array(shifts[1]) + np.array(offsets[1]) + 1
+        self.assertEqual(len(xy_i), len(xy))
+        dr = xy_i[:,None,:] - xy_true[None,:,:]
+        self.assertTrue(np.sqrt((dr**2).sum(axis=2)).min(axis=1).max() < 0.05)
+
+        results = []
+        for cpu_count in [1, 2]:
+            wcs_ref, d = prep.tweak_flt(files=files, threshold=5,
+                                        verbose=False, method='photutils',
+                                        cpu_count=cpu_count)
+            results.append(d)
+
+            self.assertEqual(list(d.keys()), files)
+            for file, shift in zip(files, shifts):
+                dx, dy, rot, scale, N, rms = d[file]
+                np.testing.assert_allclose([dx, dy],
+                                           np.array(shift)-shifts[0],
+                                           atol=0.03)
+                self.assertEqual(N, len(xy))
+
+        for file in files:
+            np.testing.assert_array_equal(results[0][file][:5],
+                                          results[1][file][:5])
+            np.testing.assert_array_equal(results[0][file][5],
+                                          results[1][file][5])
+
+        # No temporary images
+        self.assertEqual(glob.glob(os.path.join(self.path, '*_x*.fits')), [])
@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+import astropy.io.fits as pyfits
+from astropy.table import Table
+
+from .. import stack, utils
+from .test_multifit import CONF
+
+def make_test_stack(path, is_flambda=True, sh=(12, 120)):
+    """
+    Write a synthetic configuration file and a G141 stack file with a
+    single extension to `path`.
+
+    Returns
+    -------
+    file : str
+        Stack filename.
+    """
+    conf_file = os.path.join(path, 'G141.test.conf')
+    if not os.path.exists(conf_file):
+        with open(conf_file, 'w') as fp:
+            fp.write(CONF)
+
+        sens = Table()
+        sens['WAVELENGTH'] = np.linspace(1.0e4, 1.8e4, 200)
+        sens['SENSITIVITY'] = np.exp(-(sens['WAVELENGTH']-1.4e4)**2/2/2000**2)
+        sens['ERROR'] = sens['SENSITIVITY']*0.01
+        sens.write(os.path.join(path, 'sens.fits'))
+
+    NY, NX = sh
+    h0 = pyfits.Header()
+    h0['NGRISM'] = 1
+    h0['GRISM001'] = 'G141'
+    h0['ID'] = 1
+    h0['RA'], h0['DEC'] = 150., 2.2
+
+    h = pyfits.Header()
+    h['CRPIX1'], h['CRVAL1'], h['CD1_1'] = 1., 1.05e4, 46.5
+    h['ISFLAM'] = is_flambda
+    h['CONF'] = conf_file
+    h['BEAM'] = 'A'
+
+    # Asymmetric spatial kernel
+    yp, xp = np.indices((NY, NY))
+    kernel = np.exp(-((yp-NY/2.+0.3)**2+(xp-NY/2.-0.7)**2)/2/1.5**2)
+
+    # Continuum with an emission line
+    wave = (np.arange(NX)+1-h['CRPIX1'])*h['CD1_1']+h['CRVAL1']
+    flux = (wave/1.4e4)**-1+2*np.exp(-(wave-1.3e4)**2/2/60.**2)
+
+    rng = np.random.RandomState(1)
+    prof = kernel.sum(axis=1)
+    sci = prof[:,None]*flux[None,:]/prof.sum()
+    sci += rng.normal(size=sh)*0.01
+    wht = np.ones(sh)/0.01**2
+
+    hdul = pyfits.HDUList([pyfits.PrimaryHDU(header=h0)])
+    for data, extname in zip([sci, wht, kernel], ['SCI', 'WHT', 'KERNEL']):
+        hdul.append(pyfits.ImageHDU(data=data, header=h, name=extname))
+        hdul[-1].header['EXTVER'] = 'G141'
+
+    file = os.path.join(path, 'test_{0}.stack.fits'.format(int(is_flambda)))
+    hdul.writeto(file)
+    return file
+
+def dense_stack_model(spec, fl):
+    """
+    2D model computed with the dense `(NAXIS1, NAXIS2, NAXIS1)` matrix that
+    `StackedSpectrum` used before `apply_kernel`.
+    """
+    NY, NX = spec.sh
+    data = np.zeros((NX, NY, NX))
+    for j in range(NY//2):
+        data[j,:,:j+NY//2] += spec.kernel[:, -NY//2-j:]
+
+    for j in range(NX-NY//2, NX):
+        data[j,:,-NY//2+j:] += spec.kernel[:, :NX-j+NY//2]
+
+    for j in range(NY//2, NX-NY//2):
+        data[j,:,j-NY//2:j+NY//2] += spec.kernel
+
+    fit_data = data.reshape(NX,-1)
+    if not spec.is_flambda:
+        fit_data = (fit_data.T*spec.sens).T
+
+    return np.dot(fl, fit_data)
+
+class Dummy(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_apply_kernel(self):
+        rng = np.random.RandomState(2)
+        for is_flambda in [True, False]:
+            file = make_test_stack(self.path, is_flambda=is_flambda)
+            spec = stack.StackedSpectrum(file=file, extver='G141',
+                                         mask_threshold=-1)
+
+            # Spectra with flux at both edges of the wavelength axis
+            fl = rng.normal(size=(3, spec.sh[1]))
+            fl[:,:2] += 10
+            fl[:,-2:] += 10
+
+            ref = dense_stack_model(spec, fl)
+            model = spec.apply_kernel(fl)
+            self.assertEqual(model.shape, (3, spec.size))
+            np.testing.assert_allclose(model, ref, rtol=1e-10,
+                                       atol=1e-12*np.abs(ref).max())
+
+            # Edge columns
+            NX = spec.sh[1]
+            for m, r in zip(model, ref):
+                m2, r2 = m.reshape(spec.sh), r.reshape(spec.sh)
+                self.assertTrue(np.abs(r2[:,:2]).max() > 0)
+                self.assertTrue(np.abs(r2[:,-2:]).max() > 0)
+                np.testing.assert_allclose(m2[:,[0,1,NX-2,NX-1]],
+                                           r2[:,[0,1,NX-2,NX-1]], rtol=1e-10)
+
+            # Single spectrum
+            np.testing.assert_allclose(spec.apply_kernel(fl[0])[0], ref[0],
+                                       rtol=1e-10,
+                                       atol=1e-12*np.abs(ref).max())
+
+    def test_fit_zgrid_batch(self):
+        file = make_test_stack(self.path, is_flambda=True)
+        st = stack.StackFitter(files=file, verbose=False)
+
+        wave = np.arange(3000, 1.e4, 5.)
+        templates = OrderedDict()
+        templates['cont'] = utils.SpectrumTemplate(wave=wave,
+                                                   flux=(wave/6000.)**-1)
+        templates['red'] = utils.SpectrumTemplate(wave=wave,
+                                                  flux=(wave/6000.)**2)
+        templates['line'] = utils.SpectrumTemplate(wave=wave,
+                             flux=np.exp(-(wave-5007.)**2/2/20.**2))
+
+        zgrid = np.linspace(1.4, 1.8, 9)
+        for fitter in ['nnls', 'lstsq']:
+            ref_chi2 = np.zeros(len(zgrid))
+            ref_coeffs = np.zeros((len(zgrid), len(templates)))
+            for i, z in enumerate(zgrid):
+                out = st.fit_at_z(z=z, templates=templates, fitter=fitter)
+                ref_chi2[i], ref_coeffs[i,:] = out[0], out[3]
+
+            self.assertTrue(np.abs(ref_coeffs).max() > 0)
+
+            # One chunk and one redshift per chunk
+            for max_memory in [2**30, 1]:
+                chi2, coeffs = st.fit_zgrid_batch(zgrid, templates=templates,
+                                                  fitter=fitter,
+                                                  max_memory=max_memory)
+
+                np.testing.assert_allclose(chi2, ref_chi2, rtol=1e-6)
+                np.testing.assert_allclose(coeffs, ref_coeffs, rtol=1e-5,
+                                       atol=1e-6*np.abs(ref_coeffs).max())
+
+        with self.assertRaises(ValueError):
+            st.fit_zgrid_batch(zgrid)
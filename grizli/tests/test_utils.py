@@ -3,8 +3,127 @@ import unittest
 import numpy as np
 from .. import utils
 
+try:
+    import eazy.igm
+    HAS_EAZY = True
+except ImportError:
+    HAS_EAZY = False
+
 class Dummy(unittest.TestCase):  
     def test_log_zgrid(self):
         value = np.array([ 0.1       ,  0.21568801,  0.34354303,  0.48484469,  0.64100717, 0.8135934 ])
         np.testing.assert_allclose(utils.log_zgrid([0.1,1],0.1), value, rtol=1e-06, atol=0, equal_nan=False, err_msg='', verbose=True)
-  
\ No newline at end of file
+      
+    def test_normal_equations_lstsq(self):
+        import scipy.optimize
+        
+        np.random.seed(1)
+        A = np.abs(np.random.normal(size=(2000, 8)))
+        y = np.dot(A, np.linspace(0, 1, 8)) + np.random.normal(size=2000)*0.1
+        
+        coeffs, ATA, R = utils.normal_equations_lstsq(A, y, fitter='nnls')
+        nnls_coeffs, rnorm = scipy.optimize.nnls(A, y)
+        np.testing.assert_allclose(coeffs, nnls_coeffs, rtol=1e-8, atol=1e-10)
+        
+        coeffs, ATA, R = utils.normal_equations_lstsq(A, y, fitter='lstsq')
+        lstsq_coeffs = np.linalg.lstsq(A, y, rcond=None)[0]
+        np.testing.assert_allclose(coeffs, lstsq_coeffs, rtol=1e-8, atol=1e-10)
+        
+        np.testing.assert_allclose(np.dot(R.T, R), ATA, rtol=1e-10)
+        
+        covar = utils.normal_covariance(ATA=ATA)
+        np.testing.assert_allclose(covar, np.linalg.inv(np.dot(A.T, A)), rtol=1e-8)
+        
+        covar_R = utils.normal_covariance(ATA=ATA, R=R)
+        np.testing.assert_allclose(covar_R, covar, rtol=1e-10)
+    
+    def test_log_shift_spectra(self):
+        from ..utils_c.interp import interp_conserve_c
+        
+        wave = utils.log_wave_grid([100., 1.e5], R=5000)
+        
+        # Continuum and Gaussian line with FWHM = 1000 km/s
+        sig = 1000./3.e5/2.35
+        flux_arr = np.array([(wave/5000.)**-1.5, 
+                             np.exp(-np.log(wave/5007.)**2/2/sig**2)])
+        
+        x = np.linspace(9000, 1.7e4, 150)
+        i0, i1, matrix = utils.log_resampling_matrix(wave, x)
+        
+        yint = interp_conserve_c(x, wave, flux_arr[0,:])
+        np.testing.assert_allclose(matrix.dot(flux_arr[0,i0:i1]), yint, 
+                                   rtol=1e-10, atol=0)
+        
+        for z in [0.9, 1.2345, 2.1]:
+            flux_z = utils.log_shift_spectra(flux_arr, wave, z, i0=i0, i1=i1)
+            shifted = matrix.dot(flux_z.T).T
+            for i in range(2):
+                ref = interp_conserve_c(x, wave*(1+z), flux_arr[i,:]/(1+z))
+                np.testing.assert_allclose(shifted[i,:], ref, rtol=0, 
+                                           atol=2.e-3*ref.max())
+    
+    @unittest.skipIf(not HAS_EAZY, 'eazy-py not available')
+    def test_igm_table(self):
+        inoue = eazy.igm.Inoue14()
+        igm = utils.IGMTable(inoue)
+        self.assertEqual(len(igm.rows), 0)
+        
+        # Grid node, interpolated and beyond the table
+        for z in [igm.zgrid[300], 4.567, 6.1, 7.3, 16.]:
+            lobs = igm.wave*(1+z)
+            np.testing.assert_allclose(igm.full_IGM(z, lobs), 
+                                       inoue.full_IGM(z, lobs), 
+                                       rtol=0, atol=1.e-4)
+        
+        # Only the bracketing rows are computed
+        self.assertTrue(len(igm.rows) <= 8)
+        
+    def test_sky_tile_cache(self):
+        import shutil
+        import tempfile
+        from astropy.table import Table
+        
+        # Local stand-in for a remote catalog service
+        np.random.seed(2)
+        N = 20000
+        full = Table()
+        full['ra'] = 150. + (np.random.rand(N)-0.5)*0.6
+        full['dec'] = 2.2 + (np.random.rand(N)-0.5)*0.6
+        full['id'] = np.arange(N)
+        
+        def cone(ra=0., dec=0., radius=3.):
+            sep = utils.angular_separation(ra, dec, full['ra'], full['dec'])
+            return full[sep <= radius/60.]
+        
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = utils.SkyTileCache('test', query_func=cone, 
+                                       cache_dir=cache_dir, tile_size=3.,
+                                       verbose=False)
+            
+            table = cache.query(ra=150.01, dec=2.21, radius=4.)
+            self.assertTrue(cache.n_fetch > 0)
+            self.assertEqual(sorted(table['id']), 
+                             sorted(cone(150.01, 2.21, 4.)['id']))
+            
+            # Overlapping query, only fetch the new tiles
+            n_fetch = cache.n_fetch
+            n_new = len(cache.missing_tiles(ra=150.05, dec=2.21, radius=4.))
+            table = cache.query(ra=150.05, dec=2.21, radius=4.)
+            self.assertEqual(cache.n_fetch, n_fetch+n_new)
+            self.assertEqual(sorted(table['id']), 
+                             sorted(cone(150.05, 2.21, 4.)['id']))
+            
+            # Offline
+            offline = utils.SkyTileCache('test', query_func=None, 
+                                         cache_dir=cache_dir, tile_size=3.,
+                                         offline=True, verbose=False)
+            
+            table = offline.query(ra=150.03, dec=2.2, radius=2.)
+            self.assertEqual(sorted(table['id']), 
+                             sorted(cone(150.03, 2.2, 2.)['id']))
+            
+            with self.assertRaises(IOError):
+                offline.query(ra=150.2, dec=2.3, radius=2.)
+        finally:
+            shutil.rmtree(cache_dir)
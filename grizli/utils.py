@@ -791,7 +791,64 @@ def detect_with_photutils(sci, err=None, dq=None, seg=None, detect_thresh=2.,
         catalog.write(seg_cat, format='ascii.commented_header')
     
     return catalog, seg
-    
+
+def segmentation_index(seg, flam):
+    """Limits and flux-weighted centroids of all segmentation regions
+
+    Computes the same quantities as
+    `~grizli.utils_c.disperse.compute_segmentation_limits` for all objects
+    in a single pass through the segmentation image.
+
+    Parameters
+    ----------
+    seg : `~numpy.ndarray`
+        Segmentation image.  Only positive integer values are indexed.
+
+    flam : `~numpy.ndarray`
+        Flux array with the same shape as `seg`, used for the weighted
+        centroids.
+
+    Returns
+    -------
+    index : dict
+        Keys are the segmentation IDs and the values are tuples of
+        (ymin, ymax, y, xmin, xmax, x, area, flux), as from
+        `~grizli.utils_c.disperse.compute_segmentation_limits`.
+
+    """
+    segi = np.cast[int](seg)
+    valid = (segi > 0) & (segi == seg)
+
+    ids, inv = np.unique(segi[valid], return_inverse=True)
+    N = len(ids)
+    if N == 0:
+        return {}
+
+    ### Bounding boxes
+    labels = np.zeros(seg.shape, dtype=np.int32)
+    labels[valid] = inv+1
+    slices = nd.find_objects(labels)
+
+    ### Pixel sums in the same order as the full-image scan
+    yp, xp = np.nonzero(valid)
+    wht = np.cast[np.float64](flam[valid])
+    area = np.bincount(inv, minlength=N)
+    denom = np.bincount(inv, weights=wht, minlength=N)
+    inumer = np.bincount(inv, weights=yp*wht, minlength=N)
+    jnumer = np.bincount(inv, weights=xp*wht, minlength=N)
+
+    ### No matched flux
+    denom[denom == 0] = -99
+
+    index = {}
+    for i, id in enumerate(ids):
+        sly, slx = slices[i]
+        index[id] = (sly.start, sly.stop-1, inumer[i]/denom[i],
+                     slx.start, slx.stop-1, jnumer[i]/denom[i],
+                     area[i], denom[i])
+
+    return index
+
 def nmad(data):
     """Normalized NMAD=1.48 * `~.astropy.stats.median_absolute_deviation`
     
@@ -937,6 +994,148 @@ def get_line_wavelengths():
     
     return line_wavelengths, line_ratios 
     
+IGM_TABLE = None
+
+class IGMTable(object):
+    def __init__(self, igm=None, wave_range=[50., 1300.], R=2000, zmax=15., dz=0.005):
+        """Tabulated IGM transmission on a (z, rest-frame wavelength) grid
+        
+        Evaluating the IGM transmission of, e.g., `~eazy.igm.Inoue14` is 
+        expensive compared to the template fits at a single redshift, and 
+        the fitting functions call it for every template.  The table 
+        stores the transmission as a function of rest-frame wavelength on a
+        redshift grid with constant steps in `log(1+z)`.  The rows of the 
+        table are computed with `igm` as they are needed and the 
+        transmission at arbitrary redshifts is interpolated linearly 
+        between the rows.
+        
+        Parameters
+        ----------
+        igm : object
+            IGM model with a method `full_IGM(z, lobs)`, e.g., 
+            `~eazy.igm.Inoue14`.
+        
+        wave_range : [float, float]
+            Range of the rest-frame wavelength grid, Angstrom.  The 
+            transmission is unity redward of the grid.
+        
+        R : float
+            Resolution of the rest-frame wavelength grid, 
+            `1/dlog(wave)`.
+        
+        zmax, dz : float
+            Maximum redshift and step `dlog(1+z)` of the redshift grid.  
+            The transmission is computed directly with `igm` for 
+            redshifts beyond `zmax`.
+            
+        Attributes
+        ----------
+        wave : `~numpy.ndarray`
+            Rest-frame wavelength grid.
+        
+        zgrid : `~numpy.ndarray`
+            Redshift grid.
+        
+        rows : dict
+            Transmission at `wave` for the rows of `zgrid` that have been
+            computed so far, keyed by the index of the redshift grid.  Only
+            these rows are stored, so the memory footprint scales with the
+            range of redshifts that has been fit.
+            
+        """
+        self.igm = igm
+        self.wave = log_wave_grid(wave_range=wave_range, R=R)
+        self.zgrid = log_zgrid([0, zmax], dz=dz)
+        self.dz = dz
+        
+        self.rows = {}
+        self._last = (None, None)
+        
+    def get_row(self, iz):
+        """Transmission at `zgrid[iz]`, computed if necessary
+        """
+        row = self.rows.get(iz)
+        if row is None:
+            zi = self.zgrid[iz]
+            row = self.igm.full_IGM(zi, self.wave*(1+zi))
+            self.rows[iz] = row
+        
+        return row
+    
+    def rest_transmission(self, z):
+        """Transmission at redshift `z` on the rest-frame grid `wave`
+        
+        The result for the last redshift is cached, so the interpolation 
+        is only done once when the fitting functions evaluate the 
+        transmission for several templates at the same redshift.
+        
+        Parameters
+        ----------
+        z : float
+            Redshift.
+        
+        Returns
+        -------
+        trans : `~numpy.ndarray`
+            Transmission at `wave`.
+        """
+        last_z, trans = self._last
+        if last_z == z:
+            return trans
+        
+        lnz = np.log(1+z)/self.dz
+        iz = int(np.floor(lnz))
+        
+        if (iz < 0) | (iz >= len(self.zgrid)-1):
+            trans = self.igm.full_IGM(z, self.wave*(1+z))
+        else:
+            frac = lnz - iz
+            trans = (1-frac)*self.get_row(iz) + frac*self.get_row(iz+1)
+        
+        self._last = (z, trans)
+        return trans
+        
+    def full_IGM(self, z, lobs):
+        """IGM transmission at redshift `z` and observed wavelengths `lobs`
+        
+        Same call signature as `~eazy.igm.Inoue14.full_IGM`.
+        
+        Parameters
+        ----------
+        z : float
+            Redshift.
+        
+        lobs : array-like
+            Observed-frame wavelengths, Angstrom.
+        
+        Returns
+        -------
+        trans : `~numpy.ndarray`
+            Transmission at `lobs`.
+        """
+        trans = self.rest_transmission(z)
+        return np.interp(np.asarray(lobs)/(1+z), self.wave, trans, 
+                         left=trans[0], right=1.)
+    
+def get_igm_table():
+    """Shared `~grizli.utils.IGMTable` of the `~eazy.igm.Inoue14` model
+    
+    Returns
+    -------
+    igm : `~grizli.utils.IGMTable` or None
+        Table stored in `~grizli.utils.IGM_TABLE`, or None if `eazy-py` is 
+        not available.
+    """
+    global IGM_TABLE
+    if IGM_TABLE is None:
+        try:
+            import eazy.igm
+            IGM_TABLE = IGMTable(eazy.igm.Inoue14())
+        except:
+            return None
+        
+    return IGM_TABLE
+
 class SpectrumTemplate(object):
     def __init__(self, wave=None, flux=None, central_wave=None, fwhm=None, velocity=False, fluxunits=FLAMBDA_CGS, waveunits=u.angstrom, name=''):
         """Container for template spectra.   
@@ -1086,8 +1285,7 @@ class SpectrumTemplate(object):
             
         """
         try:
-            import eazy.igm
-            igm = eazy.igm.Inoue14()
+            igm = get_igm_table()
             igmz = igm.full_IGM(z, self.wave*(1+z))
         except:
             igmz = 1.
@@ -1398,6 +1596,469 @@ def load_templates(fwhm=400, line_complexes=True, stars=False,
                                  
     return temp_list    
 
+TEMPLATE_BANK_CACHE = OrderedDict()
+
+class TemplateBank(object):
+    def __init__(self, wave, flux_arr, names, fwhm=None, key=None):
+        """Array-backed set of templates on a common wavelength grid.
+        
+        The bank behaves like the (ordered) dictionary of 
+        `~grizli.utils.SpectrumTemplate` objects returned by 
+        `~grizli.utils.load_templates` and can be passed directly to the
+        fitting functions, but the templates are stored as rows of a single
+        `(NTEMP, NL)` array that is returned as-is by 
+        `~grizli.utils.array_templates`.
+        
+        Parameters
+        ----------
+        wave : array-like, dimensions `(NL,)`
+            Common wavelength grid, Angstrom.  Generally uniformly spaced in
+            `log(wave)`, see `~grizli.utils.TemplateBank.from_templates`.
+        
+        flux_arr : array-like, dimensions `(NTEMP, NL)`
+            Template fluxes evaluated on `wave`.
+        
+        names : list
+            Template names, i.e., the dictionary keys.
+        
+        fwhm : None or list
+            FWHM of the individual templates, e.g., for the emission lines.
+        
+        key : None or tuple
+            Parameters used to generate the bank 
+            (see `~grizli.utils.load_template_bank`).
+            
+        Attributes
+        ----------
+        is_line : `~numpy.ndarray`
+            Boolean array indicating emission line templates (the key in the 
+            template dictionary starts with "line ").
+            
+        """
+        self.wave = np.cast[np.float64](wave)
+        self.flux_arr = np.cast[np.float64](np.atleast_2d(flux_arr))
+        self.names = [str(n) for n in names]
+        
+        if fwhm is None:
+            fwhm = [None]*len(self.names)
+        
+        self.fwhm = list(fwhm)
+        self.key = key
+        
+        self.is_line = np.array([t.startswith('line ') for t in self.names],
+                                dtype=bool)
+        
+        self._index = OrderedDict()
+        for i, name in enumerate(self.names):
+            self._index[name] = i
+            
+        self._views = {}
+        
+    @classmethod
+    def from_templates(cls, templates, R=5000, wave_range=[100., 1.e5], key=None):
+        """Generate a bank by resampling templates to a log-wavelength grid
+        
+        Parameters
+        ----------
+        templates : dictionary of `~grizli.utils.SpectrumTemplate` objects
+            Input templates, e.g., from `~grizli.utils.load_templates`.
+        
+        R : float
+            Resolution of the output grid, which has constant steps of
+            `1/R` in `log(wave)`.
+        
+        wave_range : [float, float]
+            Wavelength limits of the output grid, Angstrom.
+        
+        key : None or tuple
+            Passed to `~grizli.utils.TemplateBank`.
+            
+        Returns
+        -------
+        bank : `~grizli.utils.TemplateBank`
+        
+        """
+        from grizli.utils_c.interp import interp_conserve_c
+        
+        wave = log_wave_grid(wave_range=wave_range, R=R)
+        
+        NTEMP = len(templates)
+        flux_arr = np.zeros((NTEMP, len(wave)))
+        fwhm = []
+        for i, t in enumerate(templates):
+            ti = templates[t]
+            flux_arr[i,:] = interp_conserve_c(wave, 
+                                              np.cast[np.float64](ti.wave),
+                                              np.cast[np.float64](ti.flux))
+            fwhm.append(ti.fwhm)
+        
+        return cls(wave, flux_arr, list(templates.keys()), fwhm=fwhm, key=key)
+    
+    @property 
+    def R(self):
+        """
+        Resolution `1/dlog(wave)` of the wavelength grid
+        """
+        return 1./np.median(np.diff(np.log(self.wave)))
+        
+    @property 
+    def NTEMP(self):
+        return len(self.names)
+        
+    def __len__(self):
+        return len(self.names)
+    
+    def __iter__(self):
+        return iter(self.names)
+    
+    def __contains__(self, key):
+        return key in self._index
+    
+    def keys(self):
+        return list(self.names)
+    
+    def values(self):
+        return [self[k] for k in self.names]
+    
+    def items(self):
+        return [(k, self[k]) for k in self.names]
+    
+    def __eq__(self, other):
+        if isinstance(other, TemplateBank):
+            return ((self.names == other.names) & 
+                    np.array_equal(self.wave, other.wave) &
+                    np.array_equal(self.flux_arr, other.flux_arr))
+        
+        if isinstance(other, dict):
+            if len(other) != len(self):
+                return False
+            
+            return list(other.keys()) == self.names
+            
+        return False
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    __hash__ = None
+    
+    def __getitem__(self, key):
+        """Template as a `~grizli.utils.SpectrumTemplate` object
+        
+        The `wave` and `flux` attributes of the returned template are views
+        into the bank arrays, which must not be modified in place.
+        """
+        if key not in self._views:
+            i = self._index[key]
+            temp = SpectrumTemplate(wave=self.wave, flux=self.flux_arr[i,:],
+                                    name=key)
+            temp.name = key
+            temp.fwhm = self.fwhm[i]
+            self._views[key] = temp
+            
+        return self._views[key]
+    
+    def __getstate__(self):
+        """Don't pickle the template views"""
+        state = self.__dict__.copy()
+        state['_views'] = {}
+        return state
+            
+    def to_dict(self):
+        """Ordered dictionary of `~grizli.utils.SpectrumTemplate` objects
+        """
+        return OrderedDict(self.items())
+        
+    def subset(self, names):
+        """New `~grizli.utils.TemplateBank` with a subset of the templates
+        
+        Parameters
+        ----------
+        names : list
+            Template names to keep, in the order given.
+            
+        """
+        ix = [self._index[name] for name in names]
+        return TemplateBank(self.wave, self.flux_arr[ix,:], names,
+                            fwhm=[self.fwhm[i] for i in ix])
+        
+    def save(self, file):
+        """Save the bank to a `~numpy` `.npz` file
+        """
+        fwhm = np.array([np.nan if f is None else f for f in self.fwhm])
+        np.savez(file, wave=self.wave, flux_arr=self.flux_arr, 
+                 names=np.array(self.names), fwhm=fwhm, 
+                 key=np.array(repr(self.key)))
+    
+    @classmethod 
+    def load(cls, file):
+        """Read a bank saved with `~grizli.utils.TemplateBank.save`
+        
+        Returns
+        -------
+        bank : `~grizli.utils.TemplateBank`
+        
+        key : str
+            String representation of the parameters used to generate the bank.
+            
+        """
+        npz = np.load(file)
+        fwhm = [f if np.isfinite(f) else None for f in npz['fwhm']]
+        bank = cls(npz['wave'], npz['flux_arr'], list(npz['names']),
+                   fwhm=fwhm)
+        
+        return bank, str(npz['key'])
+    
+def log_wave_grid(wave_range=[100., 1.e5], R=5000):
+    """Wavelength grid with constant steps in `log(wave)`
+    
+    Parameters
+    ----------
+    wave_range : [float, float]
+        Minimum and maximum wavelength.
+    
+    R : float
+        Resolution, `1/dlog(wave)`.
+    
+    Returns
+    -------
+    wave : `~numpy.ndarray`
+        Wavelength grid.
+        
+    """
+    NL = int(np.ceil(np.log(wave_range[1]/wave_range[0])*R))+1
+    wave = wave_range[0]*np.exp(np.arange(NL)/R)
+    return wave
+    
+def log_resampling_matrix(wave, x):
+    """Linear operator equivalent to `interp_conserve_c` from a fixed grid
+    
+    Since `~grizli.utils_c.interp.interp_conserve_c` is linear in the input 
+    fluxes, the resampling from a fixed template grid `wave` to the output
+    grid `x` can be precomputed as a sparse matrix, such that
+    
+        >>> i0, i1, matrix = log_resampling_matrix(wave, x)
+        >>> yint = matrix.dot(flux[i0:i1])
+        
+    is the same as
+    
+        >>> yint = interp_conserve_c(x, wave, flux)
+    
+    The matrix elements are the averages of the linear interpolation weights
+    of the `wave` pixels over the output bins, which are computed directly 
+    from the overlaps of the bins with the grid intervals.
+    
+    Parameters
+    ----------
+    wave : array-like
+        Input template wavelength grid, e.g., `~grizli.utils.TemplateBank.wave`.
+    
+    x : array-like
+        Sorted output wavelengths.
+        
+    Returns
+    -------
+    i0, i1 : int
+        Slice of `wave` that contributes to the output grid.
+    
+    matrix : `~scipy.sparse.csr_matrix`
+        Matrix with shape `(len(x), i1-i0)`.
+    
+    """
+    import scipy.sparse
+    
+    x = np.cast[np.float64](x)
+    wave = np.cast[np.float64](wave)
+    
+    # Pad by two pixels so that the output bins are fully contained within
+    # the grid slice
+    i0 = np.maximum(np.searchsorted(wave, x.min())-2, 0)
+    i1 = np.minimum(np.searchsorted(wave, x.max())+2, len(wave))
+    
+    wslice = wave[i0:i1]
+    NX, NW = len(x), i1-i0
+    
+    # Output bin edges, as in `interp_conserve_c`
+    edges = np.hstack([x[:1], (x[1:]+x[:-1])/2., x[-1:]])
+    
+    # Subintervals where both the output bin and the linear segment of the 
+    # input grid are fixed
+    inside = (wslice > edges[0]) & (wslice < edges[-1])
+    bounds = np.unique(np.hstack([edges, wslice[inside]]))
+    left, right = bounds[:-1], bounds[1:]
+    mid = (left+right)/2.
+    
+    k = np.searchsorted(edges, mid)-1
+    s = np.searchsorted(wslice, mid)-1
+    
+    # The interpolated spectrum is zero outside of the grid
+    ok = (s >= 0) & (s < NW-1)
+    k, s, left, right = k[ok], s[ok], left[ok], right[ok]
+    
+    # Integrals of the two linear interpolation weights over the 
+    # subintervals, normalized by the bin widths
+    h = wslice[s+1]-wslice[s]
+    int_hi = ((right-wslice[s])**2-(left-wslice[s])**2)/2./h
+    int_lo = (right-left)-int_hi
+    
+    dx = (edges[k+1]-edges[k])
+    rows = np.hstack([k, k])
+    cols = np.hstack([s, s+1])
+    data = np.hstack([int_lo/dx, int_hi/dx])
+    
+    matrix = scipy.sparse.coo_matrix((data, (rows, cols)), shape=(NX, NW))
+    return i0, i1, matrix.tocsr()
+    
+def log_shift_spectra(flux_arr, wave, z, i0=0, i1=None):
+    """Redshift templates on a log-wavelength grid by shifting the array index
+    
+    On a grid with constant steps `1/R` in `log(wave)`, the redshifted 
+    template 
+    
+        >>> flux_z = np.interp(wave, wave*(1+z), flux/(1+z))
+        
+    is a shift of `R*log(1+z)` pixels, with linear interpolation for the 
+    fractional part of the shift.
+    
+    Parameters
+    ----------
+    flux_arr : array-like, dimensions `(NTEMP, NL)`
+        Rest-frame template fluxes on the grid `wave`.
+    
+    wave : array-like, dimensions `(NL,)`
+        Log-wavelength grid, e.g., `~grizli.utils.log_wave_grid`.
+    
+    z : float
+        Redshift.
+    
+    i0, i1 : int
+        Slice of `wave` where to evaluate the redshifted templates.
+        
+    Returns
+    -------
+    flux_z : `~numpy.ndarray`, dimensions `(NTEMP, i1-i0)`
+        Redshifted templates at `wave[i0:i1]`, including the `1/(1+z)` 
+        factor.
+        
+    """
+    flux_arr = np.atleast_2d(flux_arr)
+    NL = flux_arr.shape[1]
+    if i1 is None:
+        i1 = NL
+        
+    R = (NL-1)/np.log(wave[-1]/wave[0])
+    shift = R*np.log(1+z)
+    s0 = int(np.floor(shift))
+    frac = shift - s0
+    
+    # flux_z[:,m-i0] = (1-frac)*flux_arr[:,m-s0] + frac*flux_arr[:,m-s0-1]
+    flux_z = np.zeros((flux_arr.shape[0], i1-i0))
+    for si, wht in [(s0, 1-frac), (s0+1, frac)]:
+        m0, m1 = np.maximum(i0, si), np.minimum(i1, NL+si)
+        if m1 > m0:
+            flux_z[:,m0-i0:m1-i0] += wht*flux_arr[:,m0-si:m1-si]
+    
+    return flux_z/(1+z)
+    
+def load_template_bank(fwhm=400, line_complexes=True, stars=False,
+                       full_line_list=None, continuum_list=None,
+                       fsps_templates=False, R=None, wave_range=[100., 1.e5],
+                       cache_dir=None, verbose=False):
+    """Cached `~grizli.utils.TemplateBank` version of `~grizli.utils.load_templates`
+    
+    The templates are generated with `~grizli.utils.load_templates` and 
+    resampled to a common log-wavelength grid only the first time a given 
+    combination of parameters is requested.  Banks are memoized in 
+    `~grizli.utils.TEMPLATE_BANK_CACHE` and, optionally, saved to `.npz` 
+    files in `cache_dir` so that they can be reused by other processes.
+    
+    Parameters
+    ----------
+    fwhm, line_complexes, stars, full_line_list, continuum_list, fsps_templates : 
+        Passed to `~grizli.utils.load_templates`.
+    
+    R : None or float
+        Resolution of the log-wavelength grid.  If None, then use 
+        `max(5000, 3*2.35*c/fwhm)` so that the emission line templates are
+        sampled with at least three pixels per sigma.
+        
+    wave_range : [float, float]
+        Wavelength limits of the bank, Angstrom.
+    
+    cache_dir : None, False or str
+        Directory for the `.npz` files.  If None, then use 
+        `$GRIZLI/templates/cache`.  If False, only keep the banks in memory.
+        
+    verbose : bool
+        Log status messages.
+        
+    Returns
+    -------
+    bank : `~grizli.utils.TemplateBank`
+    
+    """
+    import hashlib
+    
+    if R is None:
+        R = np.maximum(5000, 3*2.35*const.c.to(KMS).value/fwhm)
+    
+    key = (float(fwhm), bool(line_complexes), bool(stars),
+           None if full_line_list is None else tuple(full_line_list),
+           None if continuum_list is None else tuple(continuum_list),
+           bool(fsps_templates), float(R), 
+           (float(wave_range[0]), float(wave_range[1])))
+    
+    if key in TEMPLATE_BANK_CACHE:
+        return TEMPLATE_BANK_CACHE[key]
+    
+    if cache_dir is None:
+        if os.getenv('GRIZLI') is not None:
+            cache_dir = os.path.join(os.getenv('GRIZLI'), 'templates', 
+                                     'cache')
+        else:
+            cache_dir = False
+            
+    bank = None
+    if cache_dir:
+        hash = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, 
+                                  'template_bank_{0}.npz'.format(hash))
+        
+        if os.path.exists(cache_file):
+            try:
+                bank, file_key = TemplateBank.load(cache_file)
+                if file_key != repr(key):
+                    bank = None
+                else:
+                    bank.key = key
+                    if verbose:
+                        logging.info('Read template bank {0}'.format(cache_file))
+            except:
+                bank = None
+                
+    if bank is None:
+        templates = load_templates(fwhm=fwhm, line_complexes=line_complexes,
+                                   stars=stars, full_line_list=full_line_list,
+                                   continuum_list=continuum_list,
+                                   fsps_templates=fsps_templates)
+        
+        bank = TemplateBank.from_templates(templates, R=R, 
+                                           wave_range=wave_range, key=key)
+        
+        if cache_dir:
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                
+                bank.save(cache_file)
+                if verbose:
+                    logging.info('Save template bank {0}'.format(cache_file))
+            except (IOError, OSError):
+                logging.warning('Couldn\'t write template bank to {0}'.format(cache_dir))
+    
+    TEMPLATE_BANK_CACHE[key] = bank
+    return bank
+    
 def polynomial_templates(wave, order=0, line=False):
     temp = OrderedDict()  
     if line:
@@ -1445,17 +2106,27 @@ def dot_templates(coeffs, templates, z=0, max_R=5000):
     
     return tc, tl
     
-def array_templates(templates, max_R=5000):
+ARRAY_TEMPLATES_CACHE = []
+
+def array_templates(templates, max_R=5000, cache=False):
     """Return an array version of the templates that have all been interpolated to the same grid.
     
     
     Parameters
     ----------
     templates : dictionary of `~grizli.utils.SpectrumTemplate` objects
-        Output template list with `NTEMP` templates.  
+        Output template list with `NTEMP` templates.  If a 
+        `~grizli.utils.TemplateBank`, then the arrays of the bank are returned
+        directly.
     
     max_R : float
         Maximum spectral resolution of the regridded templates.
+    
+    cache : bool
+        Keep the result in `~grizli.utils.ARRAY_TEMPLATES_CACHE` and reuse
+        it for subsequent calls with the same template objects and `max_R`.
+        The last four results are kept.  The templates shouldn't be 
+        modified in place if the cache is used.
         
     Returns
     -------
@@ -1471,6 +2142,23 @@ def array_templates(templates, max_R=5000):
         
     """
     from grizli.utils_c.interp import interp_conserve_c
+    
+    if isinstance(templates, TemplateBank):
+        # Already on a common grid
+        return templates.wave, templates.flux_arr, templates.is_line
+    
+    if cache:
+        refs = [(t, templates[t]) for t in templates]
+        for entry in ARRAY_TEMPLATES_CACHE:
+            if (entry[0] == max_R) & (len(entry[1]) == len(refs)):
+                if all([(r[0] == e[0]) & (r[1] is e[1]) 
+                        for r, e in zip(refs, entry[1])]):
+                    return entry[2]
+        
+        result = array_templates(templates, max_R=max_R, cache=False)
+        ARRAY_TEMPLATES_CACHE.insert(0, (max_R, refs, result))
+        del ARRAY_TEMPLATES_CACHE[4:]
+        return result
         
     wave = np.unique(np.hstack([templates[t].wave for t in templates]))
     clipsum, iter = 1, 0
@@ -1533,7 +2221,8 @@ def compute_equivalent_widths(templates, coeffs, covar, max_R=5000, Ndraw=1000,
         coeffs = coeffsx[mb.N:]
     
     # Array versions of the templates
-    wave, flux_arr, is_line = array_templates(templates, max_R=max_R)
+    wave, flux_arr, is_line = array_templates(templates, max_R=max_R, 
+                                              cache=True)
     keys = np.array(list(templates.keys()))
     
     EWdict = OrderedDict()
@@ -1554,22 +2243,44 @@ def compute_equivalent_widths(templates, coeffs, covar, max_R=5000, Ndraw=1000,
     
     draws = np.random.multivariate_normal(coeffs[clip], covar_clip, size=Ndraw)
     
-    # Evaluate the continuum fits from the draws             
-    continuum = np.dot(draws*(~is_line[clip]), flux_arr[clip,:])
-    
-    # Compute the emission line EWs
+    # Integration weights of the line templates, i.e., trapezoidal rule
+    # over the wavelengths where the line templates are non-zero
+    flux_clip = flux_arr[clip,:]
     tidx = np.where(is_line[clip])[0]
-    for ix in tidx:
-        key = keys[clip][ix]
-
-        # Line template
-        line = np.dot(draws[:,ix][:,None], flux_arr[clip,:][ix,:][None,:])
-        
-        # Where line template non-zero
-        mask = flux_arr[clip,:][ix,:] > 0
-        ew_i = np.trapz((line/continuum)[:,mask], wave[mask], axis=1)
+    
+    weights = np.zeros((len(tidx), len(wave)))
+    for i, ix in enumerate(tidx):
+        mask = flux_clip[ix,:] > 0
+        wmask = wave[mask]
+        if len(wmask) < 2:
+            continue
         
-        EWdict[key] = np.percentile(ew_i, [16., 50., 84.])
+        dw = np.diff(wmask)/2.
+        trapz_weight = np.append(dw, 0) + np.append(0, dw)
+        weights[i,mask] = trapz_weight*flux_clip[ix,mask]
+    
+    # Only evaluate the continuum where needed
+    cols = (weights != 0).sum(axis=0) > 0
+    continuum = np.dot(draws*(~is_line[clip]), flux_clip[:,cols])
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_continuum = 1./continuum
+    
+    # Emission line EWs for all lines and draws
+    if np.isfinite(inv_continuum).all():
+        ew_int = np.dot(inv_continuum, weights[:,cols].T)
+    else:
+        # Zeros in the continuum, integrate the lines separately
+        ew_int = np.zeros((Ndraw, len(tidx)))
+        for i in range(len(tidx)):
+            wcols = weights[i,cols] != 0
+            ew_int[:,i] = np.dot(inv_continuum[:,wcols], weights[i,cols][wcols])
+    
+    ew = draws[:,tidx]*ew_int
+    ew_pct = np.percentile(ew, [16., 50., 84.], axis=0)
+    
+    for i, ix in enumerate(tidx):
+        EWdict[keys[clip][ix]] = ew_pct[:,i]
     
     return EWdict
     
@@ -2489,6 +3200,317 @@ td {font-size: 10pt;}
             fp.writelines(lines)
             fp.close()
     
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Great-circle distance between sky positions (haversine formula)
+    
+    Parameters
+    ----------
+    ra1, dec1, ra2, dec2 : float or `~numpy.ndarray`
+        Coordinates, decimal degrees.
+    
+    Returns
+    -------
+    sep : float or `~numpy.ndarray`
+        Separation, decimal degrees.
+        
+    """
+    r1, d1, r2, d2 = [np.radians(x) for x in [ra1, dec1, ra2, dec2]]
+    h = np.sin((d2-d1)/2.)**2 + np.cos(d1)*np.cos(d2)*np.sin((r2-r1)/2.)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+    
+class SkyTileCache(object):
+    def __init__(self, name, query_func=None, cache_dir=None, tile_size=6.,
+                 offline=False, max_rows=None, ra_col='ra', dec_col='dec',
+                 verbose=True, **query_kwargs):
+        """Tile-indexed on-disk cache of catalog cone queries
+        
+        The sky is divided into declination bands of height ~`tile_size`,
+        which are divided in RA into tiles of approximately the same width.
+        The sources of each tile are retrieved with a single cone query 
+        circumscribing the tile and saved to a FITS table, so that 
+        subsequent cone queries that fall on cached tiles don't need the 
+        remote service and only the missing tiles are fetched.
+        
+        Parameters
+        ----------
+        name : str
+            Name of the catalog, which sets the subdirectory of the tiles.
+            It should change with any `query_kwargs` that change the 
+            contents of the query result.
+        
+        query_func : function
+            Function that performs the remote cone query, with signature 
+            `query_func(ra=ra, dec=dec, radius=radius, **query_kwargs)`, 
+            where `radius` is in arcmin (e.g., 
+            `~grizli.prep.get_gaia_catalog`).  Not needed with 
+            `offline=True`.
+        
+        cache_dir : None or str
+            Directory of the cache.  If None, then use
+            `$GRIZLI/catalogs/cache`.
+        
+        tile_size : float
+            Nominal size of the tiles, arcmin.
+        
+        offline : bool
+            Only use tiles that are already cached and raise an `IOError` 
+            if any are missing.
+        
+        max_rows : None or int
+            Row limit of the remote service.  A warning is printed if a tile
+            query returns this many rows, which indicates that the tile is
+            incomplete.
+        
+        ra_col, dec_col : str
+            Coordinate columns of the query results, decimal degrees.
+        
+        verbose : bool
+            Print status messages.
+            
+        query_kwargs : dict
+            Additional keywords passed to `query_func`.
+        
+        Attributes
+        ----------
+        path : str
+            Directory of the tile files.
+        
+        nband : int
+            Number of declination bands.
+        
+        n_fetch : int
+            Number of tiles fetched from the remote service.
+            
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.getenv('GRIZLI', '.'), 'catalogs', 
+                                     'cache')
+        
+        self.name = name
+        self.query_func = query_func
+        self.query_kwargs = query_kwargs
+        self.tile_size = tile_size
+        self.offline = offline
+        self.max_rows = max_rows
+        self.ra_col = ra_col
+        self.dec_col = dec_col
+        self.verbose = verbose
+        
+        self.path = os.path.join(cache_dir, 
+                                 '{0}_t{1:.2f}'.format(name, tile_size))
+        
+        self.nband = int(np.ceil(180*60./tile_size))
+        self.band_height = 180./self.nband
+        self.n_fetch = 0
+    
+    def band_limits(self, j):
+        """Declination limits of band `j`"""
+        dec0 = -90. + j*self.band_height
+        return dec0, dec0 + self.band_height
+    
+    def band_ntile(self, j):
+        """Number of tiles in band `j`"""
+        dec0, dec1 = self.band_limits(j)
+        if dec0*dec1 < 0:
+            min_dec = 0.
+        else:
+            min_dec = np.minimum(np.abs(dec0), np.abs(dec1))
+        
+        width = 360.*np.cos(np.radians(min_dec))
+        return int(np.maximum(np.ceil(width/(self.tile_size/60.)), 1))
+    
+    def tile_limits(self, tile):
+        """RA and Dec limits of `tile = (j, i)`
+        
+        Returns
+        -------
+        ra0, ra1, dec0, dec1 : float
+            Limits, decimal degrees.  
+        """
+        j, i = tile
+        dec0, dec1 = self.band_limits(j)
+        n = self.band_ntile(j)
+        return i*360./n, (i+1)*360./n, dec0, dec1
+    
+    def tiles_in_cone(self, ra=0., dec=0., radius=3.):
+        """Tiles that overlap with a cone
+        
+        Parameters
+        ----------
+        ra, dec : float
+            Center of the cone, decimal degrees.
+        
+        radius : float
+            Radius of the cone, arcmin.
+        
+        Returns
+        -------
+        tiles : list
+            List of `(j, i)` tile indices.
+            
+        """
+        r = radius/60.
+        dmin = np.maximum(dec-r, -90)
+        dmax = np.minimum(dec+r, 90)
+        
+        j0 = int(np.floor((dmin+90)/self.band_height))
+        j1 = int(np.minimum(np.floor((dmax+90)/self.band_height), 
+                            self.nband-1))
+        
+        # Half-width in RA of the cone
+        if (dec+r >= 90) | (dec-r <= -90):
+            dra = 180.
+        else:
+            sin_dra = np.sin(np.radians(r))/np.cos(np.radians(dec))
+            dra = np.degrees(np.arcsin(np.minimum(sin_dra, 1)))
+        
+        tiles = []
+        for j in range(j0, j1+1):
+            n = self.band_ntile(j)
+            if dra >= 90:
+                ix = np.arange(n)
+            else:
+                i0 = int(np.floor((ra-dra)/360.*n))
+                i1 = int(np.floor((ra+dra)/360.*n))
+                ix = np.unique(np.arange(i0, i1+1) % n)
+            
+            tiles.extend([(j, i) for i in ix])
+            
+        return tiles
+    
+    def tile_file(self, tile):
+        """Filename of a cached tile"""
+        return os.path.join(self.path, 
+                            'tile_{0:05d}_{1:05d}.fits'.format(*tile))
+    
+    def in_tile(self, tile, ra, dec):
+        """Test if coordinates are in a tile"""
+        ra0, ra1, dec0, dec1 = self.tile_limits(tile)
+        ra = ra % 360
+        test = (ra >= ra0) & (ra < ra1) & (dec >= dec0)
+        if tile[0] == self.nband-1:
+            test &= dec <= dec1
+        else:
+            test &= dec < dec1
+            
+        return test
+        
+    def fetch_tile(self, tile):
+        """Query the remote service for the sources in a tile
+        
+        The sources of the query that fall in the tile are written to 
+        `tile_file(tile)`.
+        """
+        ra0, ra1, dec0, dec1 = self.tile_limits(tile)
+        
+        # Center and circumscribed radius, sampling the tile edges
+        if dec1 >= 90:
+            ra_c, dec_c = 0., 90.
+        elif dec0 <= -90:
+            ra_c, dec_c = 0., -90.
+        else:
+            ra_c, dec_c = (ra0+ra1)/2., (dec0+dec1)/2.
+        
+        f = np.linspace(0, 1, 9)
+        ra_edge = np.hstack([ra0+f*(ra1-ra0), ra0+f*(ra1-ra0), ra0+f*0, 
+                             ra1+f*0])
+        dec_edge = np.hstack([dec0+f*0, dec1+f*0, dec0+f*(dec1-dec0), 
+                              dec0+f*(dec1-dec0)])
+        
+        sep = angular_separation(ra_c, dec_c, ra_edge, dec_edge).max()
+        radius = sep*60*1.01
+        
+        if self.verbose:
+            logging.info('{0}: fetch tile {1} ({2:.5f}, {3:.5f}, r={4:.2f}\')'.format(self.name, tile, ra_c, dec_c, radius))
+            
+        table = self.query_func(ra=ra_c, dec=dec_c, radius=radius,
+                                **self.query_kwargs)
+        self.n_fetch += 1
+        
+        if table is None:
+            # e.g., astroquery returns None for empty results
+            table = Table()
+            table[self.ra_col] = np.zeros(0)
+            table[self.dec_col] = np.zeros(0)
+        
+        if self.max_rows is not None:
+            if len(table) >= self.max_rows:
+                logging.warning('{0}: tile {1} has {2} rows, probably truncated.'.format(self.name, tile, len(table)))
+                    
+        if len(table) > 0:
+            table = table[self.in_tile(tile, np.asarray(table[self.ra_col]),
+                                       np.asarray(table[self.dec_col]))]
+        
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Made by another process
+                pass
+        
+        # Write to a temporary file first for other processes
+        file = self.tile_file(tile)
+        tmp_file = '{0}.{1}.tmp'.format(file, os.getpid())
+        table.write(tmp_file, format='fits', overwrite=True)
+        os.rename(tmp_file, file)
+        
+        return table
+    
+    def read_tile(self, tile):
+        """Read a cached tile"""
+        return Table.read(self.tile_file(tile), format='fits')
+        
+    def missing_tiles(self, ra=0., dec=0., radius=3.):
+        """Tiles of a cone query that aren't in the cache"""
+        return [tile for tile in self.tiles_in_cone(ra=ra, dec=dec, 
+                                                    radius=radius)
+                if not os.path.exists(self.tile_file(tile))]
+        
+    def query(self, ra=0., dec=0., radius=3.):
+        """Cone query from the cached tiles, fetching missing tiles
+        
+        Parameters
+        ----------
+        ra, dec : float
+            Center of the cone, decimal degrees.
+        
+        radius : float
+            Radius of the cone, arcmin.
+        
+        Returns
+        -------
+        table : `~astropy.table.Table`
+            Sources within `radius` of (`ra`, `dec`).
+            
+        """
+        tiles = self.tiles_in_cone(ra=ra, dec=dec, radius=radius)
+        missing = [tile for tile in tiles 
+                   if not os.path.exists(self.tile_file(tile))]
+        
+        if self.offline & (len(missing) > 0):
+            raise IOError('{0}: {1} of {2} tiles not in the cache {3}'.format(self.name, len(missing), len(tiles), self.path))
+        
+        tables = []
+        for tile in tiles:
+            if tile in missing:
+                tables.append(self.fetch_tile(tile))
+            else:
+                tables.append(self.read_tile(tile))
+        
+        if self.verbose:
+            logging.info('{0}: {1} tiles ({2} cached)'.format(self.name, 
+                                       len(tiles), len(tiles)-len(missing)))
+        
+        nonempty = [tab for tab in tables if len(tab) > 0]
+        if len(nonempty) == 0:
+            return tables[0][:0]
+        
+        table = astropy.table.vstack(nonempty, metadata_conflicts='silent')
+        sep = angular_separation(ra, dec, np.asarray(table[self.ra_col]),
+                                 np.asarray(table[self.dec_col]))
+        
+        return table[sep <= radius/60.]
+    
 def column_values_in_list(col, test_list):
     """Test if column elements "in" an iterable (e.g., a list of strings)
     
@@ -2525,6 +3547,131 @@ def fill_between_steps(x, y0, y1, ax=None, *args, **kwargs):
     
     ax.fill_between(xfull[so], y0full[so], y1full[so], *args, **kwargs)
 
+def normal_covariance(AxT=None, ATA=None, R=None):
+    """Covariance matrix of a linear least-squares problem
+    
+    Inverse of the normal matrix, `(AxT.T @ AxT)^-1`, computed with a 
+    Cholesky factorization.  Falls back to a general matrix inverse if the 
+    normal matrix isn't numerically positive definite.
+    
+    Parameters
+    ----------
+    AxT : `(N,M)` `~np.ndarray`
+        Design matrix, weighted by the inverse uncertainties.
+    
+    ATA : `(M,M)` `~np.ndarray` or None
+        Precomputed normal matrix, e.g., from `normal_equations_lstsq`.  If
+        specified, `AxT` is ignored.
+    
+    R : `(M,M)` `~np.ndarray` or None
+        Upper-triangular Cholesky factor of the normal matrix, 
+        `ATA = R.T @ R`, from `normal_equations_lstsq`.  If specified, 
+        `AxT` and `ATA` are ignored and the normal matrix isn't factored
+        again.
+        
+    Returns
+    -------
+    covar : `(M,M)` `~np.ndarray`
+        Covariance matrix.
+    """
+    import scipy.linalg
+    
+    if R is not None:
+        return scipy.linalg.cho_solve((R, False), np.eye(R.shape[0]))
+        
+    if ATA is None:
+        ATA = np.dot(AxT.T, AxT)
+        
+    try:
+        cho = scipy.linalg.cho_factor(ATA, lower=True)
+        covar = scipy.linalg.cho_solve(cho, np.eye(ATA.shape[0]))
+    except (np.linalg.LinAlgError, ValueError):
+        covar = np.matrix(ATA).I.A
+    
+    return covar
+    
+def normal_equations_lstsq(AxT, data, fitter='nnls', bounds=None, ATA=None, ATy=None):
+    """Solve a linear least-squares problem from its normal equations
+    
+    For a tall design matrix `AxT` with shape `(N,M)` and `N >> M`, the 
+    normal matrix `ATA = AxT.T @ AxT` is factored as `ATA = R.T @ R` with a 
+    Cholesky decomposition.  Since 
+    
+        |AxT @ x - data|^2 = |R @ x - d|^2 + const, d = R^-T @ AxT.T @ data, 
+    
+    the (bounded) problem can be solved with the small `(M,M)` system 
+    `(R, d)` with the same solution as the full problem.
+    
+    Parameters
+    ----------
+    AxT : `(N,M)` `~np.ndarray`
+        Design matrix.
+    
+    data : `(N,)` `~np.ndarray`
+        Data vector.
+    
+    fitter : 'nnls', 'lstsq', 'bounded'
+        Solver: `scipy.optimize.nnls` for non-negative coefficients, 
+        unconstrained least squares, or `scipy.optimize.lsq_linear` with
+        `method='bvls'` and `bounds`.
+    
+    bounds : (lower, upper) or None
+        Bounds on the coefficients for `fitter='bounded'`.
+    
+    ATA, ATy : `~np.ndarray` or None
+        Precomputed `AxT.T @ AxT` and `AxT.T @ data`, e.g., from a batched
+        product of several design matrices.  If specified, `AxT` and `data` 
+        aren't used.
+        
+    Returns
+    -------
+    coeffs : `(M,)` `~np.ndarray` or None
+        Coefficients, or None if the normal matrix isn't positive definite 
+        or is poorly conditioned, in which case the full system should be 
+        used instead.
+    
+    ATA : `(M,M)` `~np.ndarray`
+        Normal matrix.
+    
+    R : `(M,M)` `~np.ndarray` or None
+        Upper-triangular Cholesky factor of `ATA`, or None if the 
+        factorization failed.  Pass `ATA` and `R` to `normal_covariance` for 
+        the covariance matrix.
+    """
+    import scipy.linalg
+    import scipy.optimize
+    
+    if ATA is None:
+        ATA = np.dot(AxT.T, AxT)
+    
+    if ATy is None:
+        ATy = np.dot(AxT.T, data)
+    
+    try:
+        R = scipy.linalg.cholesky(ATA, lower=False)
+    except (np.linalg.LinAlgError, ValueError):
+        return None, ATA, None
+    
+    ### Nearly singular, squared condition number too large
+    Rd = np.abs(np.diag(R))
+    if Rd.min() <= 1.e-7*Rd.max():
+        return None, ATA, R
+        
+    if fitter == 'lstsq':
+        coeffs = scipy.linalg.cho_solve((R, False), ATy)
+        return coeffs, ATA, R
+        
+    d = scipy.linalg.solve_triangular(R, ATy, trans='T', lower=False)
+    
+    if fitter == 'nnls':
+        coeffs, rnorm = scipy.optimize.nnls(R, d)
+    else:
+        lsq_out = scipy.optimize.lsq_linear(R, d, bounds=bounds, 
+                                            method='bvls', tol=1.e-8)
+        coeffs = lsq_out.x
+    
+    return coeffs, ATA, R
+    
 def fill_masked_covar(covar, mask):
     """Fill a covariance matrix in a larger array that had masked values
     
@@ -16,6 +16,9 @@ ctypedef np.int32_t FINT_t
 ctypedef np.float32_t FTYPE_t
 
 import cython
+from cython.parallel import prange, threadid
+
+import multiprocessing
 
 cdef extern from "math.h":
     double sqrt(double x)
@@ -62,6 +65,132 @@ def disperse_grism_object(np.ndarray[FTYPE_t, ndim=2] flam, np.ndarray[FTYPE_t,
     
     return True
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.embedsignature(True)
+def disperse_grism_object_parallel(np.ndarray[FTYPE_t, ndim=2] flam, np.ndarray[FTYPE_t, ndim=2] segm, int seg_id, np.ndarray[LINT_t, ndim=1] idxl, np.ndarray[DTYPE_t, ndim=1] yfrac, np.ndarray[DTYPE_t, ndim=1] ysens, np.ndarray[DTYPE_t, ndim=1] full, np.ndarray[LINT_t, ndim=1] x0, np.ndarray[LINT_t, ndim=1] shd, np.ndarray[LINT_t, ndim=1] sh_thumb, np.ndarray[LINT_t, ndim=1] shg, int num_threads=0):
+    """Compute a dispersed 2D spectrum with OpenMP threads
+
+    Same inputs as `disperse_grism_object`, with the loop over the columns
+    of the thumbnail split between `num_threads` threads without the GIL.
+    Each thread accumulates into its own copy of the output array, which
+    are then summed into `full`.
+
+    Parameters
+    ----------
+    num_threads: int
+        Number of threads.  If <= 0, use `multiprocessing.cpu_count()`.
+
+    """
+    cdef int i, j, it, nthreads
+    cdef Py_ssize_t ii, ni, k, k1, k2, nk, nl
+    cdef double fl_ij
+
+    if num_threads <= 0:
+        num_threads = multiprocessing.cpu_count()
+
+    nthreads = num_threads
+    nk = len(idxl)
+    nl = len(full)
+    ni = 2*sh_thumb[1]
+
+    ### Thread-local output arrays for race-free accumulation
+    cdef np.ndarray[DTYPE_t, ndim=2] thread_full = np.zeros((nthreads, nl),
+                                                            dtype=DTYPE)
+
+    cdef FTYPE_t[:, :] flam_v = flam
+    cdef FTYPE_t[:, :] segm_v = segm
+    cdef LINT_t[:] idxl_v = idxl
+    cdef DTYPE_t[:] yfrac_v = yfrac
+    cdef DTYPE_t[:] ysens_v = ysens
+    cdef DTYPE_t[:] full_v = full
+    cdef DTYPE_t[:, :] thread_v = thread_full
+    cdef LINT_t x00 = x0[0], x01 = x0[1], shd0 = shd[0], shd1 = shd[1]
+    cdef LINT_t sht0 = sh_thumb[0], sht1 = sh_thumb[1], shg1 = shg[1]
+
+    with nogil:
+        for ii in prange(ni, num_threads=nthreads, schedule='static'):
+            it = threadid()
+            i = ii - sht1
+            if (x01+i < 0) | (x01+i >= shd1):
+                continue
+
+            for j in range(0-sht0, sht0):
+                if (x00+j < 0) | (x00+j >= shd0):
+                    continue
+
+                fl_ij = flam_v[x00+j, x01+i]
+                if (fl_ij == 0) | (segm_v[x00+j, x01+i] != seg_id):
+                    continue
+
+                for k in range(nk):
+                    k1 = idxl_v[k]+j*shg1+i
+                    if (k1 >= 0) & (k1 < nl):
+                        thread_v[it, k1] += ysens_v[k]*fl_ij*yfrac_v[k]
+
+                    k2 = idxl_v[k]+(j-1)*shg1+i
+                    if (k2 >= 0) & (k2 < nl):
+                        thread_v[it, k2] += ysens_v[k]*fl_ij*(1-yfrac_v[k])
+
+        ### Reduce thread arrays
+        for k in prange(nl, num_threads=nthreads, schedule='static'):
+            for it in range(nthreads):
+                full_v[k] += thread_v[it, k]
+
+    return True
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.embedsignature(True)
+def disperse_grism_object_multi(np.ndarray[FTYPE_t, ndim=2] flam, np.ndarray[FTYPE_t, ndim=2] segm, int seg_id, np.ndarray[LINT_t, ndim=1] idxl, np.ndarray[DTYPE_t, ndim=1] yfrac, np.ndarray[DTYPE_t, ndim=2] ysens, np.ndarray[DTYPE_t, ndim=2] full, np.ndarray[LINT_t, ndim=1] x0, np.ndarray[LINT_t, ndim=1] shd, np.ndarray[LINT_t, ndim=1] sh_thumb, np.ndarray[LINT_t, ndim=1] shg):
+    """Compute dispersed 2D spectra for multiple input spectra
+    
+    Same as `disperse_grism_object` but for K spectra dispersed through the
+    same thumbnail, segmentation and trace in a single pass over the 
+    thumbnail pixels.
+    
+    Parameters
+    ----------
+    ysens: ndarray (np.double), shape (K, len(idxl))
+        Sensitivity-weighted spectra
+    
+    full: ndarray (np.double), shape (K, Npix)
+        Output array of the flattened 2D models
+    """
+    cdef int i,j,k1,k2
+    cdef unsigned int nk,nl,k,m,nspec
+    cdef double fl_ij
+    
+    nk = len(idxl)
+    nspec = full.shape[0]
+    nl = full.shape[1]
+    
+    for i in range(0-sh_thumb[1], sh_thumb[1]):
+        if (x0[1]+i < 0) | (x0[1]+i >= shd[1]):
+            continue
+            
+        for j in range(0-sh_thumb[0], sh_thumb[0]):
+            if (x0[0]+j < 0) | (x0[0]+j >= shd[0]):
+                continue
+
+            fl_ij = flam[x0[0]+j, x0[1]+i] #/1.e-17
+            if (fl_ij == 0) | (segm[x0[0]+j, x0[1]+i] != seg_id):
+                continue
+            
+            ## Trace indices shared by all of the spectra
+            for k in range(nk):
+                k1 = idxl[k]+j*shg[1]+i
+                if (k1 >= 0) & (k1 < nl):
+                    for m in range(nspec):
+                        full[m,k1] += ysens[m,k]*fl_ij*yfrac[k]
+                    
+                k2 = idxl[k]+(j-1)*shg[1]+i
+                if (k2 >= 0) & (k2 < nl):
+                    for m in range(nspec):
+                        full[m,k2] += ysens[m,k]*fl_ij*(1-yfrac[k])
+    
+    return True
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.embedsignature(True)
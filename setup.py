@@ -7,11 +7,17 @@
 
 from setuptools import setup
 from setuptools.extension import Extension
+from setuptools.command.build_ext import build_ext
 
 import os
 import numpy
 import pip
 
+try:
+    from setuptools.errors import CompileError, LinkError
+except ImportError:
+    from distutils.errors import CompileError, LinkError
+
 try:
     from Cython.Build import cythonize
     USE_CYTHON = True
@@ -28,6 +34,32 @@ else:
 
 print('C extension: {0}'.format(cext))
 
+class build_ext_openmp(build_ext):
+    """
+    Compile `disperse` with OpenMP for 
+    `disperse.disperse_grism_object_parallel`, using the flags for the 
+    compiler in use.  If the compiler doesn't support OpenMP (e.g., the 
+    default OSX compiler), build without it and the kernel runs serially.
+    """
+    def build_extension(self, ext):
+        if ext.name != 'grizli.utils_c.disperse':
+            return build_ext.build_extension(self, ext)
+        
+        if self.compiler.compiler_type == 'msvc':
+            compile_args, link_args = ['/openmp'], []
+        else:
+            compile_args, link_args = ['-fopenmp'], ['-fopenmp']
+        
+        orig_args = ext.extra_compile_args, ext.extra_link_args
+        ext.extra_compile_args = orig_args[0] + compile_args
+        ext.extra_link_args = orig_args[1] + link_args
+        try:
+            build_ext.build_extension(self, ext)
+        except (CompileError, LinkError):
+            print('OpenMP not available, compile {0} without it'.format(ext.name))
+            ext.extra_compile_args, ext.extra_link_args = orig_args
+            build_ext.build_extension(self, ext)
+
 extensions = [
     Extension("grizli.utils_c.interp", ["grizli/utils_c/interp"+cext],
         include_dirs = [numpy.get_include()],),
@@ -91,6 +123,7 @@ setup(
         'Topic :: Scientific/Engineering :: Astronomy',
     ],
     ext_modules = extensions,
+    cmdclass = {'build_ext': build_ext_openmp},
     package_data={'grizli': ['data/*', 'data/templates/*', 'data/templates/stars/*', 'data/templates/fsps/*']},
     # scripts=['grizli/scripts/flt_info.sh'],
 )